@@ -0,0 +1,91 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+# --- AI CACHE CONFIGURATION ---
+AI_CACHE_TTL = 600.0    # Seconds an answer stays valid while its context is unchanged
+AI_CACHE_SIZE = 128     # Entries kept (least recently used evicted first)
+
+
+def context_key(*parts):
+    """Stable digest of the data a prompt is built from."""
+    blob = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def _next_midnight(ts):
+    day = datetime.fromtimestamp(ts).date() + timedelta(days=1)
+    return datetime(day.year, day.month, day.day).timestamp()
+
+
+class AICache:
+    """TTL + LRU cache for generated AI text, keyed by context_key().
+
+    Entries are tagged with the device their context covers (None = all
+    devices) so a new fault or a new day on one board drops only the answers
+    that could have mentioned it.
+    """
+
+    def __init__(self, ttl=AI_CACHE_TTL, max_entries=AI_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, device_id, value)
+        self._day_end = {}             # device_id -> next local midnight
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0, "entries": 0}
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if entry[0] <= now:
+                del self._entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                self.stats["entries"] = len(self._entries)
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[2]
+
+    def put(self, key, value, device_id=None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, device_id, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+            self.stats["entries"] = len(self._entries)
+
+    def invalidate(self, device_id=None):
+        """Drops answers about device_id plus every all-devices answer; None clears everything."""
+        with self._lock:
+            if device_id is None:
+                dropped = len(self._entries)
+                self._entries.clear()
+            else:
+                stale = [k for k, (_, d, _) in self._entries.items() if d is None or d == device_id]
+                for k in stale:
+                    del self._entries[k]
+                dropped = len(stale)
+            if dropped:
+                self.stats["invalidations"] += 1
+            self.stats["entries"] = len(self._entries)
+
+    def note_sample(self, device_id, ts):
+        """Call per measurement: the first sample of a new local day invalidates that device."""
+        day_end = self._day_end.get(device_id)
+        if day_end is not None and ts < day_end:
+            return
+        self._day_end[device_id] = _next_midnight(ts)
+        if day_end is not None:
+            self.invalidate(device_id)
+
+    def clear(self):
+        self.invalidate(None)
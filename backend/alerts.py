@@ -0,0 +1,194 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# --- ALERT CONFIGURATION ---
+ALERT_QUEUE_SIZE = 1000
+ALERT_TIMEOUT = (3.05, 15)     # (connect, read) seconds per Telegram call
+ALERT_MAX_ATTEMPTS = 4         # First try + 3 retries
+ALERT_BACKOFF_BASE = 1.0       # Seconds; doubled after every failed attempt
+ALERT_BACKOFF_MAX = 30.0
+ALERT_MIN_INTERVAL = 1.0       # Telegram allows ~1 message/second per chat
+ALERT_COOLDOWN = 300.0         # Seconds between alerts with the same dedup key
+
+TELEGRAM_API = "https://api.telegram.org"
+
+
+class AlertError(Exception):
+    """A Telegram call that failed for good (after retries, or a non-retryable 4xx)."""
+
+
+class AlertDispatcher:
+    """Delivers Telegram messages from a background worker.
+
+    Callers get a Future back immediately: the MQTT thread fires and forgets,
+    while request handlers such as /api/notify can wait on .result(timeout).
+    Alerts with a dedup_key are suppressed while that key is inside its
+    cooldown window, e.g. one fault alert per device every ALERT_COOLDOWN seconds.
+    """
+
+    def __init__(self, bot_token, chat_id, queue_size=ALERT_QUEUE_SIZE):
+        self.bot_token = bot_token
+        self.chat_id = chat_id
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = {
+            "queued": 0,
+            "sent": 0,
+            "failed": 0,
+            "retries": 0,
+            "suppressed": 0,
+            "dropped": 0,
+        }
+        self._last_sent = {}   # dedup_key -> time of the last accepted alert
+        self._lock = threading.Lock()
+        self._session = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.bot_token and self.chat_id)
+
+    # --- PRODUCER SIDE ---
+    def allow(self, dedup_key, cooldown=ALERT_COOLDOWN):
+        """True if an alert for dedup_key may go out now (and starts its cooldown)."""
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_sent.get(dedup_key)
+            if last is not None and now - last < cooldown:
+                self.stats["suppressed"] += 1
+                return False
+            self._last_sent[dedup_key] = now
+            return True
+
+    def send_message(self, text, parse_mode=None, dedup_key=None, cooldown=ALERT_COOLDOWN):
+        """Queues a sendMessage call. Returns a Future, or None if suppressed/dropped."""
+        if dedup_key is not None and not self.allow(dedup_key, cooldown):
+            return None
+        data = {"chat_id": self.chat_id, "text": text}
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+        return self._submit("sendMessage", data, None)
+
+    def send_photo(self, photo_bytes, caption, parse_mode=None, filename="chart.png"):
+        """Queues a sendPhoto call. photo_bytes must be bytes so retries can resend it."""
+        data = {"chat_id": self.chat_id, "caption": caption}
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+        return self._submit("sendPhoto", data, {"photo": (filename, photo_bytes, "image/png")})
+
+    def _submit(self, method, data, files):
+        future = Future()
+        try:
+            self.queue.put_nowait((method, data, files, future))
+            self.stats["queued"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+            future.set_exception(AlertError("Alert queue full"))
+        return future
+
+    # --- LIFECYCLE ---
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="alert-dispatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Never blocks on a full queue: alerts still queued fail with AlertError."""
+        if not self._thread or not self._thread.is_alive():
+            return
+        self._stop.set()
+        try:
+            self.queue.put_nowait(None)  # Wakes an idle worker; a busy one sees _stop
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    # --- WORKER THREAD ---
+    def _get_session(self):
+        if self._session is None:
+            # requests is imported on the first send, not at server startup
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            # One pooled keep-alive connection to api.telegram.org
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+            self._session = session
+        return self._session
+
+    def _run(self):
+        last_call = 0.0
+        while not self._stop.is_set():
+            job = self.queue.get()
+            if job is None:
+                break
+            method, data, files, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            # Pace calls to stay under Telegram's per-chat rate limit
+            wait = ALERT_MIN_INTERVAL - (time.monotonic() - last_call)
+            if wait > 0:
+                self._stop.wait(wait)
+
+            try:
+                result = self._deliver(method, data, files)
+                self.stats["sent"] += 1
+                future.set_result(result)
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Telegram {method} failed: {e}")
+                future.set_exception(e)
+            last_call = time.monotonic()
+
+        # Stopped: fail whatever is still queued rather than leave callers waiting
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None and job[3].set_running_or_notify_cancel():
+                job[3].set_exception(AlertError("Alert dispatcher stopped"))
+        if self._session is not None:
+            self._session.close()
+
+    def _deliver(self, method, data, files):
+        import requests
+        url = f"{TELEGRAM_API}/bot{self.bot_token}/{method}"
+        delay = ALERT_BACKOFF_BASE
+        last_error = None
+        for attempt in range(ALERT_MAX_ATTEMPTS):
+            if attempt:
+                if self._stop.wait(delay):
+                    break  # Shutting down: no more retries
+                self.stats["retries"] += 1
+                delay = min(delay * 2, ALERT_BACKOFF_MAX)
+            try:
+                if files:
+                    resp = self._get_session().post(url, data=data, files=files, timeout=ALERT_TIMEOUT)
+                else:
+                    resp = self._get_session().post(url, json=data, timeout=ALERT_TIMEOUT)
+            except requests.RequestException as e:
+                last_error = AlertError(f"{type(e).__name__}: {e}")
+                continue
+
+            if resp.status_code == 200:
+                return resp.json()
+            last_error = AlertError(f"HTTP {resp.status_code}: {resp.text}")
+            if resp.status_code == 429:
+                # Telegram says exactly how long to back off
+                try:
+                    retry_after = resp.json().get("parameters", {}).get("retry_after")
+                except ValueError:
+                    retry_after = None
+                if retry_after:
+                    delay = min(float(retry_after), ALERT_BACKOFF_MAX)
+                continue
+            if resp.status_code < 500:
+                break  # Bad request / auth error: retrying won't help
+        raise last_error
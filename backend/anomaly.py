@@ -0,0 +1,179 @@
+import math
+import os
+import threading
+
+# --- ANOMALY DETECTION CONFIGURATION ---
+# Per-device online statistics, updated in O(1) time and memory per sample:
+# no query against measurements. Baselines are exponentially weighted with a
+# time constant (not a per-sample weight), so a 10 Hz board and a 0.5 Hz board
+# adapt at the same speed.
+OVERCURRENT_AMPS = float(os.getenv("OVERCURRENT_AMPS", "0.30"))  # Firmware hard-trips at 0.35 A
+OVERCURRENT_HOLD = 5.0       # Seconds above OVERCURRENT_AMPS before it counts as sustained
+VOLTAGE_TOLERANCE = 0.10     # Sag/swell: more than +/-10% off the device's voltage baseline
+VOLTAGE_OFF = 5.0            # V; below this the board is unpowered / not measuring, not sagging
+VOLTAGE_TAU = 600.0          # Seconds: slow baseline, so a sag doesn't drag it down with it
+POWER_TAU = 60.0             # Seconds: power mean/variance follow the load
+STEP_SIGMAS = 6.0            # A power step is this many standard deviations off the mean...
+STEP_MIN_WATTS = 10.0        # ...and at least this many watts
+STEP_COOLDOWN = 30.0         # Seconds between power-step events per device
+WARMUP_SAMPLES = 10          # Baselines are trusted after this many samples
+RESET_GAP = 120.0            # Seconds of silence after which baselines start over
+
+
+class DeviceStats:
+    """Rolling state for one device (EWMA mean/variance, open episodes)."""
+    __slots__ = ("last_ts", "samples", "v_base", "p_mean", "p_var",
+                 "oc_since", "oc_open", "v_kind", "v_since", "v_extreme", "last_step")
+
+    def __init__(self):
+        self.last_ts = None
+        self.samples = 0
+        self.v_base = None
+        self.p_mean = None
+        self.p_var = 0.0
+        self.oc_since = None   # First sample of the current run above the limit
+        self.oc_open = False   # Sustained overcurrent reported, not yet cleared
+        self.v_kind = None     # "voltage_sag" / "voltage_swell" while one is open
+        self.v_since = None
+        self.v_extreme = None  # Deepest sag / highest swell in the open episode
+        self.last_step = None
+
+
+def _alpha(dt, tau):
+    return 1.0 - math.exp(-dt / tau)
+
+
+class AnomalyDetector:
+    """Streaming checks on every ingested sample: sustained overcurrent,
+    voltage sag/swell against the device's own baseline, sudden power steps.
+
+    update() returns the events a sample opens or closes (usually none), as
+    dicts: kind, device_id, timestamp, level, message and the numbers behind it.
+    Episodes (overcurrent, sag, swell) report once when they start and once
+    when they clear, however many samples they span.
+    """
+
+    def __init__(self, overcurrent=OVERCURRENT_AMPS):
+        self.overcurrent = overcurrent
+        self._devices = {}
+        self._lock = threading.Lock()
+        self.stats = {"samples": 0, "skipped": 0, "errors": 0, "events": {}}
+
+    def update(self, device_id, ts, voltage, current, power):
+        with self._lock:
+            d = self._devices.get(device_id)
+            if d is None:
+                d = self._devices[device_id] = DeviceStats()
+            if d.last_ts is not None and ts <= d.last_ts:
+                self.stats["skipped"] += 1  # Straggler / duplicate: stats only move forward in time
+                return []
+            if d.last_ts is not None and ts - d.last_ts > RESET_GAP:
+                # Start over, open episodes included: nothing is known about
+                # the gap, so they are neither extended nor reported as cleared
+                d.samples = 0
+                d.v_base = d.p_mean = None
+                d.oc_since = None
+                d.oc_open = False
+                d.v_kind = d.v_since = d.v_extreme = None
+            dt = ts - d.last_ts if d.last_ts is not None else None
+            d.last_ts = ts
+            self.stats["samples"] += 1
+
+            events = []
+            self._check_current(d, device_id, ts, current, events)
+            self._check_voltage(d, device_id, ts, voltage, dt, events)
+            self._check_power(d, device_id, ts, power, dt, events)
+            d.samples += 1
+            for e in events:
+                self.stats["events"][e["kind"]] = self.stats["events"].get(e["kind"], 0) + 1
+            return events
+
+    # --- DETECTORS ---
+    def _check_current(self, d, device_id, ts, current, events):
+        if current > self.overcurrent:
+            if d.oc_since is None:
+                d.oc_since = ts
+            if not d.oc_open and ts - d.oc_since >= OVERCURRENT_HOLD:
+                d.oc_open = True
+                events.append(dict(
+                    kind="overcurrent", device_id=device_id, timestamp=ts, level="WARNING",
+                    current=current, limit=self.overcurrent, duration=round(ts - d.oc_since, 1),
+                    message=f"Anomaly: sustained overcurrent {current:.3f}A > {self.overcurrent:.2f}A "
+                            f"for {ts - d.oc_since:.1f}s"))
+        elif current < self.overcurrent * 0.9:  # Hysteresis: no flapping around the limit
+            if d.oc_open:
+                events.append(dict(
+                    kind="overcurrent_cleared", device_id=device_id, timestamp=ts, level="INFO",
+                    duration=round(ts - d.oc_since, 1),
+                    message=f"Anomaly cleared: overcurrent lasted {ts - d.oc_since:.1f}s"))
+            d.oc_since = None
+            d.oc_open = False
+
+    def _check_voltage(self, d, device_id, ts, voltage, dt, events):
+        if voltage < VOLTAGE_OFF:
+            return  # Unpowered / relay open: no voltage information
+        if d.v_base is None:
+            d.v_base = voltage
+            return
+        deviation = (voltage - d.v_base) / d.v_base
+        kind = None
+        if d.samples >= WARMUP_SAMPLES:
+            if deviation < -VOLTAGE_TOLERANCE:
+                kind = "voltage_sag"
+            elif deviation > VOLTAGE_TOLERANCE:
+                kind = "voltage_swell"
+
+        if kind != d.v_kind and d.v_kind is not None:
+            events.append(dict(
+                kind=d.v_kind + "_cleared", device_id=device_id, timestamp=ts, level="INFO",
+                duration=round(ts - d.v_since, 1), extreme=d.v_extreme,
+                message=f"Anomaly cleared: {d.v_kind.replace('_', ' ')} lasted {ts - d.v_since:.1f}s "
+                        f"(extreme {d.v_extreme:.1f}V)"))
+            d.v_kind = None
+        if kind is not None:
+            if d.v_kind is None:
+                d.v_kind, d.v_since, d.v_extreme = kind, ts, voltage
+                events.append(dict(
+                    kind=kind, device_id=device_id, timestamp=ts, level="WARNING",
+                    voltage=voltage, baseline=round(d.v_base, 1), deviation=round(deviation * 100, 1),
+                    message=f"Anomaly: {kind.replace('_', ' ')} {voltage:.1f}V "
+                            f"({deviation * 100:+.0f}% vs {d.v_base:.1f}V baseline)"))
+            else:
+                d.v_extreme = min(d.v_extreme, voltage) if kind == "voltage_sag" else max(d.v_extreme, voltage)
+            return  # Baseline frozen during the episode
+        if dt is not None:
+            d.v_base += _alpha(dt, VOLTAGE_TAU) * (voltage - d.v_base)
+
+    def _check_power(self, d, device_id, ts, power, dt, events):
+        if d.p_mean is None:
+            d.p_mean, d.p_var = power, 0.0
+            return
+        diff = power - d.p_mean
+        std = math.sqrt(d.p_var)
+        if (d.samples >= WARMUP_SAMPLES and abs(diff) >= max(STEP_MIN_WATTS, STEP_SIGMAS * std)
+                and (d.last_step is None or ts - d.last_step >= STEP_COOLDOWN)):
+            d.last_step = ts
+            events.append(dict(
+                kind="power_step", device_id=device_id, timestamp=ts, level="INFO",
+                power=power, mean=round(d.p_mean, 2), std=round(std, 2), step=round(diff, 2),
+                message=f"Anomaly: power step {diff:+.1f}W to {power:.1f}W (mean {d.p_mean:.1f}W, sd {std:.1f}W)"))
+        # Exponentially weighted (Welford-style) mean/variance update; the step
+        # itself is absorbed, so a new steady load becomes the new baseline
+        a = _alpha(dt, POWER_TAU)
+        incr = a * diff
+        d.p_mean += incr
+        d.p_var = (1.0 - a) * (d.p_var + diff * incr)
+
+    # --- INTROSPECTION ---
+    def snapshot(self):
+        with self._lock:
+            return {
+                device_id: {
+                    "samples": d.samples,
+                    "voltage_baseline": round(d.v_base, 2) if d.v_base is not None else None,
+                    "power_mean": round(d.p_mean, 2) if d.p_mean is not None else None,
+                    "power_std": round(math.sqrt(d.p_var), 2),
+                    "open": (["overcurrent"] if d.oc_open else []) + ([d.v_kind] if d.v_kind else []),
+                }
+                for device_id, d in self._devices.items()
+            }
@@ -0,0 +1,78 @@
+"""Telemetry decode benchmark: JSON payloads vs binary frames (codec.py).
+
+    python bench_codec.py [messages]
+
+Decodes the same readings in both formats through decode_payload(), the call
+on_message makes, and reports throughput and bytes per message; then the same
+readings again as 10-sample batch frames (10 Hz sampling, one message a second).
+"""
+import json
+import random
+import sys
+import time
+
+from codec import decode_payload, encode_batch, encode_frame
+
+STATUSES = ("OK", "OK", "OK", "IDLE", "FAULT: OC", "LEVEL_1")
+BATCH_SAMPLES = 10
+
+
+def make_readings(n):
+    now = time.time()
+    readings = []
+    for i in range(n):
+        voltage = round(230 + random.uniform(-3, 3), 1)
+        current = round(random.uniform(0.05, 0.4), 3)
+        readings.append({"device_id": f"esp32_box_{i % 8 + 1}", "voltage": voltage, "current": current,
+                         "power": round(voltage * current, 2), "status": random.choice(STATUSES),
+                         "timestamp": round(now + i * 0.1, 3)})
+    return readings
+
+
+def make_batches(readings):
+    batches = []
+    for i in range(0, len(readings), BATCH_SAMPLES):
+        chunk = readings[i:i + BATCH_SAMPLES]
+        samples = [(r["timestamp"], r["voltage"], r["current"], r["power"], r["status"]) for r in chunk]
+        batches.append((samples, chunk[0]["device_id"]))
+    return batches
+
+
+def bench(label, payloads, repeat=3, samples_per_msg=1):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for p in payloads:
+            decode_payload(p)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    rate = len(payloads) * samples_per_msg / best
+    size = sum(len(p) for p in payloads) / len(payloads) / samples_per_msg
+    print(f"{label:>12}: {rate:12,.0f} samples/s | {best / len(payloads) / samples_per_msg * 1e6:6.2f} us/sample | "
+          f"{size:5.1f} B/sample")
+    return rate
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    readings = make_readings(n)
+    as_json = [json.dumps(r).encode() for r in readings]
+    as_frames = [encode_frame(r["voltage"], r["current"], r["power"], r["status"], r["timestamp"], r["device_id"])
+                 for r in readings]
+    batches = make_batches(readings)
+    as_json_batches = [json.dumps({"device_id": device_id, "samples": [
+        dict(zip(("timestamp", "voltage", "current", "power", "status"), s)) for s in samples]}).encode()
+        for samples, device_id in batches]
+    as_frame_batches = [encode_batch(samples, device_id) for samples, device_id in batches]
+    json_rate = bench("json", as_json)
+    frame_rate = bench("binary", as_frames)
+    bench(f"json x{BATCH_SAMPLES}", as_json_batches, samples_per_msg=BATCH_SAMPLES)
+    batch_rate = bench(f"binary x{BATCH_SAMPLES}", as_frame_batches, samples_per_msg=BATCH_SAMPLES)
+    print(f"binary decodes {frame_rate / json_rate:.1f}x faster, "
+          f"{sum(map(len, as_frames)) / sum(map(len, as_json)) * 100:.0f}% of the JSON bytes; "
+          f"{BATCH_SAMPLES}-sample frames {batch_rate / json_rate:.1f}x, "
+          f"{sum(map(len, as_frame_batches)) / sum(map(len, as_json)) * 100:.0f}%")
+
+
+if __name__ == "__main__":
+    main()
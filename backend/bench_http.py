@@ -0,0 +1,125 @@
+"""HTTP load test: /api/data throughput under gunicorn at several worker counts.
+
+    python bench_http.py [--workers 1,2,4] [--clients 16] [--duration 10]
+    python bench_http.py --url http://host:5000/api/data    # an already running server
+
+Each worker count gets a fresh gunicorn (gunicorn.conf.py) on a scratch copy of
+power_monitor.db. Clients are separate processes holding one keep-alive
+connection each, so the load generator isn't limited by a single GIL.
+"""
+import argparse
+import http.client
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from multiprocessing import Pool
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+PORT = 5057
+
+
+def client(args):
+    url, duration = args
+    parts = urllib.parse.urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                errors += 1
+                continue
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+            continue
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+    return latencies, errors
+
+
+def run_load(url, clients, duration):
+    with Pool(clients) as pool:
+        results = pool.map(client, [(url, duration)] * clients)
+    latencies = sorted(l for r in results for l in r[0])
+    errors = sum(r[1] for r in results)
+    if not latencies:
+        return {"rps": 0.0, "errors": errors}
+    return {
+        "rps": len(latencies) / duration,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "errors": errors,
+    }
+
+
+def wait_ready(url, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("gunicorn exited during startup")
+        try:
+            latencies, _ = client((url, 0.2))
+            if latencies:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("gunicorn did not become ready")
+
+
+def report(label, r):
+    if not r["rps"]:
+        print(f"{label}: no successful requests ({r['errors']} errors)")
+        return
+    print(f"{label}: {r['rps']:8.1f} req/s | p50 {r['p50_ms']:6.1f} ms | p99 {r['p99_ms']:6.1f} ms | "
+          f"errors {r['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated gunicorn worker counts")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent client connections")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    parser.add_argument("--url", help="load an existing server instead of starting gunicorn")
+    args = parser.parse_args()
+
+    if args.url:
+        report(args.url, run_load(args.url, args.clients, args.duration))
+        return
+
+    url = f"http://127.0.0.1:{PORT}/api/data"
+    for workers in (int(w) for w in args.workers.split(",")):
+        workdir = tempfile.mkdtemp(prefix="gridguard-load-")
+        db = os.path.join(BACKEND_DIR, "power_monitor.db")
+        if os.path.exists(db):
+            shutil.copy(db, workdir)
+        env = dict(os.environ, WEB_CONCURRENCY=str(workers), GRIDGUARD_BIND=f"127.0.0.1:{PORT}",
+                   PYTHONPATH=os.pathsep.join(filter(None, [BACKEND_DIR, os.getenv("PYTHONPATH")])))
+        proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", os.path.join(BACKEND_DIR, "gunicorn.conf.py"),
+                                 "--access-logfile", "/dev/null", "wsgi:app"],
+                                cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(url, proc)
+            report(f"{workers} worker(s)", run_load(url, args.clients, args.duration))
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(30)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Startup benchmark: time to import server.py and build the app, in fresh interpreters.
+
+    python bench_startup.py [runs]
+
+"lazy" is the current startup. "eager" also imports the subsystems that server.py
+used to load at import time (Gemini SDK, matplotlib, requests, paho), which is
+what every start, test run and worker fork paid before they became lazy.
+"""
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+EAGER_IMPORTS = ("google.generativeai", "matplotlib.figure", "matplotlib.backends.backend_agg",
+                 "requests", "paho.mqtt.client")
+
+SNIPPET = '''
+import sys, time, warnings
+warnings.filterwarnings("ignore")
+sys.path.insert(0, {backend!r})
+t0 = time.perf_counter()
+{eager}
+import server
+t1 = time.perf_counter()
+server.create_app(start=False)
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t1)
+'''
+
+
+def run_once(workdir, eager):
+    code = SNIPPET.format(backend=BACKEND_DIR,
+                          eager="\n".join(f"import {m}" for m in EAGER_IMPORTS) if eager else "")
+    out = subprocess.run([sys.executable, "-c", code], cwd=workdir, capture_output=True, text=True, check=True)
+    import_s, factory_s = (float(x) for x in out.stdout.split()[-2:])
+    return import_s, factory_s
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    # Run in a scratch directory so nothing touches the real database
+    workdir = tempfile.mkdtemp(prefix="gridguard-bench-")
+    try:
+        results = {}
+        for label, eager in (("eager", True), ("lazy", False)):
+            samples = [run_once(workdir, eager) for _ in range(runs)]
+            results[label] = statistics.median(s[0] for s in samples)
+            print(f"{label:>5}: import {results[label] * 1000:7.1f} ms | "
+                  f"create_app {statistics.median(s[1] for s in samples) * 1000:5.1f} ms  (median of {runs})")
+        saved = results["eager"] - results["lazy"]
+        print(f"saved: {saved * 1000:.1f} ms per start ({saved / results['eager'] * 100:.0f}%)")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import io
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from ai_cache import context_key
+
+# --- CHART CONFIGURATION ---
+CHART_CACHE_SIZE = 32   # Rendered PNGs kept (least recently used evicted first)
+CHART_TIMEOUT = 30.0    # Seconds a caller waits for the render worker
+CHART_DPI = 100
+
+
+def render_usage_chart(data_dict, title="Energy Consumption History"):
+    """Dark-themed bar chart of {date: kwh} as PNG bytes.
+
+    Object-oriented Figure API only: no pyplot, so no global figure manager or
+    rcParams are touched and renders can't interfere with each other.
+    """
+    # matplotlib (~0.5s to import) loads with the first chart, on the render worker
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    dates = list(data_dict.keys())
+    values = list(data_dict.values())
+
+    fig = Figure(figsize=(10, 5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    # Plot Bars
+    bars = ax.bar(dates, values, color='#4facfe', edgecolor='#00f2fe')
+
+    # Styling (the old pyplot 'dark_background' look, set per figure)
+    ax.set_facecolor('black')
+    ax.set_title(title, fontsize=16, color='white', pad=20)
+    ax.set_ylabel('Energy (kWh)', fontsize=12, color='#94a3b8')
+    ax.tick_params(axis='x', rotation=45, colors='#94a3b8')
+    ax.tick_params(axis='y', colors='#94a3b8')
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.spines['bottom'].set_color('#334155')
+    ax.spines['left'].set_color('#334155')
+
+    # Add Value Labels
+    for bar in bars:
+        height = bar.get_height()
+        ax.text(bar.get_x() + bar.get_width() / 2., height,
+                f'{height:.2f}',
+                ha='center', va='bottom', color='white', fontsize=10)
+
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=CHART_DPI, transparent=True)
+    return buf.getvalue()
+
+
+class ChartRenderer:
+    """One render worker plus an LRU cache of PNGs keyed by the chart's data.
+
+    Identical requests share the cached PNG, or the in-flight render if it
+    isn't finished yet, so repeated reports for the same range render once.
+    """
+
+    def __init__(self, max_entries=CHART_CACHE_SIZE, render=render_usage_chart):
+        self.max_entries = max_entries
+        self._render = render
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chart")
+        self._cache = OrderedDict()  # key -> PNG bytes
+        self._pending = {}           # key -> Future of a render in progress
+        self._lock = threading.Lock()
+        self.stats = {"renders": 0, "hits": 0, "coalesced": 0, "errors": 0, "entries": 0, "last_render_ms": 0.0}
+
+    @staticmethod
+    def key(data_dict, title):
+        return context_key("usage_chart", title, {day: round(kwh, 6) for day, kwh in data_dict.items()})
+
+    def submit(self, data_dict, title="Energy Consumption History"):
+        """Future of the PNG bytes (already resolved on a cache hit)."""
+        key = self.key(data_dict, title)
+        with self._lock:
+            png = self._cache.get(key)
+            if png is None:
+                future = self._pending.get(key)
+                if future is not None:
+                    self.stats["coalesced"] += 1
+                else:
+                    future = self._pending[key] = self._executor.submit(self._run, key, dict(data_dict), title)
+                return future
+            self._cache.move_to_end(key)
+            self.stats["hits"] += 1
+        future = Future()
+        future.set_result(png)
+        return future
+
+    def png(self, data_dict, title="Energy Consumption History", timeout=CHART_TIMEOUT):
+        return self.submit(data_dict, title).result(timeout)
+
+    def _run(self, key, data_dict, title):
+        start = time.perf_counter()
+        try:
+            png = self._render(data_dict, title)
+        except Exception:
+            with self._lock:
+                self._pending.pop(key, None)
+            self.stats["errors"] += 1
+            raise
+        self.stats["renders"] += 1
+        self.stats["last_render_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        with self._lock:
+            self._pending.pop(key, None)
+            self._cache[key] = png
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+            self.stats["entries"] = len(self._cache)
+        return png
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.stats["entries"] = 0
+
+    def stop(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
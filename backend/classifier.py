@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from features import N_FEATURES, WindowBuffer
+
+# --- CLASSIFIER CONFIGURATION ---
+# The model ml/train_model.py exports (the firmware runs the same one): raw
+# (voltage, current, power) in, softmax over the classes out. A windowed model
+# (--windowed in ml/) takes the features.py window statistics instead and is
+# preferred when installed; the two are told apart by their input width.
+_BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+_WINDOWED_MODEL = os.path.join(_BACKEND_DIR, "model_windowed.tflite")  # train_pipeline.py --windowed --install
+CLASSIFIER_MODEL = os.getenv("GRIDGUARD_MODEL", _WINDOWED_MODEL if os.path.exists(_WINDOWED_MODEL)
+                             else os.path.join(_BACKEND_DIR, "model.tflite"))
+CLASSIFIER_BATCH = 256  # Interpreter input rows; bigger writer batches run in chunks, smaller ones are padded
+CLASS_NAMES = ("FAULT", "IDLE", "LEVEL_1", "LEVEL_2")  # LabelEncoder order, as in firmware/src/class_map.h
+RAW_INPUTS = 3          # voltage, current, power
+
+
+def _interpreter_class():
+    """The first TFLite Interpreter installed: LiteRT, tflite_runtime, then TensorFlow's."""
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter, "ai_edge_litert"
+    except ImportError:
+        pass
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter, "tflite_runtime"
+    except ImportError:
+        pass
+    try:
+        import tensorflow as tf
+        return tf.lite.Interpreter, "tensorflow"
+    except ImportError:
+        return None, None
+
+
+class LoadClassifier:
+    """Server-side load classification with the TFLite CPU interpreter.
+
+    The ingest writer calls classify_samples() once per write batch, so a flush of
+    hundreds of samples costs one interpreter invoke (per CLASSIFIER_BATCH
+    rows), not one per sample. The input is resized once to a fixed batch and
+    short batches are zero-padded, so tensors are never reallocated. The model
+    is loaded on first use, on the calling thread; the interpreter is not
+    thread-safe and only the writer thread uses it.
+    """
+
+    def __init__(self, model_path=CLASSIFIER_MODEL, batch=CLASSIFIER_BATCH, classes=CLASS_NAMES):
+        self.model_path = model_path
+        self.batch = batch
+        self.classes = classes
+        self.stats = {
+            "enabled": None,  # None until the first batch tries to load the model
+            "backend": None,
+            "windowed": None,
+            "reason": None,
+            "samples": 0,
+            "batches": 0,
+            "invokes": 0,
+            "errors": 0,
+            "last_batch_size": 0,
+            "last_batch_ms": 0.0,
+            "max_batch_ms": 0.0,
+            "total_ms": 0.0,
+            "feature_ms": 0.0,  # Window features (windowed model), on top of total_ms
+        }
+        self._interpreter = None
+        self._input = None
+        self._output = None
+        self._buffer = None
+        self._windows = None  # WindowBuffer when the model is windowed
+        self._lock = threading.Lock()
+
+    def _load(self):
+        self.stats["enabled"] = False
+        Interpreter, backend = _interpreter_class()
+        if Interpreter is None:
+            self.stats["reason"] = "no TFLite interpreter (pip install ai-edge-litert)"
+        elif not os.path.exists(self.model_path):
+            self.stats["reason"] = f"model not found: {self.model_path}"
+        if self.stats["reason"]:
+            print(f"Classifier disabled: {self.stats['reason']}")
+            return
+        try:
+            interpreter = Interpreter(model_path=self.model_path, num_threads=1)
+            inp = interpreter.get_input_details()[0]
+            interpreter.resize_tensor_input(inp["index"], [self.batch, inp["shape"][-1]])
+            interpreter.allocate_tensors()
+            out = interpreter.get_output_details()[0]
+        except Exception as e:
+            self.stats["reason"] = f"model load failed: {e}"
+            print(f"Classifier disabled: {self.stats['reason']}")
+            return
+        if out["shape"][-1] != len(self.classes):
+            self.stats["reason"] = f"model has {out['shape'][-1]} outputs, expected {len(self.classes)} classes"
+        elif inp["shape"][-1] not in (RAW_INPUTS, N_FEATURES):
+            self.stats["reason"] = f"model has {inp['shape'][-1]} inputs, expected {RAW_INPUTS} or {N_FEATURES}"
+        if self.stats["reason"]:
+            print(f"Classifier disabled: {self.stats['reason']}")
+            return
+        self._interpreter = interpreter
+        self._input = inp["index"]
+        self._output = out["index"]
+        self._buffer = np.zeros((self.batch, inp["shape"][-1]), dtype=np.float32)
+        windowed = bool(inp["shape"][-1] == N_FEATURES)
+        self._windows = WindowBuffer() if windowed else None
+        self.stats.update(enabled=True, backend=backend, windowed=windowed)
+        print(f"Classifier: {os.path.basename(self.model_path)} on {backend}, batch {self.batch}"
+              f"{', windowed' if windowed else ''}")
+
+    def classify_samples(self, samples):
+        """(device_id, voltage, current, power) rows, oldest first -> class names, or None.
+
+        With a windowed model each device's samples are turned into window
+        features first (continuing from the device's previous batch); a raw
+        model gets the readings as they are.
+        """
+        with self._lock:
+            if self.stats["enabled"] is None:
+                self._load()
+            if not self.stats["enabled"] or not samples:
+                return None
+            if self._windows is None:
+                return self._classify([s[1:] for s in samples])
+            start = time.perf_counter()
+            try:
+                features = self._windows.features([s[0] for s in samples], [s[1:] for s in samples])
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Classifier features failed ({len(samples)} samples): {e}")
+                return None
+            self.stats["feature_ms"] += (time.perf_counter() - start) * 1000.0
+            return self._classify(features)
+
+    def classify(self, features):
+        """Model input rows (raw readings or window features) -> predicted class names, or None."""
+        with self._lock:
+            if self.stats["enabled"] is None:
+                self._load()
+            if not self.stats["enabled"] or len(features) == 0:
+                return None
+            return self._classify(features)
+
+    def _classify(self, features):
+        start = time.perf_counter()
+        try:
+            x = np.asarray(features, dtype=np.float32)
+            labels = np.empty(len(x), dtype=np.intp)
+            for i in range(0, len(x), self.batch):
+                chunk = x[i:i + self.batch]
+                self._buffer[:len(chunk)] = chunk
+                self._buffer[len(chunk):] = 0.0
+                self._interpreter.set_tensor(self._input, self._buffer)
+                self._interpreter.invoke()
+                labels[i:i + len(chunk)] = self._interpreter.get_tensor(self._output)[:len(chunk)].argmax(axis=1)
+                self.stats["invokes"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Classifier batch failed ({len(features)} samples): {e}")
+            return None
+        elapsed = (time.perf_counter() - start) * 1000.0
+        self.stats["samples"] += len(x)
+        self.stats["batches"] += 1
+        self.stats["last_batch_size"] = len(x)
+        self.stats["last_batch_ms"] = round(elapsed, 3)
+        self.stats["max_batch_ms"] = round(max(self.stats["max_batch_ms"], elapsed), 3)
+        self.stats["total_ms"] += elapsed
+        return [self.classes[k] for k in labels]
+
+    def metrics(self):
+        """stats plus derived throughput / latency for /api/debug/classifier."""
+        s = dict(self.stats)
+        s["total_ms"] = round(s["total_ms"], 3)
+        s["feature_ms"] = round(s["feature_ms"], 3)
+        if s["samples"]:
+            s["samples_per_s"] = round(s["samples"] / (s["total_ms"] / 1000.0), 1) if s["total_ms"] else None
+            s["us_per_sample"] = round(s["total_ms"] * 1000.0 / s["samples"], 3)
+            s["avg_batch_ms"] = round(s["total_ms"] / s["batches"], 3)
+            s["feature_us_per_sample"] = round(s["feature_ms"] * 1000.0 / s["samples"], 3)
+        return s
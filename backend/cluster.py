@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+
+from db import connect
+
+# --- CLUSTER CONFIGURATION ---
+# Under a multi-worker server every worker runs create_app(). Exactly one (the
+# leader, elected with a file lock) subscribes to MQTT and writes telemetry;
+# the others follow the database and keep their in-memory state in sync.
+CLUSTER_ROLE = os.getenv("GRIDGUARD_ROLE", "auto")  # "auto" = elect; "web" = never ingest
+REPLICA_POLL_INTERVAL = 0.5  # Seconds between follower polls (the writer flushes every 1s)
+REPLICA_BATCH = 5000         # Max rows applied per table per poll
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, single-process dev server only
+    fcntl = None
+
+
+class LeaderLock:
+    """Non-blocking exclusive lock on a file, held until the process exits.
+
+    The OS drops it when the holder dies, so a crashed leader never blocks the
+    next election.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.held = False
+        self._fd = None
+
+    def acquire(self):
+        if self.held:
+            return True
+        if fcntl is None:
+            self.held = True
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        self.held = True
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self.held = False
+
+
+class Replica:
+    """Follower side: tails new measurements and logs (by rowid) from the DB.
+
+    Each poll hands new rows to on_measurement(row) / on_log(row) in insertion
+    order, which is the order the leader processed them. With a lock, every
+    poll also tries to take over leadership; on success on_promote() runs after
+    a final catch-up poll and the replica stops.
+    """
+
+    def __init__(self, db_file, on_measurement, on_log, lock=None, on_promote=None,
+                 interval=REPLICA_POLL_INTERVAL, batch=REPLICA_BATCH):
+        self.db_file = db_file
+        self.on_measurement = on_measurement
+        self.on_log = on_log
+        self.lock = lock
+        self.on_promote = on_promote
+        self.interval = interval
+        self.batch = batch
+        self.last_measurement_id = 0
+        self.last_log_id = 0
+        self.stats = {"polls": 0, "measurements": 0, "logs": 0, "errors": 0, "lag": None, "promoted": False}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def seek(self, conn):
+        """Starts after the newest rows visible to conn (call inside the snapshot used to warm state)."""
+        self.last_measurement_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM measurements").fetchone()[0]
+        self.last_log_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM logs").fetchone()[0]
+
+    def poll(self, conn):
+        """Applies everything committed since the last poll; returns rows applied."""
+        applied = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id, device_id, timestamp, voltage, current, power, status FROM measurements "
+                "WHERE id > ? ORDER BY id LIMIT ?", (self.last_measurement_id, self.batch)).fetchall()
+            for row_id, device_id, ts, voltage, current, power, status in rows:
+                self.on_measurement({"device_id": device_id, "timestamp": ts, "voltage": voltage,
+                                     "current": current, "power": power, "status": status})
+                self.last_measurement_id = row_id
+                self.stats["lag"] = round(time.time() - ts, 3)
+            applied += len(rows)
+            self.stats["measurements"] += len(rows)
+            if len(rows) < self.batch:
+                break
+        rows = conn.execute("SELECT id, timestamp, level, message, device_id FROM logs WHERE id > ? "
+                            "ORDER BY id LIMIT ?", (self.last_log_id, self.batch)).fetchall()
+        for row_id, ts, level, message, device_id in rows:
+            self.on_log({"timestamp": ts, "level": level, "message": message, "device_id": device_id})
+            self.last_log_id = row_id
+        applied += len(rows)
+        self.stats["logs"] += len(rows)
+        self.stats["polls"] += 1
+        return applied
+
+    def _run(self):
+        conn = connect(self.db_file)
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    self.poll(conn)
+                    if self.lock is not None and self.lock.acquire():
+                        # Old leader is gone: take whatever it committed last, then lead
+                        self.poll(conn)
+                        self.stats["promoted"] = True
+                        break
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    print(f"Replica poll failed: {e}")
+        finally:
+            conn.close()
+        if self.stats["promoted"] and self.on_promote:
+            self.on_promote()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="replica")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
@@ -0,0 +1,163 @@
+import json
+import struct
+
+# --- TELEMETRY FRAME FORMAT ---
+# Devices may publish either a JSON object or a compact binary frame on the
+# same topic; the first byte tells them apart (a JSON text starts with "{" or
+# whitespace, a frame with FRAME_MAGIC).
+#
+# Frame v1, little-endian, 24-byte header:
+#   0  u8   magic (0xA5)
+#   1  u8   version (1)
+#   2  u8   status code (index into STATUS_CODES; 0xFF = text follows the device id)
+#   3  u8   device id length (0 = take it from the topic)
+#   4  f64  timestamp, unix seconds (0 = none: arrival time is used)
+#   12 f32  voltage (V RMS)
+#   16 f32  current (A RMS)
+#   20 f32  power (W)
+#   24 ...  device id (UTF-8), then for status 0xFF: u8 length + status text
+#
+# Frame v2 carries a batch of samples (e.g. 10 Hz sampling, published once a
+# second), little-endian, 16-byte header:
+#   0  u8   magic (0xA5)
+#   1  u8   version (2)
+#   2  u8   device id length (0 = take it from the topic)
+#   3  u8   status text count (sample codes >= 0x80 index these texts)
+#   4  u16  sample count
+#   6  u16  reserved (0)
+#   8  f64  base timestamp, unix seconds (0 = no clock: the batch ends at arrival time)
+#   16 ...  device id, then each status text as u8 length + text
+#   then 17 bytes per sample, oldest first:
+#       u32 offset from the base timestamp (ms), u8 status code,
+#       i32 voltage (mV), i32 current (0.1 mA), i32 power (mW)
+# Fixed-point instead of f32: exact decimals with no rounding pass, which is
+# most of the per-sample decode cost at 10+ samples per message.
+FRAME_MAGIC = 0xA5
+FRAME_VERSION = 1
+BATCH_VERSION = 2
+STATUS_TEXT = 0xFF
+STATUS_TABLE = 0x80
+MAX_BATCH_SAMPLES = 0xFFFF
+
+# Append only: codes are baked into deployed firmware
+STATUS_CODES = ("OK", "IDLE", "OFFLINE", "UNKNOWN", "FAULT", "FAULT: OC", "AI FAULT",
+                "AI INIT", "LEVEL_1", "LEVEL_2")
+_STATUS_INDEX = {status: code for code, status in enumerate(STATUS_CODES)}
+
+_HEADER = struct.Struct("<BBBBdfff")
+HEADER_SIZE = _HEADER.size
+_BATCH_HEADER = struct.Struct("<BBBBHxxd")
+_SAMPLE = struct.Struct("<IBiii")
+
+
+def is_frame(payload):
+    return len(payload) > 0 and payload[0] == FRAME_MAGIC
+
+
+def encode_frame(voltage, current, power, status, timestamp=None, device_id=None):
+    """Packs one reading as a v1 frame (the firmware/demo side of decode_frame)."""
+    device = device_id.encode() if device_id else b""
+    code = _STATUS_INDEX.get(status, STATUS_TEXT)
+    frame = _HEADER.pack(FRAME_MAGIC, FRAME_VERSION, code, len(device), timestamp or 0.0,
+                         voltage, current, power) + device
+    if code == STATUS_TEXT:
+        text = status.encode()[:255]
+        frame += bytes((len(text),)) + text
+    return frame
+
+
+def encode_batch(samples, device_id=None, timestamp=None):
+    """Packs (timestamp, voltage, current, power, status) tuples, oldest first, as a v2 frame.
+
+    Without a timestamp the first sample's is the base; sample timestamps may be
+    relative (e.g. uptime seconds) when the device has no clock.
+    """
+    if not samples or len(samples) > MAX_BATCH_SAMPLES:
+        raise ValueError(f"Batch must hold 1..{MAX_BATCH_SAMPLES} samples")
+    base = samples[0][0] if timestamp is None else timestamp
+    device = device_id.encode() if device_id else b""
+    texts = []
+    body = []
+    for ts, voltage, current, power, status in samples:
+        code = _STATUS_INDEX.get(status)
+        if code is None:
+            if status not in texts:
+                if len(texts) == STATUS_TEXT - STATUS_TABLE:
+                    raise ValueError("Too many distinct status texts in one batch")
+                texts.append(status)
+            code = STATUS_TABLE + texts.index(status)
+        body.append(_SAMPLE.pack(round((ts - base) * 1000), code, round(voltage * 1000),
+                                 round(current * 10000), round(power * 1000)))
+    table = b"".join(bytes((len(t),)) + t for t in (s.encode()[:255] for s in texts))
+    return (_BATCH_HEADER.pack(FRAME_MAGIC, BATCH_VERSION, len(device), len(texts), len(samples), base or 0.0)
+            + device + table + b"".join(body))
+
+
+def decode_batch(frame):
+    """v2 frame -> {"device_id"?, "samples": [reading dicts with "timestamp"]}. Raises ValueError if malformed.
+
+    Sample timestamps are base + offset; with no base they are relative seconds
+    and the server anchors the batch at arrival time.
+    """
+    if len(frame) < _BATCH_HEADER.size:
+        raise ValueError(f"Batch frame too short ({len(frame)} bytes)")
+    _, _, id_len, text_count, count, base = _BATCH_HEADER.unpack_from(frame)
+    pos = _BATCH_HEADER.size + id_len
+    if len(frame) < pos:
+        raise ValueError("Batch frame truncated in device id")
+    statuses = dict(enumerate(STATUS_CODES))
+    for i in range(text_count):
+        if len(frame) <= pos:
+            raise ValueError("Batch frame truncated in status texts")
+        end = pos + 1 + frame[pos]
+        statuses[STATUS_TABLE + i] = frame[pos + 1:end].decode()
+        pos = end
+    if len(frame) != pos + count * _SAMPLE.size:
+        raise ValueError(f"Batch frame holds {len(frame) - pos} sample bytes, expected {count * _SAMPLE.size}")
+    try:
+        samples = [{"timestamp": base + offset / 1000.0, "voltage": voltage / 1000.0, "current": current / 10000.0,
+                    "power": power / 1000.0, "status": statuses[code]}
+                   for offset, code, voltage, current, power in _SAMPLE.iter_unpack(frame[pos:])]
+    except KeyError as e:
+        raise ValueError(f"Unknown status code {e.args[0]}")
+    payload = {"samples": samples}
+    if id_len:
+        payload["device_id"] = frame[_BATCH_HEADER.size:_BATCH_HEADER.size + id_len].decode()
+    return payload
+
+
+def decode_frame(frame):
+    """Frame -> the same dict shape a JSON payload parses to. Raises ValueError if malformed."""
+    if len(frame) >= 2 and frame[1] == BATCH_VERSION:
+        return decode_batch(frame)
+    if len(frame) < HEADER_SIZE:
+        raise ValueError(f"Frame too short ({len(frame)} bytes)")
+    magic, version, code, id_len, ts, voltage, current, power = _HEADER.unpack_from(frame)
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version {version}")
+    end = HEADER_SIZE + id_len
+    if len(frame) < end:
+        raise ValueError("Frame truncated in device id")
+    if code == STATUS_TEXT:
+        if len(frame) <= end:
+            raise ValueError("Frame truncated before status text")
+        status = frame[end + 1:end + 1 + frame[end]].decode()
+    elif code < len(STATUS_CODES):
+        status = STATUS_CODES[code]
+    else:
+        raise ValueError(f"Unknown status code {code}")
+    # float32 carries ~7 significant digits: round away the binary noise
+    payload = {"voltage": round(voltage, 3), "current": round(current, 4), "power": round(power, 3),
+               "status": status}
+    if id_len:
+        payload["device_id"] = frame[HEADER_SIZE:end].decode()
+    if ts:
+        payload["timestamp"] = ts
+    return payload
+
+
+def decode_payload(payload):
+    """Decodes an MQTT payload in either format; returns (dict, format name)."""
+    if is_frame(payload):
+        return decode_frame(payload), "binary"
+    return json.loads(payload), "json"
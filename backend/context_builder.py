@@ -0,0 +1,228 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+# --- PROMPT CONTEXT CONFIGURATION ---
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))  # For the data sections of a prompt
+CHARS_PER_TOKEN = 4             # Rough estimate for English + numbers
+CONTEXT_WARM_DAYS = 7           # Log history loaded at startup, and the window prompts summarize
+CONTEXT_MAX_GROUPS = 100        # Distinct log templates kept per device
+CONTEXT_GROUP_TIMES = 100       # Recent timestamps kept per template (exact windowed counts)...
+CONTEXT_BUCKET = 3600           # ...beyond those, counts per hour for CONTEXT_WARM_DAYS
+
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def log_template(message):
+    """Message with numbers masked, so "Fault at 81.2W" and "Fault at 80.9W" group together."""
+    return _NUMBER.sub("#", message)
+
+
+def _clock(ts):
+    return datetime.fromtimestamp(ts).strftime("%m-%d %H:%M:%S")
+
+
+class LogGroup:
+    """All occurrences of one (level, template) for one device.
+
+    Windowed counts are exact while the window fits in the last
+    CONTEXT_GROUP_TIMES occurrences, else summed from hourly buckets (the
+    oldest hour is counted whole).
+    """
+    __slots__ = ("level", "count", "first_ts", "last_ts", "last_message", "recent", "hours")
+
+    def __init__(self, level, ts, message):
+        self.level = level
+        self.count = 0
+        self.first_ts = ts
+        self.last_ts = ts
+        self.last_message = message
+        self.recent = deque(maxlen=CONTEXT_GROUP_TIMES)
+        self.hours = deque()  # [hour start, count], oldest first, CONTEXT_WARM_DAYS deep
+
+    def add(self, ts, message):
+        self.count += 1
+        if ts >= self.last_ts:
+            self.last_ts = ts
+            self.last_message = message
+        self.first_ts = min(self.first_ts, ts)
+        self.recent.append(ts)
+        hour = ts - ts % CONTEXT_BUCKET
+        if self.hours and self.hours[-1][0] == hour:
+            self.hours[-1][1] += 1
+        elif not self.hours or self.hours[-1][0] < hour:
+            self.hours.append([hour, 1])
+            while self.hours[0][0] < hour - CONTEXT_WARM_DAYS * 86400:
+                self.hours.popleft()
+        else:  # Out of order (rare): find or insert its hour
+            for i, bucket in enumerate(self.hours):
+                if bucket[0] >= hour:
+                    if bucket[0] == hour:
+                        bucket[1] += 1
+                    else:
+                        self.hours.insert(i, [hour, 1])
+                    break
+
+    def window(self, since):
+        """(occurrences at or after since, first of them); since None: all time."""
+        if since is None:
+            return self.count, self.first_ts
+        if len(self.recent) < CONTEXT_GROUP_TIMES or self.recent[0] < since:
+            times = [ts for ts in self.recent if ts >= since]
+            return len(times), min(times, default=None)
+        start = since - since % CONTEXT_BUCKET
+        buckets = [b for b in self.hours if b[0] >= start]
+        return sum(n for _, n in buckets), max(buckets[0][0], since, self.first_ts) if buckets else None
+
+    def count_since(self, since):
+        return self.window(since)[0]
+
+
+class ContextBuilder:
+    """Deduplicated, incrementally maintained log summary for AI prompts.
+
+    log_event() feeds every log row in; prompts read compact one-line-per-
+    template summaries instead of dumping raw rows, so their size depends on
+    how many *distinct* things happened, not how often.
+    """
+
+    def __init__(self, max_groups=CONTEXT_MAX_GROUPS):
+        self.max_groups = max_groups
+        self._groups = {}    # device_id (None = system) -> OrderedDict[(level, template)] -> LogGroup
+        self._versions = {}  # (device_id, level) -> logs seen
+        self._lock = threading.Lock()
+        self.stats = {"logs": 0, "groups": 0, "evicted": 0}
+
+    def add_log(self, row):
+        device_id = row.get("device_id")
+        level = row["level"]
+        key = (level, log_template(row["message"]))
+        with self._lock:
+            groups = self._groups.get(device_id)
+            if groups is None:
+                groups = self._groups[device_id] = OrderedDict()
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = LogGroup(level, row["timestamp"], row["message"])
+                self.stats["groups"] += 1
+                if len(groups) > self.max_groups:
+                    groups.popitem(last=False)  # Least recently seen template
+                    self.stats["groups"] -= 1
+                    self.stats["evicted"] += 1
+            else:
+                groups.move_to_end(key)
+            group.add(row["timestamp"], row["message"])
+            vkey = (device_id, level)
+            self._versions[vkey] = self._versions.get(vkey, 0) + 1
+            self.stats["logs"] += 1
+
+    def _scoped(self, device_id):
+        # A device's context includes system-wide events; no device means everything
+        if device_id is None:
+            return list(self._groups.items())
+        return [(d, g) for d, g in self._groups.items() if d is None or d == device_id]
+
+    def version(self, device_id=None, levels=None):
+        """Changes whenever a matching log arrives (for cache keys)."""
+        with self._lock:
+            return sum(n for (d, level), n in self._versions.items()
+                       if (device_id is None or d is None or d == device_id)
+                       and (levels is None or level in levels))
+
+    def groups(self, device_id=None, levels=None, since=None):
+        """(device_id, LogGroup, count) tuples, most recent first."""
+        with self._lock:
+            found = []
+            for d, groups in self._scoped(device_id):
+                for group in groups.values():
+                    if levels is not None and group.level not in levels:
+                        continue
+                    if since is not None and group.last_ts < since:
+                        continue
+                    n = group.count_since(since)
+                    if n:
+                        found.append((d, group, n))
+        found.sort(key=lambda item: item[1].last_ts, reverse=True)
+        return found
+
+    def count(self, device_id=None, levels=None, since=None):
+        return sum(n for _, _, n in self.groups(device_id, levels, since))
+
+    def log_lines(self, device_id=None, levels=None, since=None):
+        """One line per distinct message: last time, level, repeat count, device, latest text."""
+        lines = []
+        for d, group, n in self.groups(device_id, levels, since):
+            repeat = ""
+            if n > 1:
+                repeat = f" x{n} (first {_clock(group.window(since)[1])})"
+            source = f" [{d}]" if d and device_id is None else ""
+            lines.append(f"{_clock(group.last_ts)} {group.level}{source}{repeat}: {group.last_message}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._groups = {}
+            self._versions = {}
+            self.stats.update(logs=0, groups=0)
+
+    def warm(self, conn, days=CONTEXT_WARM_DAYS):
+        """Replays the last `days` of logs from the DB."""
+        rows = conn.execute("SELECT timestamp, level, message, device_id FROM logs WHERE timestamp >= ? "
+                            "ORDER BY timestamp", (time.time() - days * 86400,)).fetchall()
+        for ts, level, message, device_id in rows:
+            self.add_log({"timestamp": ts, "level": level, "message": message, "device_id": device_id})
+        return len(rows)
+
+
+# --- FORMATTING / BUDGET ---
+def readings_lines(rows):
+    """Measurement rows as a compact table (one header, one line per row)."""
+    if not rows:
+        return ["No readings."]
+    lines = ["time | V | A | W | status"]
+    for r in rows:
+        lines.append(f"{_clock(r['timestamp'])} | {r['voltage']:.1f} | {r['current']:.3f} | "
+                     f"{r['power']:.1f} | {r['status']}")
+    return lines
+
+
+def daily_lines(daily_usage, newest_first=False):
+    """{date: kwh} as "date: x kWh" lines."""
+    if not daily_usage:
+        return ["No daily data."]
+    days = sorted(daily_usage, reverse=newest_first)
+    return [f"{day}: {daily_usage[day]:.3f} kWh" for day in days]
+
+
+def fit_to_budget(sections, budget=PROMPT_TOKEN_BUDGET, sep="\n"):
+    """Trims sections until their combined size fits the token budget.
+
+    sections: {name: (lines, priority)} with lines most-important first. The
+    lowest-priority section loses lines from its end first. Returns {name: text}
+    with lines joined by sep.
+    """
+    kept = {name: list(lines) for name, (lines, _) in sections.items()}
+    omitted = {name: 0 for name in sections}
+    total = sum(estimate_tokens(line) for lines in kept.values() for line in lines)
+
+    for name in sorted(sections, key=lambda n: sections[n][1]):
+        lines = kept[name]
+        while lines and total > budget:
+            total -= estimate_tokens(lines.pop())
+            omitted[name] += 1
+        if total <= budget:
+            break
+
+    out = {}
+    for name, lines in kept.items():
+        if omitted[name]:
+            lines.append(f"...({omitted[name]} more lines omitted)")
+        out[name] = sep.join(lines) if lines else "(none)"
+    return out
@@ -0,0 +1,221 @@
+import os
+import sqlite3
+
+# --- CONNECTION TUNING ---
+# journal_mode=WAL is persistent (stored in the DB file) and is set once in init_db.
+# The rest are per-connection and applied by connect().
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_SIZE_KB = 8192     # Page cache per connection
+DB_MMAP_SIZE = 64 * 1024 * 1024
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def connect(db_file, row_factory=None):
+    """Opens a connection with the standard pragmas applied."""
+    conn = sqlite3.connect(db_file, timeout=DB_BUSY_TIMEOUT_MS / 1000.0)
+    if row_factory is not None:
+        conn.row_factory = row_factory
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    # NORMAL is durable across application crashes in WAL mode; only an OS
+    # crash / power cut can lose the last few commits.
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    return conn
+
+
+# --- SCHEMA MIGRATIONS ---
+# Each entry upgrades the schema by one version. The current version lives in
+# PRAGMA user_version, so init_db only runs the steps a given DB file is missing.
+# Never edit a released step: append a new one instead.
+
+def _migrate_base_tables(c):
+    # Measurements Table: High frequency data
+    c.execute('''CREATE TABLE IF NOT EXISTS measurements (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp REAL,
+                    voltage REAL,
+                    current REAL,
+                    power REAL,
+                    status TEXT
+                )''')
+    # Daily Summary Table: Aggregated kWh per day
+    c.execute('''CREATE TABLE IF NOT EXISTS daily_summary (
+                    date TEXT PRIMARY KEY,
+                    kwh REAL
+                )''')
+    # Logs Table: System events
+    c.execute('''CREATE TABLE IF NOT EXISTS logs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp REAL,
+                    level TEXT,
+                    message TEXT
+                )''')
+
+
+def _migrate_timestamp_indexes(c):
+    # Every read path is "ORDER BY timestamp DESC LIMIT n" or "timestamp > ?"
+    c.execute("CREATE INDEX IF NOT EXISTS idx_measurements_timestamp ON measurements (timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_measurements_status_timestamp ON measurements (status, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs (timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_level_timestamp ON logs (level, timestamp)")
+
+
+def _migrate_device_columns(c):
+    # Rows written before multi-device support all came from the single
+    # original board, which identifies itself as esp32_box_1.
+    c.execute("ALTER TABLE measurements ADD COLUMN device_id TEXT NOT NULL DEFAULT 'esp32_box_1'")
+    # NULL device_id marks a system-wide event (MQTT connect, etc.)
+    c.execute("ALTER TABLE logs ADD COLUMN device_id TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_measurements_device_timestamp ON measurements (device_id, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_device_timestamp ON logs (device_id, timestamp)")
+
+    # daily_summary's primary key becomes (device_id, date): rebuild the table.
+    c.execute('''CREATE TABLE daily_summary_v3 (
+                    device_id TEXT NOT NULL DEFAULT 'esp32_box_1',
+                    date TEXT NOT NULL,
+                    kwh REAL,
+                    PRIMARY KEY (device_id, date)
+                )''')
+    c.execute("INSERT INTO daily_summary_v3 (date, kwh) SELECT date, kwh FROM daily_summary")
+    c.execute("DROP TABLE daily_summary")
+    c.execute("ALTER TABLE daily_summary_v3 RENAME TO daily_summary")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_daily_summary_date ON daily_summary (date)")
+
+
+def _migrate_rollup_tables(c):
+    # Per-device aggregates at 1 minute / 1 hour / 1 day. bucket is the bucket
+    # start (unix seconds); means are *_sum / samples. Filled by the ingest
+    # writer and backfilled from raw measurements on first start (rollups.py).
+    for table in ("rollup_1m", "rollup_1h", "rollup_1d"):
+        c.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                        device_id TEXT NOT NULL,
+                        bucket REAL NOT NULL,
+                        samples INTEGER NOT NULL,
+                        v_min REAL, v_max REAL, v_sum REAL,
+                        i_min REAL, i_max REAL, i_sum REAL,
+                        p_min REAL, p_max REAL, p_sum REAL,
+                        energy_kwh REAL NOT NULL DEFAULT 0,
+                        fault_count INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (device_id, bucket)
+                    ) WITHOUT ROWID''')
+        c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_bucket ON {table} (bucket)")
+
+
+def _migrate_energy_checkpoint(c):
+    # Per-device integration state, updated in the same transaction as the raw
+    # rows it covers (energy.py). Lifetime totals start from daily_summary.
+    c.execute('''CREATE TABLE IF NOT EXISTS energy_checkpoint (
+                    device_id TEXT PRIMARY KEY,
+                    last_ts REAL,
+                    last_power REAL,
+                    total_kwh REAL NOT NULL DEFAULT 0
+                )''')
+    c.execute('''INSERT OR IGNORE INTO energy_checkpoint (device_id, total_kwh)
+                 SELECT device_id, SUM(kwh) FROM daily_summary GROUP BY device_id''')
+
+
+def _migrate_jobs(c):
+    # Background jobs every web worker must see, not just the one that
+    # handled the request (jobs.JobStore).
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT,
+                    status TEXT,
+                    progress TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created REAL,
+                    started REAL,
+                    finished REAL,
+                    waiters INTEGER
+                )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs (finished)")
+
+
+def _migrate_predicted_class(c):
+    # Server-side model output per sample (classifier.py), next to the board's
+    # own status. NULL = not classified (no model available, or an older row).
+    c.execute("ALTER TABLE measurements ADD COLUMN predicted_class TEXT")
+
+
+def _migrate_recording_sessions(c):
+    # Labelled time windows from /api/record: the training pipeline
+    # (ml/train_pipeline.py) labels the measurements inside each closed one.
+    c.execute('''CREATE TABLE IF NOT EXISTS recording_sessions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    label TEXT NOT NULL,
+                    device_id TEXT,
+                    started REAL NOT NULL,
+                    ended REAL
+                )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_recording_sessions_started ON recording_sessions (started)")
+
+
+def _migrate_drop_app_state(c):
+    # Settings table of the old cluster.SharedState; recording state, its
+    # only user, moved to recording_sessions
+    c.execute("DROP TABLE IF EXISTS app_state")
+
+
+MIGRATIONS = [
+    _migrate_base_tables,        # v1
+    _migrate_timestamp_indexes,  # v2
+    _migrate_device_columns,     # v3
+    _migrate_rollup_tables,      # v4
+    _migrate_energy_checkpoint,  # v5
+    _migrate_jobs,               # v6
+    _migrate_predicted_class,    # v7
+    _migrate_recording_sessions, # v8
+    _migrate_drop_app_state,     # v9
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def init_db(db_file):
+    print(f"--- DB CONFIGURATION ---")
+    print(f"DB Path: {os.path.abspath(db_file)}")
+    conn = connect(db_file)
+    try:
+        mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        print(f"Journal Mode: {mode}")
+
+        version = get_schema_version(conn)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"DB schema v{version} is newer than this server (v{SCHEMA_VERSION})")
+
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            migration = MIGRATIONS[target - 1]
+            # Step + version bump commit together (DDL is transactional in
+            # SQLite), so a crash mid-migration leaves the DB at the previous
+            # version and the step is simply retried on the next start.
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if get_schema_version(conn) >= target:
+                    conn.rollback()  # Another process got there first
+                    continue
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {target}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            print(f"Schema migrated to v{target} ({migration.__name__})")
+
+        print(f"Schema Version: {get_schema_version(conn)}")
+
+        # Retention frees pages with PRAGMA incremental_vacuum, which needs
+        # auto_vacuum=INCREMENTAL. Existing files only switch over after a full
+        # VACUUM, so this is a one-time rewrite of older databases.
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            conn.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}")
+            conn.execute("VACUUM")
+            print("Auto-vacuum: switched to INCREMENTAL")
+    finally:
+        conn.close()
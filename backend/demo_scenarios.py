@@ -1,7 +1,9 @@
 import time
 import json
 import random
+import threading
 import paho.mqtt.client as mqtt
+from codec import encode_batch, encode_frame
 
 MQTT_BROKER = "broker.hivemq.com"
 MQTT_PORT = 1883
@@ -9,6 +11,9 @@ MQTT_TOPIC = "gridguard/power/telemetry"
 
 client = mqtt.Client()
 connected = False
+payload_format = "json"  # --format binary sends compact frames (codec.py) instead
+batch_hz = 0             # --batch-hz 10 samples at 10 Hz and publishes one multi-sample frame per second
+signal = None            # (voltage, current, status) the scenario last set; read by the sampler
 
 def on_connect(client, userdata, flags, rc):
     global connected
@@ -26,16 +31,53 @@ client.loop_start()
 while not connected:
     time.sleep(0.1)
 
+def publish_batch(samples):
+    if payload_format == "binary":
+        frame = encode_batch(samples)
+    else:
+        frame = json.dumps({"samples": [
+            {"timestamp": ts, "voltage": v, "current": c, "power": p, "status": s}
+            for ts, v, c, p, s in samples]})
+    client.publish(MQTT_TOPIC, frame)
+    print(f"Sent batch ({len(samples)} samples, {len(frame)} B): {samples[-1][1]}V {samples[-1][2]}A {samples[-1][4]}")
+
+def sampler():
+    """Stands in for firmware that samples at batch_hz and publishes once a second."""
+    buffer = []
+    next_publish = time.time() + 1.0
+    while True:
+        if signal is not None:
+            v, c, status = signal
+            v += random.uniform(-0.5, 0.5)  # Sample-to-sample noise
+            buffer.append((round(time.time(), 3), round(v, 1), round(c, 3), round(v * c, 2), status))
+        if time.time() >= next_publish:
+            if buffer:
+                publish_batch(buffer)
+                buffer = []
+            next_publish += 1.0
+        time.sleep(1.0 / batch_hz)
+
 def send_data(voltage, current, status="OK"):
+    global signal
+    if batch_hz:
+        # The sampler thread reads this at batch_hz and publishes the frames
+        signal = (voltage, current, status)
+        return
     power = voltage * current
     payload = {
         "voltage": round(voltage, 1),
         "current": round(current, 3),
         "power": round(power, 2),
-        "status": status
+        "status": status,
+        "timestamp": round(time.time(), 3)  # Device-side sample time (used for energy integration)
     }
-    client.publish(MQTT_TOPIC, json.dumps(payload))
-    print(f"Sent: {payload}")
+    if payload_format == "binary":
+        frame = encode_frame(payload["voltage"], payload["current"], payload["power"], status, payload["timestamp"])
+        client.publish(MQTT_TOPIC, frame)
+        print(f"Sent ({len(frame)} B frame): {payload}")
+    else:
+        client.publish(MQTT_TOPIC, json.dumps(payload))
+        print(f"Sent: {payload}")
 
 def scenario_normal():
     print("\n--- SIMULATING NORMAL OPERATION ---")
@@ -92,7 +134,14 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--scenario", choices=["normal", "overload", "spike"], default="normal")
+    parser.add_argument("--format", choices=["json", "binary"], default="json")
+    parser.add_argument("--batch-hz", type=float, default=0,
+                        help="sample at this rate and publish one multi-sample frame per second")
     args = parser.parse_args()
+    payload_format = args.format
+    batch_hz = args.batch_hz
+    if batch_hz:
+        threading.Thread(target=sampler, daemon=True).start()
 
     if args.scenario == "normal":
         scenario_normal()
@@ -101,5 +150,7 @@ if __name__ == "__main__":
     elif args.scenario == "spike":
         scenario_spike()
 
+    if batch_hz:
+        time.sleep(1.5)  # Let the sampler publish the last frame
     client.loop_stop()
     client.disconnect()
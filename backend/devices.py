@@ -0,0 +1,93 @@
+import threading
+import time
+
+# --- DEVICE CONFIGURATION ---
+# Boards publish to gridguard/<device_id>/telemetry. The original single-meter
+# firmware publishes to gridguard/power/telemetry with "device_id" in the
+# payload, so the payload wins and "power" is treated as the shared legacy topic.
+TOPIC_PREFIX = "gridguard"
+TELEMETRY_TOPIC = f"{TOPIC_PREFIX}/+/telemetry"
+LEGACY_TOPIC_DEVICE = "power"
+DEFAULT_DEVICE_ID = "esp32_box_1"
+DEVICE_OFFLINE_AFTER = 5.0  # Seconds without telemetry before a device shows OFFLINE
+
+
+def resolve_device_id(topic, payload):
+    """Picks the device id from the payload, falling back to the topic segment."""
+    device_id = payload.get("device_id") if isinstance(payload, dict) else None
+    if device_id:
+        return str(device_id)
+    parts = topic.split("/")
+    if len(parts) == 3 and parts[1] and parts[1] != LEGACY_TOPIC_DEVICE:
+        return parts[1]
+    return DEFAULT_DEVICE_ID
+
+
+class DeviceState:
+    """Live state for one board. Slotted: one of these exists per device."""
+    __slots__ = ("device_id", "voltage", "current", "power", "status",
+                 "timestamp", "last_update", "session_kwh", "in_fault")
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.voltage = 0
+        self.current = 0
+        self.power = 0
+        self.status = "OFFLINE"
+        self.timestamp = 0
+        self.last_update = None  # Arrival time of the last message (None until the first one)
+        self.session_kwh = 0.0
+        self.in_fault = False  # Inside a fault episode (cleared when status returns to OK)
+
+    def is_online(self, now=None):
+        if self.last_update is None:
+            return False
+        return ((now or time.time()) - self.last_update) <= DEVICE_OFFLINE_AFTER
+
+    def live(self, now=None):
+        """The "live" dict served to the dashboard; zeroed when the device has gone quiet."""
+        if not self.is_online(now):
+            return {"device_id": self.device_id, "voltage": 0, "current": 0, "power": 0,
+                    "status": "OFFLINE", "timestamp": self.timestamp}
+        return {"device_id": self.device_id, "voltage": self.voltage, "current": self.current,
+                "power": self.power, "status": self.status, "timestamp": self.timestamp}
+
+
+class DeviceRegistry:
+    """Thread-safe map of device_id -> DeviceState."""
+
+    def __init__(self):
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def get(self, device_id):
+        return self._devices.get(device_id)
+
+    def get_or_create(self, device_id):
+        state = self._devices.get(device_id)
+        if state is None:
+            with self._lock:
+                state = self._devices.get(device_id)
+                if state is None:
+                    state = DeviceState(device_id)
+                    self._devices[device_id] = state
+        return state
+
+    def ids(self):
+        return sorted(self._devices)
+
+    def latest(self):
+        """The most recently heard-from device, or None if nothing has reported yet."""
+        states = [s for s in self._devices.values() if s.last_update is not None]
+        if not states:
+            return None
+        return max(states, key=lambda s: s.last_update)
+
+    def resolve(self, device_id=None):
+        """State for an explicit id, else the latest device, else an empty default."""
+        if device_id:
+            return self.get(device_id) or DeviceState(device_id)
+        return self.latest() or self.get(DEFAULT_DEVICE_ID) or DeviceState(DEFAULT_DEVICE_ID)
+
+    def __len__(self):
+        return len(self._devices)
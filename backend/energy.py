@@ -0,0 +1,219 @@
+import threading
+
+# --- ENERGY ACCOUNTING CONFIGURATION ---
+ENERGY_MAX_GAP = 360.0  # Seconds; longer silences are gaps, not integrated across
+MAX_CLOCK_SKEW = 300.0  # Device timestamps further than this from arrival time are ignored
+
+
+class EnergyAccumulator:
+    """Integration state for one device: the last accepted sample and the running total."""
+    __slots__ = ("last_ts", "last_power", "total_kwh")
+
+    def __init__(self, last_ts=None, last_power=0.0, total_kwh=0.0):
+        self.last_ts = last_ts
+        self.last_power = last_power
+        self.total_kwh = total_kwh
+
+
+class EnergyMeter:
+    """Per-device trapezoidal energy integration on device-side timestamps.
+
+    The accumulator is checkpointed by the ingest writer in the same transaction
+    as the raw rows (energy_checkpoint), so after a restart load() resumes
+    exactly where the committed data ends: nothing is lost or counted twice.
+    """
+
+    def __init__(self, max_gap=ENERGY_MAX_GAP):
+        self.max_gap = max_gap
+        self._meters = {}
+        self._lock = threading.Lock()
+        self.stats = {"samples": 0, "gaps": 0, "out_of_order": 0, "duplicates": 0, "clock_rejected": 0}
+
+    def sample_time(self, payload, arrival):
+        """The sample's device timestamp (seconds or ms since epoch), else its arrival time."""
+        ts = payload.get("timestamp") if isinstance(payload, dict) else None
+        if ts is None:
+            return arrival
+        try:
+            ts = float(ts)
+        except (TypeError, ValueError):
+            self.stats["clock_rejected"] += 1
+            return arrival
+        if ts > 1e11:
+            ts /= 1000.0
+        if abs(ts - arrival) > MAX_CLOCK_SKEW:
+            # Unsynced RTC / uptime counter: arrival order is the better clock
+            self.stats["clock_rejected"] += 1
+            return arrival
+        return ts
+
+    def batch_times(self, timestamps, arrival):
+        """Timestamps for one multi-sample frame (same units as sample_time), newest last.
+
+        The spacing between samples is always the device's own; only the anchor
+        can fall back. If the newest sample's clock is unusable (unsynced RTC,
+        uptime counter) the whole batch is shifted to end at arrival time.
+        """
+        try:
+            times = [float(ts) for ts in timestamps]
+        except (TypeError, ValueError):
+            raise ValueError("Every sample in a batch needs a numeric timestamp")
+        newest = max(times)
+        if newest > 1e11:
+            times = [ts / 1000.0 for ts in times]
+            newest /= 1000.0
+        if abs(newest - arrival) > MAX_CLOCK_SKEW:
+            self.stats["clock_rejected"] += 1
+            shift = arrival - newest
+            times = [ts + shift for ts in times]
+        return times
+
+    def integrate(self, device_id, ts, power):
+        """Adds one sample; returns the kWh for the interval it closes (0 for gaps and stragglers)."""
+        with self._lock:
+            acc = self._meters.get(device_id)
+            if acc is None:
+                acc = self._meters[device_id] = EnergyAccumulator()
+            self.stats["samples"] += 1
+
+            if acc.last_ts is None:
+                increment = 0.0
+            else:
+                dt = ts - acc.last_ts
+                if dt < 0:
+                    # Arrived after a newer sample: the interval it belongs to was
+                    # already integrated, so it is stored but not counted.
+                    self.stats["out_of_order"] += 1
+                    return 0.0
+                if dt == 0:
+                    self.stats["duplicates"] += 1
+                    return 0.0
+                if dt >= self.max_gap:
+                    self.stats["gaps"] += 1
+                    increment = 0.0
+                else:
+                    increment = (acc.last_power + power) * 0.5 * dt / 3600.0 / 1000.0
+
+            acc.last_ts = ts
+            acc.last_power = power
+            acc.total_kwh += increment
+            return increment
+
+    def snapshot(self, device_id):
+        """device_id's integration state, for restore() if the samples integrated after it are not stored."""
+        with self._lock:
+            acc = self._meters.get(device_id)
+            return None if acc is None else (acc.last_ts, acc.last_power, acc.total_kwh)
+
+    def restore(self, device_id, snapshot):
+        with self._lock:
+            if snapshot is None:
+                self._meters.pop(device_id, None)
+            else:
+                self._meters[device_id] = EnergyAccumulator(*snapshot)
+
+    def total(self, device_id):
+        acc = self._meters.get(device_id)
+        return acc.total_kwh if acc else 0.0
+
+    def clear(self):
+        with self._lock:
+            self._meters = {}
+
+    def load(self, conn):
+        """Restores accumulators from energy_checkpoint."""
+        rows = conn.execute("SELECT device_id, last_ts, last_power, total_kwh FROM energy_checkpoint").fetchall()
+        with self._lock:
+            for device_id, last_ts, last_power, total_kwh in rows:
+                self._meters[device_id] = EnergyAccumulator(last_ts, last_power or 0.0, total_kwh or 0.0)
+        return len(rows)
+
+
+# --- CHECKPOINT (runs on the ingest writer, inside its batch transaction) ---
+_CHECKPOINT_SQL = (
+    "INSERT INTO energy_checkpoint (device_id, last_ts, last_power, total_kwh) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(device_id) DO UPDATE SET "
+    "total_kwh = total_kwh + excluded.total_kwh, "
+    "last_power = CASE WHEN last_ts IS NULL OR excluded.last_ts > last_ts "
+    "THEN excluded.last_power ELSE last_power END, "
+    "last_ts = MAX(COALESCE(last_ts, excluded.last_ts), excluded.last_ts)")
+
+
+def checkpoint(conn, samples):
+    """Folds (device_id, ts, voltage, current, power, status, kwh) samples into energy_checkpoint."""
+    per_device = {}
+    for device_id, ts, voltage, current, power, status, kwh in samples:
+        cp = per_device.get(device_id)
+        if cp is None:
+            per_device[device_id] = [ts, power, kwh or 0.0]
+        else:
+            if ts > cp[0]:
+                cp[0] = ts
+                cp[1] = power
+            cp[2] += kwh or 0.0
+    conn.executemany(_CHECKPOINT_SQL, [(d, ts, p, kwh) for d, (ts, p, kwh) in per_device.items()])
+
+
+# --- RECOMPUTE FROM RAW ---
+def interval_sql():
+    """SQL for one sample's kWh from dt / prev_power columns and a :max_gap parameter (same rules as integrate())."""
+    return ("CASE WHEN dt > 0 AND dt < :max_gap "
+            "THEN (power + prev_power) * 0.5 * dt / 3600.0 / 1000.0 ELSE 0 END")
+
+
+def recompute(conn, device_id=None, start=None, end=None, max_gap=ENERGY_MAX_GAP):
+    """kWh per device for samples in [start, end), re-integrated from raw measurements.
+
+    Samples are ordered by device time here, so this is the reference value: it
+    only differs from the live total by intervals the meter skipped as out of order.
+    """
+    raw_where = []
+    range_where = []
+    params = {"max_gap": max_gap}
+    if device_id:
+        raw_where.append("device_id = :device")
+        params["device"] = device_id
+    if start is not None:
+        raw_where.append("timestamp >= :start - :max_gap")
+        range_where.append("timestamp >= :start")
+        params["start"] = start
+    if end is not None:
+        raw_where.append("timestamp < :end")
+        range_where.append("timestamp < :end")
+        params["end"] = end
+    rows = conn.execute(f'''
+        SELECT device_id, SUM({interval_sql()}), COUNT(*)
+        FROM (
+            SELECT device_id, timestamp, power,
+                   timestamp - LAG(timestamp) OVER w AS dt,
+                   LAG(power) OVER w AS prev_power
+            FROM measurements{(" WHERE " + " AND ".join(raw_where)) if raw_where else ""}
+            WINDOW w AS (PARTITION BY device_id ORDER BY timestamp)
+        ){(" WHERE " + " AND ".join(range_where)) if range_where else ""}
+        GROUP BY device_id''', params).fetchall()
+    return {d: {"kwh": kwh or 0.0, "samples": n} for d, kwh, n in rows}
+
+
+def compare_with_rollups(conn, device_id=None, start=None, end=None):
+    """recompute() next to the rollup_1m energy for the same range. Pass minute-aligned bounds."""
+    result = {d: {"raw_kwh": v["kwh"], "rollup_kwh": 0.0, "samples": v["samples"]}
+              for d, v in recompute(conn, device_id, start, end).items()}
+    where = []
+    params = []
+    if device_id:
+        where.append("device_id = ?")
+        params.append(device_id)
+    if start is not None:
+        where.append("bucket >= ?")
+        params.append(start)
+    if end is not None:
+        where.append("bucket < ?")
+        params.append(end)
+    rows = conn.execute("SELECT device_id, SUM(energy_kwh) FROM rollup_1m" +
+                        ((" WHERE " + " AND ".join(where)) if where else "") +
+                        " GROUP BY device_id", params).fetchall()
+    for d, kwh in rows:
+        result.setdefault(d, {"raw_kwh": 0.0, "samples": 0})["rollup_kwh"] = kwh or 0.0
+    for v in result.values():
+        v["diff_kwh"] = v["rollup_kwh"] - v["raw_kwh"]
+    return result
@@ -0,0 +1,191 @@
+import threading
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# --- WINDOWED FEATURES ---
+# Shared by the backend classifier and the training scripts (ml/), so a
+# windowed model sees exactly the features it was trained on. Each sample is
+# described by the WINDOW_SIZE samples ending at it, per channel (V, I, P):
+# mean, RMS, slope (least squares, per sample), crest factor (peak / RMS) and
+# variance. Sums come from cumulative sums, so the cost per sample does not
+# grow with the window; only the peak uses a strided window view.
+WINDOW_SIZE = 10   # Samples: 1 s at 10 Hz batch frames, 20 s at the classic 0.5 Hz
+CHANNELS = ("voltage", "current", "power")
+STATS = ("mean", "rms", "slope", "crest", "var")
+FEATURE_NAMES = tuple(f"{c}_{s}" for c in CHANNELS for s in STATS)
+N_FEATURES = len(FEATURE_NAMES)
+
+
+def _window_sums(x, window):
+    """Sliding sums of x over `window` rows (axis 0) via a cumulative sum."""
+    c = np.cumsum(x, axis=0)
+    c = np.concatenate([np.zeros((1,) + x.shape[1:]), c])
+    return c[window:] - c[:-window]
+
+
+def window_features(x, window=WINDOW_SIZE):
+    """(n, 3) samples, oldest first -> (n - window + 1, N_FEATURES): one row per complete window."""
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    if n < window:
+        return np.empty((0, N_FEATURES), dtype=np.float32)
+    # Moments of x - offset: long runs of ~120 V would otherwise lose the
+    # variance to cancellation in the cumulative sums
+    offset = x.mean(axis=0)
+    d = x - offset
+    k = np.arange(n, dtype=np.float64)[:, None]
+    s1 = _window_sums(d, window)
+    s2 = _window_sums(d * d, window)
+    sk = _window_sums(k * d, window)
+    start = k[:n - window + 1]
+
+    mean_d = s1 / window
+    var = np.maximum(s2 / window - mean_d * mean_d, 0.0)
+    mean = mean_d + offset
+    rms = np.sqrt(var + mean * mean)
+    # Least-squares slope against the position inside the window (0..window-1)
+    k_mean = (window - 1) / 2.0
+    k_ss = window * (window * window - 1) / 12.0
+    slope = (sk - start * s1 - k_mean * s1) / k_ss if window > 1 else np.zeros_like(s1)
+    # Reduce across the window axis as the outer loop: each step is one
+    # contiguous (m, 3) slice, ~15x faster than .max(axis=-1) on the view
+    peak = np.maximum.reduce(sliding_window_view(np.abs(x), window, axis=0).transpose(2, 0, 1))
+    crest = np.divide(peak, rms, out=np.zeros_like(rms), where=rms > 0)
+
+    # Column order matches FEATURE_NAMES: channel-major, STATS within a channel
+    out = np.empty((len(mean), len(CHANNELS), len(STATS)), dtype=np.float32)
+    for k, stat in enumerate((mean, rms, slope, crest, var)):
+        out[:, :, k] = stat
+    return out.reshape(len(out), N_FEATURES)
+
+
+def grouped_window_features(x, groups, window=WINDOW_SIZE):
+    """Complete windows that don't cross a group boundary (session / device run).
+
+    Returns (features, index of each window's last sample), e.g. to pick its label.
+    """
+    x = np.asarray(x)
+    groups = np.asarray(groups)
+    feats, ends = [], []
+    bounds = np.flatnonzero(groups[1:] != groups[:-1]) + 1
+    for lo, hi in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(x)]])):
+        f = window_features(x[lo:hi], window)
+        if len(f):
+            feats.append(f)
+            ends.append(np.arange(lo + window - 1, hi))
+    if not feats:
+        return np.empty((0, N_FEATURES), dtype=np.float32), np.empty(0, dtype=np.intp)
+    return np.concatenate(feats), np.concatenate(ends)
+
+
+# --- TRAINING AUGMENTATION ---
+# Used by both ml/train_model.py and ml/train_pipeline.py, so the two
+# training paths synthesize the same data.
+FAULT_LEVEL = ((120.0, 5.0), (0.35, 0.05), (40.0, 5.0))  # (mean, sd) of V, A, W: beyond the firmware trip
+FAULT_NOISE = (1.0, 0.005, 0.5)  # V, A, W sample-to-sample noise of recorded steady loads
+TRANSIENT_RATE = 0.1             # Share of samples given a switching spike in the augmented copy
+TRANSIENT_GAIN = (1.1, 1.5)
+
+
+def add_synthetic_faults(X, labels, groups, n, rng, windowed=False, window=WINDOW_SIZE):
+    """Appends ~n extreme overcurrent samples labelled FAULT, so FAULT is always a class.
+
+    Plain: n independent samples. Windowed, independent draws would make FAULT
+    "the noisy class", so faults come as steady runs of 2 * window samples
+    (window + 1 complete windows each, enough runs for ~n windows): one level
+    per run, with the noise recorded loads show. Each run is a group of its own.
+    """
+    if n <= 0:
+        return X, labels, groups
+    run, n_runs = (2 * window, -(-n // (window + 1))) if windowed else (1, n)
+    levels = np.column_stack([rng.normal(mean, sd, n_runs) for mean, sd in FAULT_LEVEL])
+    if run == 1:
+        faults = levels
+    else:
+        faults = np.repeat(levels, run, axis=0) + rng.normal(0, FAULT_NOISE, (n_runs * run, 3))
+    faults = faults.astype(np.float32)
+    first = groups.max() + 1 if len(groups) else 0
+    fault_groups = first + (np.arange(len(faults)) // run if run > 1 else np.zeros(len(faults), dtype=np.int64))
+    return (np.concatenate([X, faults]), np.concatenate([labels, np.full(len(faults), "FAULT")]),
+            np.concatenate([groups, fault_groups]))
+
+
+def add_transients(X, labels, groups, rng, rate=TRANSIENT_RATE):
+    """A copy of every group with switching spikes on `rate` of its samples.
+
+    Recorded sessions are mostly steady, so without these a windowed model
+    learns that any spread in a window means another class - exactly the
+    transients it is meant to ride out. Labels stay the session's.
+    """
+    spiky = np.array(X, dtype=np.float32)
+    hit = rng.random(len(spiky)) < rate
+    gain = rng.uniform(*TRANSIENT_GAIN, hit.sum()).astype(np.float32)
+    spiky[hit, 1] *= gain  # Inrush: current and power jump, the mains voltage doesn't
+    spiky[hit, 2] *= gain
+    return (np.concatenate([X, spiky]), np.concatenate([labels, labels]),
+            np.concatenate([groups, groups + groups.max() + 1]))
+
+
+class WindowBuffer:
+    """Per-device tail of the last window - 1 samples, so windows continue across batches.
+
+    A device's first samples get windows padded by repeating its first
+    reading, so every sample is classified from the moment a device appears.
+    Tails live in one (devices, window - 1, 3) array, indexed by a slot per
+    device, so a batch is stitched together without a Python loop per device.
+    """
+
+    def __init__(self, window=WINDOW_SIZE):
+        self.window = window
+        self._slots = {}
+        self._tails = np.empty((0, window - 1, len(CHANNELS)))
+        self._lock = threading.Lock()
+
+    def features(self, device_ids, x):
+        """(n, 3) samples of any devices, each device's oldest first -> (n, N_FEATURES), same order.
+
+        Every device's tail + new samples are laid end to end and featurized in
+        one window_features() call: a segment starts with window - 1 samples of
+        history, so the windows kept never reach into another device's segment.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        n = len(x)
+        if n == 0:
+            return np.empty((0, N_FEATURES), dtype=np.float32)
+        history = self.window - 1
+        with self._lock:
+            device_ids = list(device_ids)
+            new = set(device_ids).difference(self._slots)
+            if new:  # New devices: history = their first reading repeated
+                grown = np.empty((len(self._slots) + len(new), history, len(CHANNELS)))
+                grown[:len(self._tails)] = self._tails
+                for device_id in sorted(new, key=device_ids.index):
+                    self._slots[device_id] = len(self._slots)
+                    grown[self._slots[device_id]] = x[device_ids.index(device_id)]
+                self._tails = grown
+            slot = np.fromiter(map(self._slots.__getitem__, device_ids), dtype=np.intp, count=n)
+
+            order = np.argsort(slot, kind="stable")  # Grouped by device, arrival order kept
+            counts = np.bincount(slot)
+            devices = np.flatnonzero(counts)
+            counts = counts[devices]
+            seg_ends = np.cumsum(counts + history)
+            seg_starts = seg_ends - counts - history
+            stream = np.empty((int(seg_ends[-1]), x.shape[1]))
+            steps = np.arange(history)
+            stream[(seg_starts[:, None] + steps).ravel()] = self._tails[devices].reshape(-1, x.shape[1])
+            # Device k's new samples follow its history: stream rows seg_starts[k] + history + j
+            offsets = np.repeat(seg_starts - (np.cumsum(counts) - counts), counts)
+            stream[offsets + history + np.arange(n)] = x[order]
+            self._tails[devices] = stream[seg_ends[:, None] - history + steps]
+
+        # Feature row r is the window ending at stream row r + history
+        out = np.empty((n, N_FEATURES), dtype=np.float32)
+        out[order] = window_features(stream, self.window)[offsets + np.arange(n)]
+        return out
+
+    def clear(self):
+        with self._lock:
+            self._slots.clear()
+            self._tails = self._tails[:0]
@@ -0,0 +1,20 @@
+import os
+
+# --- GUNICORN CONFIGURATION ---
+bind = os.getenv("GRIDGUARD_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+# Threaded workers: /api/stream (SSE) and chat streams hold a thread for their whole lifetime
+worker_class = "gthread"
+threads = int(os.getenv("GRIDGUARD_THREADS", "16"))
+timeout = 120          # Synchronous AI reports can take a while
+graceful_timeout = 10  # Lets the leader flush its ingest queue on shutdown
+# No preload: each worker starts its own services after the fork (threads don't survive fork)
+preload_app = False
+accesslog = "-"
+
+
+def on_starting(server):
+    # Migrate once in the master so workers don't race on schema changes
+    from db import init_db
+    from server import DB_FILE
+    init_db(DB_FILE)
@@ -0,0 +1,246 @@
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+
+import energy
+import rollups
+from db import connect
+
+# --- INGESTION CONFIGURATION ---
+INGEST_QUEUE_SIZE = 10000   # Max pending records before we start dropping
+INGEST_BATCH_SIZE = 500     # Flush when this many records are buffered...
+INGEST_FLUSH_INTERVAL = 1.0 # ...or when the oldest buffered record is this old (seconds)
+INGEST_CONTROL_TIMEOUT = 5.0  # Seconds flush()/call()/stop() wait for room in a full queue
+
+# Queue record kinds
+_MEASUREMENT = 0
+_LOG = 1
+_FLUSH = 2
+_STOP = 3
+_CALL = 4
+_MEASUREMENTS = 5
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+class IngestWriter:
+    """Owns the single write connection to the DB and flushes telemetry in batches.
+
+    The MQTT thread only enqueues tuples; every INSERT happens here, inside one
+    transaction per batch, so a burst of messages costs one commit instead of
+    two or three connections and commits per message.
+    """
+
+    def __init__(self, db_file, queue_size=INGEST_QUEUE_SIZE,
+                 batch_size=INGEST_BATCH_SIZE, flush_interval=INGEST_FLUSH_INTERVAL, classifier=None):
+        self.db_file = db_file
+        self.classifier = classifier  # Optional LoadClassifier: one inference call per batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = {
+            "queued": 0,
+            "measurements_written": 0,
+            "logs_written": 0,
+            "batches": 0,
+            "dropped": 0,
+            "failed": 0,
+            "last_batch_size": 0,
+            "last_flush_ms": 0.0,
+        }
+        self._thread = None
+
+    # --- PRODUCER SIDE (called from the MQTT / Flask threads) ---
+    def _put(self, record, rows=1):
+        try:
+            self.queue.put_nowait(record)
+            self.stats["queued"] += rows
+            return True
+        except queue.Full:
+            self.stats["dropped"] += rows
+            return False
+
+    def submit_measurement(self, device_id, timestamp, voltage, current, power, status, kwh_increment=0.0):
+        return self._put((_MEASUREMENT, device_id, timestamp, voltage, current, power, status, kwh_increment))
+
+    def submit_measurements(self, rows):
+        """Queues a multi-sample frame as one record.
+
+        rows are (device_id, timestamp, voltage, current, power, status,
+        kwh_increment) tuples; they are committed together or not at all.
+        """
+        return self._put((_MEASUREMENTS, rows), len(rows))
+
+    def submit_log(self, timestamp, level, message, device_id=None):
+        return self._put((_LOG, timestamp, level, message, device_id))
+
+    def flush(self, timeout=INGEST_CONTROL_TIMEOUT):
+        """Blocks until everything queued before this call has been committed. False on timeout."""
+        done = threading.Event()
+        deadline = time.monotonic() + timeout
+        try:
+            self.queue.put((_FLUSH, done), timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(max(0.0, deadline - time.monotonic()))
+
+    def call(self, fn, timeout=INGEST_CONTROL_TIMEOUT):
+        """Runs fn(conn) on the writer thread after everything queued so far is committed.
+
+        Used for maintenance that must not race the incremental writes (rollup
+        rebuilds, retention). Returns a Future with fn's result; if the queue
+        stays full for `timeout` seconds it fails with IngestQueueFull instead
+        of blocking the caller.
+        """
+        future = Future()
+        try:
+            self.queue.put((_CALL, fn, future), timeout=timeout)
+        except queue.Full:
+            future.set_exception(IngestQueueFull(f"Ingest queue full ({self.queue.maxsize} records pending)"))
+        return future
+
+    # --- LIFECYCLE ---
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="ingest-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=INGEST_CONTROL_TIMEOUT):
+        if not self._thread or not self._thread.is_alive():
+            return
+        try:
+            self.queue.put((_STOP,), timeout=timeout)
+        except queue.Full:
+            print("Ingest writer: queue still full at shutdown, pending records are lost")
+            return
+        self._thread.join(timeout)
+
+    @property
+    def alive(self):
+        """False if the writer was never started or has died: nothing queued will be committed."""
+        return self._thread is not None and self._thread.is_alive()
+
+    # --- WRITER THREAD ---
+    def _run(self):
+        conn = connect(self.db_file)
+        try:
+            running = True
+            while running:
+                try:
+                    first = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    continue
+
+                batch = []
+                waiters = []
+                calls = []
+                item = first
+                deadline = time.monotonic() + self.flush_interval
+                # Size-or-time trigger: keep draining until the batch is full
+                # or the first record has waited flush_interval seconds.
+                while True:
+                    kind = item[0]
+                    if kind == _FLUSH:
+                        waiters.append(item[1])
+                        break
+                    if kind == _CALL:
+                        calls.append(item[1:])
+                        break
+                    if kind == _STOP:
+                        running = False
+                        break
+                    batch.append(item)
+                    remaining = deadline - time.monotonic()
+                    if len(batch) >= self.batch_size or remaining <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+
+                if batch:
+                    try:
+                        self._write_batch(conn, batch)
+                    except Exception as e:
+                        # A bad record must cost its batch, not the writer thread
+                        if conn.in_transaction:
+                            conn.rollback()
+                        rows = sum(len(r[1]) if r[0] == _MEASUREMENTS else 1 for r in batch)
+                        self.stats["failed"] += rows
+                        print(f"Ingest batch failed ({rows} records): {type(e).__name__}: {e}")
+                for w in waiters:
+                    w.set()
+                for fn, future in calls:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        future.set_result(fn(conn))
+                    except Exception as e:
+                        if conn.in_transaction:
+                            conn.rollback()
+                        future.set_exception(e)
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn, batch):
+        start = time.perf_counter()
+        measurements = []
+        samples = []
+        logs = []
+        daily = {}
+        for record in batch:
+            kind = record[0]
+            if kind == _MEASUREMENT:
+                samples.append(record[1:])
+            elif kind == _MEASUREMENTS:
+                samples.extend(record[1])
+            elif kind == _LOG:
+                logs.append(record[1:])
+        predicted = None
+        if samples and self.classifier is not None:
+            predicted = self.classifier.classify_samples([(s[0], s[2], s[3], s[4]) for s in samples])
+        if predicted is None:
+            predicted = [None] * len(samples)
+        for (device_id, ts, voltage, current, power, status, kwh), cls in zip(samples, predicted):
+            measurements.append((device_id, ts, voltage, current, power, status, cls))
+            if kwh:
+                key = (device_id, datetime.fromtimestamp(ts).strftime("%Y-%m-%d"))
+                daily[key] = daily.get(key, 0.0) + kwh
+
+        try:
+            with conn:
+                if measurements:
+                    conn.executemany(
+                        "INSERT INTO measurements (device_id, timestamp, voltage, current, power, status, "
+                        "predicted_class) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        measurements)
+                if daily:
+                    conn.executemany(
+                        "INSERT INTO daily_summary (device_id, date, kwh) VALUES (?, ?, ?) "
+                        "ON CONFLICT(device_id, date) DO UPDATE SET kwh = kwh + excluded.kwh",
+                        [(device_id, day, kwh) for (device_id, day), kwh in daily.items()])
+                if samples:
+                    # 1m/1h/1d rollups: one upsert per touched bucket, not per sample
+                    rollups.apply(conn, rollups.aggregate(samples))
+                    # Energy accumulator checkpoint commits with the rows it covers
+                    energy.checkpoint(conn, samples)
+                if logs:
+                    conn.executemany(
+                        "INSERT INTO logs (timestamp, level, message, device_id) VALUES (?, ?, ?, ?)", logs)
+        except sqlite3.Error as e:
+            self.stats["failed"] += len(measurements) + len(logs)
+            print(f"Ingest batch failed ({len(measurements)} measurements, {len(logs)} logs): {e}")
+            return
+
+        self.stats["measurements_written"] += len(measurements)
+        self.stats["logs_written"] += len(logs)
+        self.stats["batches"] += 1
+        self.stats["last_batch_size"] = len(measurements) + len(logs)
+        self.stats["last_flush_ms"] = round((time.perf_counter() - start) * 1000.0, 3)
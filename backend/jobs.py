@@ -0,0 +1,202 @@
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from db import connect
+
+# --- JOB CONFIGURATION ---
+JOB_WORKERS = 2          # Reports generated in parallel
+JOB_MAX_PENDING = 16     # Queued + running jobs before new submissions are refused
+JOB_HISTORY = 200        # Finished jobs kept for GET /api/jobs/<id>
+JOB_RESULT_TTL = 3600.0  # Seconds a finished job stays queryable
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    """One background run: status moves queued -> running -> done | failed."""
+    __slots__ = ("id", "kind", "key", "status", "progress", "result", "error",
+                 "created", "started", "finished", "waiters", "on_update")
+
+    def __init__(self, kind, key=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.key = key
+        self.status = "queued"
+        self.progress = "Queued"
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.waiters = 1  # Requests sharing this job (coalesced duplicates included)
+        self.on_update = None
+
+    def update(self, progress):
+        self.progress = progress
+        if self.on_update:
+            self.on_update(self)
+
+    @property
+    def done(self):
+        return self.status in ("done", "failed")
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "waiters": self.waiters,
+        }
+
+
+class JobStore:
+    """Jobs mirrored to the jobs table, so any web worker can answer a status poll."""
+
+    _COLUMNS = ("id", "kind", "status", "progress", "result", "error", "created", "started", "finished", "waiters")
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+
+    def save(self, job):
+        row = job.to_dict()
+        values = [job.id] + [json.dumps(row[c]) if c == "result" else row[c] for c in self._COLUMNS[1:]]
+        try:
+            conn = connect(self.db_file)
+            try:
+                with conn:
+                    conn.execute(f"INSERT OR REPLACE INTO jobs ({', '.join(self._COLUMNS)}) "
+                                 f"VALUES ({', '.join('?' * len(self._COLUMNS))})", values)
+            finally:
+                conn.close()
+        except Exception as e:
+            # The job itself still runs; only other workers lose sight of it
+            print(f"Job store write failed: {e}")
+
+    def load(self, job_id):
+        conn = connect(self.db_file)
+        try:
+            row = conn.execute(f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        values = dict(zip(self._COLUMNS, row))
+        job = Job(values["kind"])
+        for name in self._COLUMNS:
+            setattr(job, name, json.loads(values[name]) if name == "result" and values[name] else values[name])
+        return job
+
+    def prune(self, cutoff):
+        try:
+            conn = connect(self.db_file)
+            try:
+                with conn:
+                    conn.execute("DELETE FROM jobs WHERE finished < ?", (cutoff,))
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"Job store prune failed: {e}")
+
+
+class JobManager:
+    """Bounded worker pool for slow request pipelines (AI reports, Telegram uploads).
+
+    submit() returns immediately. A job submitted with the same key as one
+    still queued or running is not started again: the caller gets the
+    existing job. With a store, jobs are also visible to other processes
+    (coalescing stays per process).
+    """
+
+    def __init__(self, workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING,
+                 history=JOB_HISTORY, result_ttl=JOB_RESULT_TTL, store=None):
+        self.store = store
+        self.max_pending = max_pending
+        self.history = history
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._jobs = OrderedDict()  # id -> Job, oldest first
+        self._active = {}           # key -> Job still queued/running
+        self._lock = threading.Lock()
+        self.stats = {"submitted": 0, "coalesced": 0, "completed": 0, "failed": 0, "rejected": 0, "pending": 0}
+
+    def submit(self, kind, fn, key=None):
+        """Queues fn(job) and returns the Job; its return value becomes job.result."""
+        with self._lock:
+            if key is not None:
+                job = self._active.get(key)
+                if job is not None:
+                    job.waiters += 1
+                    self.stats["coalesced"] += 1
+                    return job
+            if self.stats["pending"] >= self.max_pending:
+                self.stats["rejected"] += 1
+                raise JobQueueFull(f"{self.stats['pending']} jobs already pending")
+            cutoff = self._prune()
+            job = Job(kind, key)
+            if self.store is not None:
+                job.on_update = self.store.save
+            self._jobs[job.id] = job
+            if key is not None:
+                self._active[key] = job
+            self.stats["submitted"] += 1
+            self.stats["pending"] += 1
+        if self.store is not None:
+            # DB work outside the lock: submit()/get() on other threads don't wait on it
+            self.store.prune(cutoff)
+            self.store.save(job)
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def get(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            job = self.store.load(job_id)  # Submitted through another worker
+        return job
+
+    def _run(self, job, fn):
+        job.status = "running"
+        job.started = time.time()
+        job.update("Running")
+        try:
+            job.result = fn(job)
+            status = "done"
+        except Exception as e:
+            job.error = str(e)
+            status = "failed"
+        job.finished = time.time()
+        job.progress = "Done" if status == "done" else "Failed"
+        job.status = status
+        if job.on_update:
+            job.on_update(job)
+        with self._lock:
+            if job.key is not None and self._active.get(job.key) is job:
+                del self._active[job.key]
+            self.stats["pending"] -= 1
+            self.stats["completed" if job.status == "done" else "failed"] += 1
+
+    def _prune(self):
+        # Caller holds the lock. Drops expired finished jobs, then the oldest beyond
+        # history; returns the cutoff for the caller's store.prune() once unlocked.
+        cutoff = time.time() - self.result_ttl
+        finished = [j for j in self._jobs.values() if j.done]
+        excess = len(finished) - self.history
+        for j in finished:
+            if j.finished < cutoff or excess > 0:
+                del self._jobs[j.id]
+                excess -= 1
+        return cutoff
+
+    def stop(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
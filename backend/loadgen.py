@@ -0,0 +1,345 @@
+"""Synthetic telemetry load generator and ingestion benchmark.
+
+    python loadgen.py [--devices 100] [--rate 1] [--duration 30] [--mix normal=8,overload=1,spike=1]
+                      [--format json|binary] [--batch 1]
+    python loadgen.py --target mqtt --broker localhost:1883 --db /path/to/power_monitor.db [--server-pid PID]
+
+Simulates N devices, each publishing --rate messages/s of --batch samples and
+behaving like demo_scenarios.py (normal / overload ramp / spike + cutoff).
+
+    direct  (default) the server module in this process on a scratch DB;
+            messages go straight to server.on_message, no broker needed
+    mqtt    publishes to a broker (e.g. a local mosquitto); a server started
+            with MQTT_BROKER=<host> ingests, and --db points at its database
+
+Reports offered vs sustained messages/s, sample-to-commit latency percentiles
+(found by polling the DB, so they are +/- --poll), DB write amplification
+(bytes the ingesting process wrote per sample, from /proc/<pid>/io) and the
+samples that never reached the DB.
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from codec import encode_batch, encode_frame
+
+DEVICE_PREFIX = "load_"
+SCENARIOS = ("normal", "overload", "spike")
+SPIKE_PROBABILITY = 0.01  # Per sample, for "spike" devices
+SPIKE_CUTOFF_SAMPLES = 5  # OFFLINE samples after a spike (protection tripped)
+
+Message = namedtuple("Message", "topic payload")  # The two fields on_message reads
+
+
+class SimDevice:
+    """One simulated board; next_reading() advances its scenario by one sample."""
+
+    def __init__(self, device_id, scenario, rng):
+        self.device_id = device_id
+        self.topic = f"gridguard/{device_id}/telemetry"
+        self.scenario = scenario
+        self.rng = rng
+        self.ramp = 0.20
+        self.cutoff = 0
+
+    def next_reading(self):
+        voltage = 230 + self.rng.uniform(-2, 2)
+        status = "OK"
+        if self.scenario == "overload":
+            # Ramp until the overcurrent trip, then reset
+            self.ramp = 0.20 if self.ramp > 0.50 else self.ramp + 0.02
+            current = self.ramp
+            if current > 0.35:
+                status = "FAULT: OC"
+        elif self.scenario == "spike":
+            if self.cutoff:
+                self.cutoff -= 1
+                return 0.0, 0.0, 0.0, "OFFLINE"
+            current = 0.15
+            if self.rng.random() < SPIKE_PROBABILITY:
+                self.cutoff = SPIKE_CUTOFF_SAMPLES
+                voltage, current, status = 240.0, 2.5, "FAULT: COMPONENT SHORT"
+        else:
+            current = 0.15 + self.rng.uniform(0.01, 0.05)
+        return round(voltage, 1), round(current, 3), round(voltage * current, 2), status
+
+    def message(self, now, batch, spacing, payload_format):
+        """One MQTT message: batch samples spaced `spacing` apart, the newest taken now."""
+        samples = [(round(now - (batch - 1 - k) * spacing, 3),) + self.next_reading() for k in range(batch)]
+        if batch == 1:
+            ts, voltage, current, power, status = samples[0]
+            if payload_format == "binary":
+                return encode_frame(voltage, current, power, status, ts)
+            return json.dumps({"voltage": voltage, "current": current, "power": power,
+                               "status": status, "timestamp": ts}).encode()
+        if payload_format == "binary":
+            return encode_batch(samples)
+        return json.dumps({"samples": [
+            {"timestamp": ts, "voltage": v, "current": c, "power": p, "status": s}
+            for ts, v, c, p, s in samples]}).encode()
+
+
+def make_devices(count, mix, seed):
+    rng = random.Random(seed)
+    weights = [mix.get(s, 0) for s in SCENARIOS]
+    return [SimDevice(f"{DEVICE_PREFIX}{i:04d}", rng.choices(SCENARIOS, weights)[0], random.Random(rng.random()))
+            for i in range(count)]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r} (choose from {', '.join(SCENARIOS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def process_wchar(pid):
+    """Bytes pid has passed to write() so far (None where /proc isn't available)."""
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def db_bytes(db_file):
+    return sum(os.path.getsize(p) for p in (db_file, db_file + "-wal") if os.path.exists(p))
+
+
+class _Discard:
+    """stdout for the in-process server: its per-fault prints would otherwise count as DB writes."""
+
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+# --- TARGETS ---
+class DirectTarget:
+    """The server module in this process, on an empty (or --seed-db) DB in a temp dir."""
+
+    def __init__(self, seed_db=None):
+        self.workdir = tempfile.mkdtemp(prefix="gridguard-loadgen-")
+        if seed_db:
+            shutil.copy(seed_db, os.path.join(self.workdir, "power_monitor.db"))
+        self._cwd = os.getcwd()
+        os.chdir(self.workdir)  # server.DB_FILE is relative
+        import server
+        self.server = server
+        server.alert_dispatcher.bot_token = None  # Simulated faults must not reach Telegram
+        server.init_db(server.DB_FILE)
+        server.load_energy_meter()
+        server.ingest_writer.start()
+        self.db_file = os.path.join(self.workdir, server.DB_FILE)
+        self.pid = os.getpid()
+
+    def send(self, msg):
+        self.server.on_message(None, None, msg)
+
+    def drain(self, monitor, timeout):
+        self.server.ingest_writer.flush(timeout)
+        monitor.poll()
+
+    def stats(self):
+        writer = self.server.ingest_writer.stats
+        return {"writer_batches": writer["batches"], "writer_dropped": writer["dropped"],
+                "writer_failed": writer["failed"], "payload_errors": self.server.payload_stats["errors"]}
+
+    def close(self):
+        self.server.ingest_writer.stop()
+        os.chdir(self._cwd)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class MqttTarget:
+    """A broker in front of a separately running server whose DB we watch."""
+
+    def __init__(self, broker, db_file, server_pid=None):
+        import paho.mqtt.client as mqtt
+        host, _, port = broker.partition(":")
+        self.client = mqtt.Client()
+        self.client.connect(host, int(port or 1883), 60)
+        self.client.loop_start()
+        self.db_file = db_file
+        self.pid = server_pid
+
+    def send(self, msg):
+        self.client.publish(msg.topic, msg.payload)
+
+    def drain(self, monitor, timeout):
+        # No flush handle on a remote server: wait until rows stop arriving
+        deadline = time.time() + timeout
+        quiet_since = time.time()
+        seen = monitor.rows
+        while time.time() < deadline and time.time() - quiet_since < 3.0:
+            time.sleep(0.25)
+            monitor.poll()
+            if monitor.rows != seen:
+                seen = monitor.rows
+                quiet_since = time.time()
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class CommitMonitor:
+    """Polls the DB for newly committed load_* rows; latency = seen time - sample timestamp."""
+
+    def __init__(self, db_file, interval):
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.interval = interval
+        self.last_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM measurements").fetchone()[0]
+        self.rows = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="commit-monitor", daemon=True)
+
+    def poll(self):
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id, timestamp FROM measurements WHERE id > ? AND device_id LIKE ? ORDER BY id",
+                (self.last_id, DEVICE_PREFIX + "%")).fetchall()
+            now = time.time()
+            if rows:
+                self.last_id = rows[-1][0]
+                self.rows += len(rows)
+                self.latencies.extend(now - ts for _, ts in rows)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.poll()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.conn.close()
+
+
+# --- LOAD LOOP ---
+def generate(devices, target, rate, batch, payload_format, duration):
+    """Sends each device's messages on its own schedule; stops at the deadline even if behind."""
+    period = 1.0 / rate
+    spacing = period / batch
+    start = time.time()
+    end = start + duration
+    schedule = [(start + i * period / len(devices), i) for i in range(len(devices))]  # Spread phases
+    heapq.heapify(schedule)
+    sent = payload_bytes = 0
+    while True:
+        due, i = schedule[0]
+        now = time.time()
+        if now >= end:
+            break
+        if due > now:
+            time.sleep(min(due - now, end - now))
+            continue
+        heapq.heapreplace(schedule, (due + period, i))
+        device = devices[i]
+        payload = device.message(now, batch, spacing, payload_format)
+        target.send(Message(device.topic, payload))
+        sent += 1
+        payload_bytes += len(payload)
+    return sent, payload_bytes, time.time() - start
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per device")
+    parser.add_argument("--batch", type=int, default=1, help="samples per message (multi-sample frames if > 1)")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("normal=8,overload=1,spike=1"),
+                        help="scenario weights, e.g. normal=8,overload=1,spike=1")
+    parser.add_argument("--format", choices=["json", "binary"], default="json")
+    parser.add_argument("--target", choices=["direct", "mqtt"], default="direct")
+    parser.add_argument("--seed-db", help="direct: start from a copy of this DB instead of an empty one")
+    parser.add_argument("--broker", default="localhost:1883", help="mqtt: host[:port]")
+    parser.add_argument("--db", help="mqtt: the ingesting server's database file")
+    parser.add_argument("--server-pid", type=int, help="mqtt: ingesting server pid (for write amplification)")
+    parser.add_argument("--poll", type=float, default=0.05, help="commit monitor poll interval (s)")
+    parser.add_argument("--drain", type=float, default=30.0, help="max seconds to wait for queued rows")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if args.target == "mqtt" and not args.db:
+        parser.error("--target mqtt needs --db")
+
+    devices = make_devices(args.devices, args.mix, args.seed)
+    scenarios = {s: sum(d.scenario == s for d in devices) for s in SCENARIOS}
+    print(f"{args.devices} devices ({', '.join(f'{n} {s}' for s, n in scenarios.items() if n)}) x {args.rate:g} msg/s "
+          f"x {args.batch} sample(s), {args.format}, target {args.target}, {args.duration:g}s")
+
+    if args.target == "direct":
+        target = DirectTarget(args.seed_db)
+    else:
+        target = MqttTarget(args.broker, args.db, args.server_pid)
+    real_stdout = sys.stdout
+    try:
+        monitor = CommitMonitor(target.db_file, args.poll)
+        wchar_before = process_wchar(target.pid) if target.pid else None
+        size_before = db_bytes(target.db_file)
+        monitor.start()
+        if args.target == "direct":
+            sys.stdout = _Discard()
+        sent, payload_bytes, elapsed = generate(devices, target, args.rate, args.batch, args.format, args.duration)
+        target.drain(monitor, args.drain)
+        monitor.stop()
+        sys.stdout = real_stdout
+        wchar_after = process_wchar(target.pid) if target.pid else None
+        size_after = db_bytes(target.db_file)
+        extra = target.stats()
+    finally:
+        sys.stdout = real_stdout
+        target.close()
+
+    offered = args.devices * args.rate * args.duration
+    samples = sent * args.batch
+    print(f"messages: offered {offered:,.0f}, sent {sent:,} | sustained {sent / elapsed:,.1f} msg/s "
+          f"({samples / elapsed:,.1f} samples/s, {payload_bytes / max(sent, 1):.0f} B/msg)")
+    lat = sorted(monitor.latencies)
+    if lat:
+        print(f"sample->commit latency: p50 {percentile(lat, 0.50) * 1000:.0f} ms | "
+              f"p95 {percentile(lat, 0.95) * 1000:.0f} ms | p99 {percentile(lat, 0.99) * 1000:.0f} ms | "
+              f"max {lat[-1] * 1000:.0f} ms (+/- {args.poll * 1000:.0f} ms poll)")
+    if wchar_before is not None and wchar_after is not None and samples:
+        written = wchar_after - wchar_before
+        print(f"DB writes: {written / 1e6:.1f} MB, {written / samples:,.0f} B/sample "
+              f"({written / max(payload_bytes, 1):.1f}x payload bytes) | "
+              f"file growth {(size_after - size_before) / samples:,.0f} B/sample")
+    else:
+        print(f"DB file growth: {(size_after - size_before) / max(samples, 1):,.0f} B/sample "
+              f"(no /proc/<pid>/io for write amplification)")
+    lost = samples - monitor.rows
+    print(f"committed {monitor.rows:,} of {samples:,} samples | missing {lost:,}"
+          + (" | " + ", ".join(f"{k} {v:,}" for k, v in extra.items()) if extra else ""))
+
+
+if __name__ == "__main__":
+    main()
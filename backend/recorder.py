@@ -0,0 +1,429 @@
+import csv
+import glob
+import io
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from db import connect
+
+# --- RECORDER CONFIGURATION ---
+# Labelled training data: /api/record opens a session (recording_sessions row,
+# one device or all), the ingestion leader buffers that session's samples in
+# memory and a background thread writes them out in chunks. The ingest path
+# only appends to a list; files are opened once per flush, never per message.
+RECORD_FORMAT = os.getenv("RECORD_FORMAT", "csv")  # csv | npy | parquet (needs pyarrow, else npy)
+RECORD_FLUSH_ROWS = 2000      # Flush when a session has this many rows buffered...
+RECORD_FLUSH_INTERVAL = 2.0   # ...or at least this often (seconds)
+RECORD_POLL_INTERVAL = 1.0    # Seconds between reads of the open sessions (any worker may start/stop one)
+RECORD_MAX_BUFFER = 200000    # Rows held per session while writes fail; newer rows are dropped past it
+COLUMNS = ("timestamp", "device_id", "voltage", "current", "power")
+DATASET_HEADER = "voltage,current,power,label\n"  # ml/train_model.py's CSV
+
+# .npy chunks store the device as an index into the session's meta.json
+# "devices" list, so a row is 22 bytes whatever the device id length
+NPY_DTYPE = np.dtype([("timestamp", "<f8"), ("device", "<u2"), ("voltage", "<f4"),
+                      ("current", "<f4"), ("power", "<f4")])
+
+
+def _parquet():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        return pyarrow
+    except ImportError:
+        return None
+
+
+def _write_atomic(path, data):
+    """Whole file or nothing: a crash mid-write leaves only a .tmp behind."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _repair_tail(path):
+    """Cuts a half-written last line (crash during an append) off a CSV file."""
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return False
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return False
+        f.seek(max(0, size - 65536))
+        tail = f.read()
+        f.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+        return True
+
+
+class RecordingSession:
+    """An open recording_sessions row and its in-memory buffer / on-disk chunks."""
+    __slots__ = ("id", "label", "device_id", "started", "ended", "path", "format",
+                 "rows", "chunks", "devices", "buffer")
+
+    def __init__(self, session_id, label, device_id, started, path, fmt):
+        self.id = session_id
+        self.label = label
+        self.device_id = device_id  # None: every device
+        self.started = started
+        self.ended = None
+        self.path = path
+        self.format = fmt
+        self.rows = 0
+        self.chunks = 0
+        self.devices = []  # Device ids in the order .npy chunks index them
+        self.buffer = []   # (timestamp, device_id, voltage, current, power)
+
+    def meta(self):
+        return {"id": self.id, "label": self.label, "device_id": self.device_id,
+                "started": self.started, "ended": self.ended, "format": self.format,
+                "columns": list(COLUMNS), "rows": self.rows, "chunks": self.chunks,
+                "devices": self.devices}
+
+
+class DatasetRecorder:
+    """Per-device recording sessions with buffered, crash-safe writes.
+
+    Every flush writes one chunk file per session (tmp file, fsync, rename),
+    then its meta.json the same way, so a crash loses at most the rows still
+    buffered and never leaves a torn chunk. Sessions live in
+    recordings/session-<id>/ as CSV, .npy or Parquet chunks; with dataset_csv
+    set, rows are also appended to the legacy ml_dataset.csv (one open per
+    flush) so ml/train_model.py keeps working unchanged.
+
+    The ingestion leader start()s it and writes; other workers start(write=False),
+    which only keeps the open sessions current for active().
+    """
+
+    def __init__(self, db_file, base_dir, fmt=RECORD_FORMAT, dataset_csv=None,
+                 flush_rows=RECORD_FLUSH_ROWS, flush_interval=RECORD_FLUSH_INTERVAL,
+                 poll_interval=RECORD_POLL_INTERVAL, max_buffer=RECORD_MAX_BUFFER):
+        self.db_file = db_file
+        self.base_dir = base_dir
+        self.requested_format = fmt
+        self.format = fmt
+        self.dataset_csv = dataset_csv
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self.max_buffer = max_buffer
+        self.stats = {
+            "rows": 0,
+            "dropped": 0,
+            "flushes": 0,
+            "chunks": 0,
+            "bytes": 0,
+            "failed": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+        }
+        self._sessions = {}     # id -> RecordingSession (open in the DB)
+        self._by_device = {}    # device_id (None = all devices) -> RecordingSession
+        self._writing = False
+        self._dataset_checked = False
+        self._lock = threading.Lock()        # Sessions and buffers
+        self._flush_lock = threading.Lock()  # One flush at a time (thread vs stop / route)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # --- SESSIONS ---
+    def session_dir(self, session_id):
+        return os.path.join(self.base_dir, f"session-{session_id}")
+
+    def refresh(self):
+        """Re-reads the open sessions. The writer also opens new ones on disk and closes ended ones."""
+        conn = connect(self.db_file)
+        try:
+            rows = conn.execute("SELECT id, label, device_id, started FROM recording_sessions "
+                                "WHERE ended IS NULL ORDER BY id").fetchall()
+            with self._lock:
+                gone = [sid for sid in self._sessions if sid not in {r[0] for r in rows}]
+            ended = {}
+            if gone:
+                marks = ", ".join("?" * len(gone))
+                ended = dict(conn.execute(f"SELECT id, ended FROM recording_sessions WHERE id IN ({marks})",
+                                          gone).fetchall())
+        finally:
+            conn.close()
+
+        writing = self._writing
+        closed = []
+        with self._lock:
+            for sid in gone:
+                session = self._sessions.pop(sid, None)
+                if session is None:  # Closed by a concurrent refresh
+                    continue
+                session.ended = ended.get(sid) or time.time()
+                closed.append(session)
+            for sid, label, device_id, started in rows:
+                if sid not in self._sessions:
+                    self._sessions[sid] = self._open(sid, label, device_id, started, writing)
+            # Newest session wins if a device ever has two (the route closes overlaps)
+            self._by_device = {s.device_id: s for s in self._sessions.values()}
+        if writing:
+            for session in closed:
+                self._flush_session(session, final=True)
+        return closed
+
+    def _open(self, sid, label, device_id, started, writing):
+        session = RecordingSession(sid, label, device_id, started, self.session_dir(sid), self.format)
+        if not writing:
+            return session
+        os.makedirs(session.path, exist_ok=True)
+        meta_path = os.path.join(session.path, "meta.json")
+        if os.path.exists(meta_path):  # Resumed after a restart: keep appending chunks
+            with open(meta_path) as f:
+                meta = json.load(f)
+            session.format = meta.get("format", self.format)
+            session.devices = meta.get("devices", [])
+            session.rows = meta.get("rows", 0)
+            session.chunks = len(self._chunk_files(session.path))
+        else:
+            self._write_meta(session)
+        print(f"Recorder: session {sid} '{label}' ({device_id or 'all devices'}) -> {session.path}")
+        return session
+
+    def active(self, device_id=None):
+        """Open sessions covering device_id (any device if None), newest first.
+
+        Memory only (request path): the background poll keeps the sessions current.
+        """
+        with self._lock:
+            sessions = [s for s in self._sessions.values()
+                        if device_id is None or s.device_id in (None, device_id)]
+        return [{"id": s.id, "label": s.label, "device_id": s.device_id, "started": s.started}
+                for s in sorted(sessions, key=lambda s: -s.id)]
+
+    # --- HOT PATH (MQTT thread) ---
+    def record(self, device_id, rows):
+        """(timestamp, voltage, current, power) rows of one device. No I/O: buffered for the writer."""
+        session = self._by_device.get(device_id) or self._by_device.get(None)
+        if session is None or not rows:
+            return
+        with self._lock:
+            if len(session.buffer) + len(rows) > self.max_buffer:
+                self.stats["dropped"] += len(rows)
+                return
+            session.buffer.extend((ts, device_id, v, i, p) for ts, v, i, p in rows)
+            full = len(session.buffer) >= self.flush_rows
+        if full:
+            self._wake.set()
+
+    # --- WRITER ---
+    def flush(self):
+        """Writes every buffered row now. Returns the number of rows written."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return sum(self._flush_session(s) for s in sessions)
+
+    def _flush_session(self, session, final=False):
+        with self._flush_lock:
+            with self._lock:
+                rows, session.buffer = session.buffer, []
+            # Samples stamped outside the session (device clock, stop seen late) are not its data
+            end = session.ended if final else None
+            rows = [r for r in rows if r[0] >= session.started and (end is None or r[0] <= end)]
+            if not rows and not final:
+                return 0
+            start = time.perf_counter()
+            try:
+                if rows:
+                    session.chunks += 1
+                    data = self._encode(session, rows)
+                    _write_atomic(os.path.join(session.path, f"chunk-{session.chunks:06d}.{session.format}"), data)
+                    session.rows += len(rows)
+                    self.stats["bytes"] += len(data)
+                    self.stats["chunks"] += 1
+                    if self.dataset_csv:
+                        self._append_dataset(session.label, rows)
+                self._write_meta(session)
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Recorder flush failed (session {session.id}, {len(rows)} rows): {e}")
+                with self._lock:
+                    if not final:  # Retried on the next flush
+                        session.buffer[:0] = rows
+                return 0
+            elapsed = (time.perf_counter() - start) * 1000.0
+            self.stats["rows"] += len(rows)
+            self.stats["flushes"] += 1
+            self.stats["last_flush_ms"] = round(elapsed, 3)
+            self.stats["max_flush_ms"] = round(max(self.stats["max_flush_ms"], elapsed), 3)
+            if final:
+                print(f"Recorder: session {session.id} closed, {session.rows} rows in {session.chunks} chunk(s)")
+            return len(rows)
+
+    def _encode(self, session, rows):
+        if session.format == "npy":
+            codes = {d: k for k, d in enumerate(session.devices)}
+            for r in rows:
+                if r[1] not in codes:
+                    codes[r[1]] = len(session.devices)
+                    session.devices.append(r[1])
+            arr = np.array([(r[0], codes[r[1]], r[2], r[3], r[4]) for r in rows], dtype=NPY_DTYPE)
+            buf = io.BytesIO()
+            np.save(buf, arr, allow_pickle=False)
+            return buf.getvalue()
+        if session.format == "parquet":
+            pa = _parquet()
+            table = pa.table({name: [r[k] for r in rows] for k, name in enumerate(COLUMNS)})
+            buf = io.BytesIO()
+            pa.parquet.write_table(table, buf)
+            return buf.getvalue()
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")  # Quotes device ids with commas
+        writer.writerow(COLUMNS)
+        writer.writerows((f"{ts:.3f}", device_id, f"{v:.2f}", f"{i:.3f}", f"{p:.2f}")
+                         for ts, device_id, v, i, p in rows)
+        return out.getvalue().encode()
+
+    def _write_meta(self, session):
+        _write_atomic(os.path.join(session.path, "meta.json"), json.dumps(session.meta(), indent=1).encode())
+
+    def _append_dataset(self, label, rows):
+        path = self.dataset_csv
+        if not self._dataset_checked:
+            if os.path.exists(path) and _repair_tail(path):
+                print(f"Recorder: dropped a torn last line from {path}")
+            self._dataset_checked = True
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        lines = "".join(f"{v:.2f},{i:.3f},{p:.2f},{label}\n" for _, _, v, i, p in rows)
+        with open(path, "a") as f:
+            f.write((DATASET_HEADER if new_file else "") + lines)
+
+    # --- EXPORT ---
+    @staticmethod
+    def _chunk_files(path):
+        return sorted(f for f in glob.glob(os.path.join(path, "chunk-*.*")) if not f.endswith(".tmp"))
+
+    def read_meta(self, session_id):
+        """-> (meta.json dict, session dir), or (None, dir) for a session without files."""
+        path = self.session_dir(session_id)
+        try:
+            with open(os.path.join(path, "meta.json")) as f:
+                return json.load(f), path
+        except FileNotFoundError:
+            return None, path
+
+    def load(self, session_id):
+        """A session's meta.json and its rows as column arrays (COLUMNS), from every complete chunk."""
+        meta, path = self.read_meta(session_id)
+        if meta is None:
+            return None, None
+        parts = []
+        for chunk in self._chunk_files(path):
+            if chunk.endswith(".npy"):
+                arr = np.load(chunk, allow_pickle=False)
+                devices = np.asarray(meta["devices"], dtype=object)
+                parts.append((arr["timestamp"], devices[arr["device"]], arr["voltage"],
+                              arr["current"], arr["power"]))
+            elif chunk.endswith(".parquet"):
+                pa = _parquet()
+                if pa is None:
+                    raise RuntimeError("session has Parquet chunks: pip install pyarrow to read them")
+                table = pa.parquet.read_table(chunk)
+                parts.append(tuple(np.asarray(table.column(c).to_pylist()) for c in COLUMNS))
+            else:
+                with open(chunk, newline="") as f:
+                    recs = list(csv.reader(f))[1:]
+                cols = list(zip(*recs)) if recs else [()] * len(COLUMNS)
+                parts.append((np.asarray(cols[0], dtype=np.float64), np.asarray(cols[1], dtype=object),
+                              *(np.asarray(c, dtype=np.float64) for c in cols[2:])))
+        columns = {}
+        for k, name in enumerate(COLUMNS):
+            values = [p[k] for p in parts]
+            columns[name] = np.concatenate(values) if values else np.empty(0)
+        return meta, columns
+
+    def export(self, session_id, fmt="csv"):
+        """-> (bytes, mimetype, filename) of one session as CSV or .npy, or None if unknown."""
+        meta, cols = self.load(session_id)
+        if meta is None:
+            return None
+        n = len(cols["timestamp"])
+        if fmt == "npy":
+            width = max([len(str(d)) for d in cols["device_id"]] + [1])
+            arr = np.empty(n, dtype=[("timestamp", "<f8"), ("device_id", f"U{width}"), ("voltage", "<f4"),
+                                     ("current", "<f4"), ("power", "<f4"), ("label", f"U{len(meta['label'])}")])
+            for name in COLUMNS:
+                arr[name] = cols[name]
+            arr["label"] = meta["label"]
+            buf = io.BytesIO()
+            np.save(buf, arr, allow_pickle=False)
+            return buf.getvalue(), "application/octet-stream", f"session-{session_id}.npy"
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(COLUMNS + ("label",))
+        writer.writerows((f"{ts:.3f}", device_id, f"{v:.2f}", f"{i:.3f}", f"{p:.2f}", meta["label"])
+                         for ts, device_id, v, i, p in zip(*(cols[c] for c in COLUMNS)))
+        return out.getvalue().encode(), "text/csv", f"session-{session_id}.csv"
+
+    def export_dataset(self, session_ids):
+        """Closed sessions merged into ml/train_model.py's CSV (voltage,current,power,label)."""
+        out = io.StringIO()
+        out.write(DATASET_HEADER)
+        for sid in session_ids:
+            meta, cols = self.load(sid)
+            if meta is None:
+                continue  # Recorded before sessions had files (still in the DB for train_pipeline.py)
+            for v, i, p in zip(cols["voltage"], cols["current"], cols["power"]):
+                out.write(f"{v:.2f},{i:.3f},{p:.2f},{meta['label']}\n")
+        return out.getvalue().encode()
+
+    # --- LIFECYCLE ---
+    def start(self, write=True):
+        """write=False: poll the open sessions only (no files); a later start() upgrades to writing."""
+        if self._thread and self._thread.is_alive():
+            if not write or self._writing:
+                return
+            self.stop()  # Follower promoted to leader: re-open the sessions with files
+        self.format = self.requested_format
+        if self.format == "parquet" and _parquet() is None:
+            print("Recorder: pyarrow not installed, writing .npy chunks instead of Parquet")
+            self.format = "npy"
+        elif self.format not in ("csv", "npy", "parquet"):
+            print(f"Recorder: unknown RECORD_FORMAT '{self.format}', using csv")
+            self.format = "csv"
+        os.makedirs(self.base_dir, exist_ok=True)
+        with self._lock:
+            self._sessions.clear()  # Re-opened by the writer with files on disk (resume after restart)
+            self._by_device = {}
+        self._writing = write
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="recorder")
+        self._thread.daemon = True
+        self._thread.start()
+        self.refresh()
+
+    def stop(self, timeout=5.0):
+        """Stops the writer after a last flush; open sessions stay open and resume on the next start."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout)
+        if self._writing:
+            self.flush()
+        self._writing = False
+
+    def _loop(self):
+        last_poll = 0.0
+        while not self._stop.is_set():
+            self._wake.wait(min(self.flush_interval, self.poll_interval))
+            self._wake.clear()
+            try:
+                if time.monotonic() - last_poll >= self.poll_interval:
+                    last_poll = time.monotonic()
+                    self.refresh()
+                if self._writing:
+                    self.flush()
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Recorder loop failed: {e}")
@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+
+import rollups
+
+# --- RETENTION CONFIGURATION ---
+# Raw samples older than RETENTION_DAYS are deleted once their rollups are in
+# place; 1-minute rollups are thinned later, hourly/daily rollups are kept forever.
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "30"))
+ROLLUP_1M_RETENTION_DAYS = float(os.getenv("ROLLUP_1M_RETENTION_DAYS", "180"))
+LOG_RETENTION_DAYS = float(os.getenv("LOG_RETENTION_DAYS", "90"))
+RETENTION_INTERVAL = 3600.0  # Seconds between background runs
+RETENTION_CHUNK = 5000       # Rows per DELETE transaction (keeps the write lock short)
+VACUUM_CHUNK_PAGES = 1000    # Pages released per incremental_vacuum step
+
+
+def _delete_chunk(table, column, cutoff, chunk):
+    # Walks the timestamp index, so each chunk is cheap whatever the table size
+    key = "device_id, bucket" if table == "rollup_1m" else "rowid"  # rollup tables are WITHOUT ROWID
+    sql = (f"DELETE FROM {table} WHERE ({key}) IN "
+           f"(SELECT {key} FROM {table} WHERE {column} < ? ORDER BY {column} LIMIT ?)")
+
+    def run(conn):
+        with conn:
+            return conn.execute(sql, (cutoff, chunk)).rowcount
+    return run
+
+
+def _ensure_rollups(cutoff):
+    """Rebuilds rollups for raw data before cutoff if they don't account for every sample."""
+    def run(conn):
+        raw = conn.execute("SELECT COUNT(*), MIN(timestamp) FROM measurements WHERE timestamp < ?",
+                           (cutoff,)).fetchone()
+        if not raw[0]:
+            return 0
+        rolled = conn.execute("SELECT COALESCE(SUM(samples), 0) FROM rollup_1d WHERE bucket >= ? AND bucket < ?",
+                              (rollups.bucket_start(raw[1], 86400), cutoff)).fetchone()[0]
+        if rolled == raw[0]:
+            return 0
+        with conn:
+            return rollups.rebuild(conn, start=raw[1], end=cutoff - 1)
+    return run
+
+
+def _page_stats(conn):
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return page_size, page_count, freelist
+
+
+def _vacuum_step(pages):
+    def run(conn):
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # executescript, not execute: the sqlite3 module steps a statement once,
+        # and incremental_vacuum frees a single page per step
+        conn.executescript(f"PRAGMA incremental_vacuum({pages});")
+        return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return run
+
+
+class RetentionManager:
+    """Prunes old raw data in small transactions on the ingest writer thread.
+
+    Every DB step is submitted through writer.call(), so telemetry batches are
+    committed between chunks instead of waiting behind one huge DELETE.
+    """
+
+    def __init__(self, writer, retention_days=RETENTION_DAYS,
+                 rollup_1m_days=ROLLUP_1M_RETENTION_DAYS, log_days=LOG_RETENTION_DAYS,
+                 interval=RETENTION_INTERVAL, chunk=RETENTION_CHUNK):
+        self.writer = writer
+        self.retention_days = retention_days
+        self.rollup_1m_days = rollup_1m_days
+        self.log_days = log_days
+        self.interval = interval
+        self.chunk = chunk
+        self.stats = {"runs": 0, "failed": 0, "last_run": None, "last_report": None}
+        self._lock = threading.Lock()  # One run at a time (background thread vs debug endpoint)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _call(self, fn, timeout=300):
+        return self.writer.call(fn).result(timeout)
+
+    def _prune(self, table, column, cutoff):
+        deleted = 0
+        while not self._stop.is_set():
+            n = self._call(_delete_chunk(table, column, cutoff, self.chunk))
+            deleted += n
+            if n < self.chunk:
+                break
+        return deleted
+
+    def run_once(self, now=None):
+        """One full pass: rollup check, chunked deletes, incremental vacuum. Returns a report dict."""
+        with self._lock:
+            started = time.time()
+            now = now or started
+            # Whole local days only, so every rollup_1d bucket left behind is complete
+            raw_cutoff = rollups.bucket_start(now - self.retention_days * 86400, 86400)
+            page_size, pages_before, _ = self._call(_page_stats)
+
+            rebuilt = self._call(_ensure_rollups(raw_cutoff))
+            deleted = {
+                "measurements": self._prune("measurements", "timestamp", raw_cutoff),
+                "rollup_1m": self._prune("rollup_1m", "bucket", now - self.rollup_1m_days * 86400),
+                "logs": self._prune("logs", "timestamp", now - self.log_days * 86400),
+            }
+
+            released = 0
+            while not self._stop.is_set():
+                n = self._call(_vacuum_step(VACUUM_CHUNK_PAGES))
+                released += n
+                if n < VACUUM_CHUNK_PAGES:
+                    break
+            _, pages_after, freelist = self._call(_page_stats)
+            # Let the checkpoint move the shrunk pages back so the file itself gets smaller
+            self._call(lambda conn: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall())
+
+            report = {
+                "cutoff": raw_cutoff,
+                "deleted": deleted,
+                "rollup_samples_rebuilt": rebuilt,
+                "pages_released": released,
+                "reclaimed_bytes": (pages_before - pages_after) * page_size,
+                "db_bytes": pages_after * page_size,
+                "free_bytes": freelist * page_size,
+                "seconds": round(time.time() - started, 3),
+            }
+            self.stats["runs"] += 1
+            self.stats["last_run"] = started
+            self.stats["last_report"] = report
+            return report
+
+    # --- LIFECYCLE ---
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="retention")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                report = self.run_once()
+                total = sum(report["deleted"].values())
+                if total or report["reclaimed_bytes"]:
+                    print(f"Retention: deleted {total} rows, reclaimed {report['reclaimed_bytes'] / 1024:.1f} KB")
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Retention run failed: {e}")
@@ -0,0 +1,121 @@
+import threading
+
+# --- LIVE HISTORY CONFIGURATION ---
+MEASUREMENT_HISTORY_SIZE = 50  # Rows per device served by /api/data
+LOG_HISTORY_SIZE = 20          # Log lines kept per device (and for system-wide events)
+
+
+class RingBuffer:
+    """Fixed-capacity FIFO over a preallocated list; appends overwrite the oldest slot."""
+    __slots__ = ("capacity", "_items", "_head", "_size", "_lock")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = [None] * capacity
+        self._head = 0  # Next slot to write
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def append(self, item):
+        with self._lock:
+            self._items[self._head] = item
+            self._head = (self._head + 1) % self.capacity
+            if self._size < self.capacity:
+                self._size += 1
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def latest(self, n=None):
+        """Up to n most recent items, oldest first."""
+        with self._lock:
+            count = self._size if n is None else min(n, self._size)
+            start = (self._head - count) % self.capacity
+            if start + count <= self.capacity:
+                return self._items[start:start + count]
+            return self._items[start:] + self._items[:(start + count) % self.capacity]
+
+    def clear(self):
+        with self._lock:
+            self._items = [None] * self.capacity
+            self._head = 0
+            self._size = 0
+
+    def __len__(self):
+        return self._size
+
+
+class LiveHistory:
+    """Per-device ring buffers of recent measurements and logs, kept in API row format.
+
+    Filled by on_message / log_event as data arrives, so /api/data never has to
+    touch SQLite for its history and logs. The DB is only read by warm() at startup.
+    """
+
+    def __init__(self, measurement_size=MEASUREMENT_HISTORY_SIZE, log_size=LOG_HISTORY_SIZE):
+        self.measurement_size = measurement_size
+        self.log_size = log_size
+        self._measurements = {}  # device_id -> RingBuffer
+        self._logs = {}          # device_id (None = system-wide) -> RingBuffer
+        self._lock = threading.Lock()
+
+    def _buffer(self, table, key, size):
+        buf = table.get(key)
+        if buf is None:
+            with self._lock:
+                buf = table.get(key)
+                if buf is None:
+                    buf = RingBuffer(size)
+                    table[key] = buf
+        return buf
+
+    def add_measurement(self, row):
+        self._buffer(self._measurements, row["device_id"], self.measurement_size).append(row)
+
+    def add_log(self, row):
+        self._buffer(self._logs, row.get("device_id"), self.log_size).append(row)
+
+    def measurements(self, device_id, n=MEASUREMENT_HISTORY_SIZE):
+        """Most recent n rows for a device, chronological."""
+        buf = self._measurements.get(device_id)
+        return buf.latest(n) if buf else []
+
+    def logs(self, device_id=None, n=10):
+        """Most recent n log rows for a device plus system-wide events, newest first."""
+        rows = []
+        for key in {device_id, None}:
+            buf = self._logs.get(key)
+            if buf:
+                rows.extend(buf.latest(n))
+        rows.sort(key=lambda r: r["timestamp"], reverse=True)
+        return rows[:n]
+
+    def device_ids(self):
+        return list(self._measurements)
+
+    def clear(self):
+        with self._lock:
+            self._measurements = {}
+            self._logs = {}
+
+    def warm(self, conn):
+        """Loads the newest rows per device from the DB. Expects conn.row_factory = sqlite3.Row."""
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT device_id FROM measurements")
+        for (device_id,) in c.fetchall():
+            c.execute("SELECT * FROM measurements WHERE device_id = ? ORDER BY timestamp DESC LIMIT ?",
+                      (device_id, self.measurement_size))
+            for row in reversed(c.fetchall()):
+                self.add_measurement(dict(row))
+
+        c.execute("SELECT DISTINCT device_id FROM logs")
+        for (device_id,) in c.fetchall():
+            if device_id is None:
+                c.execute("SELECT * FROM logs WHERE device_id IS NULL ORDER BY timestamp DESC LIMIT ?",
+                          (self.log_size,))
+            else:
+                c.execute("SELECT * FROM logs WHERE device_id = ? ORDER BY timestamp DESC LIMIT ?",
+                          (device_id, self.log_size))
+            for row in reversed(c.fetchall()):
+                self.add_log(dict(row))
@@ -0,0 +1,186 @@
+import time
+
+from energy import ENERGY_MAX_GAP, interval_sql
+
+# --- ROLLUP CONFIGURATION ---
+# resolution -> (table, bucket size in seconds)
+RESOLUTIONS = {
+    "1m": ("rollup_1m", 60),
+    "1h": ("rollup_1h", 3600),
+    "1d": ("rollup_1d", 86400),
+}
+QUERY_LIMIT_MAX = 5000
+
+# Buckets are aligned to local wall-clock time (so "1d" matches daily_summary's
+# local dates and hours line up in half-hour timezones). The offset is fixed
+# for the life of the process so incremental updates and rebuilds agree.
+UTC_OFFSET = time.localtime().tm_gmtoff
+
+_AGG_COLUMNS = ("samples", "v_min", "v_max", "v_sum", "i_min", "i_max", "i_sum",
+                "p_min", "p_max", "p_sum", "energy_kwh", "fault_count")
+
+
+def bucket_start(ts, size):
+    return ts - ((ts + UTC_OFFSET) % size)
+
+
+def _where(clauses):
+    return (" WHERE " + " AND ".join(clauses)) if clauses else ""
+
+
+def aggregate(samples):
+    """Folds (device_id, ts, voltage, current, power, status, kwh) samples into
+    {(table, device_id, bucket): [samples, v_min, v_max, v_sum, ...]} for every resolution."""
+    buckets = {}
+    for device_id, ts, voltage, current, power, status, kwh in samples:
+        fault = 1 if status and "FAULT" in status else 0
+        for table, size in RESOLUTIONS.values():
+            key = (table, device_id, bucket_start(ts, size))
+            agg = buckets.get(key)
+            if agg is None:
+                buckets[key] = [1, voltage, voltage, voltage, current, current, current,
+                                power, power, power, kwh or 0.0, fault]
+            else:
+                agg[0] += 1
+                if voltage < agg[1]: agg[1] = voltage
+                if voltage > agg[2]: agg[2] = voltage
+                agg[3] += voltage
+                if current < agg[4]: agg[4] = current
+                if current > agg[5]: agg[5] = current
+                agg[6] += current
+                if power < agg[7]: agg[7] = power
+                if power > agg[8]: agg[8] = power
+                agg[9] += power
+                agg[10] += kwh or 0.0
+                agg[11] += fault
+    return buckets
+
+
+def _upsert_sql(table):
+    cols = ", ".join(_AGG_COLUMNS)
+    marks = ", ".join("?" for _ in _AGG_COLUMNS)
+    return (f"INSERT INTO {table} (device_id, bucket, {cols}) VALUES (?, ?, {marks}) "
+            "ON CONFLICT(device_id, bucket) DO UPDATE SET "
+            "samples = samples + excluded.samples, "
+            "v_min = MIN(v_min, excluded.v_min), v_max = MAX(v_max, excluded.v_max), v_sum = v_sum + excluded.v_sum, "
+            "i_min = MIN(i_min, excluded.i_min), i_max = MAX(i_max, excluded.i_max), i_sum = i_sum + excluded.i_sum, "
+            "p_min = MIN(p_min, excluded.p_min), p_max = MAX(p_max, excluded.p_max), p_sum = p_sum + excluded.p_sum, "
+            "energy_kwh = energy_kwh + excluded.energy_kwh, "
+            "fault_count = fault_count + excluded.fault_count")
+
+
+def apply(conn, buckets):
+    """Merges aggregate() output into the rollup tables. Call inside the writer's transaction."""
+    by_table = {}
+    for (table, device_id, bucket), agg in buckets.items():
+        by_table.setdefault(table, []).append((device_id, bucket, *agg))
+    for table, rows in by_table.items():
+        conn.executemany(_upsert_sql(table), rows)
+
+
+def rebuild(conn, device_id=None, start=None, end=None):
+    """Recomputes rollups from raw measurements for whole buckets overlapping [start, end).
+
+    Energy per sample is re-derived the same way ingestion does it (trapezoid
+    over the interval since the device's previous sample, gaps of
+    ENERGY_MAX_GAP or more ignored).
+    Returns the number of raw samples aggregated.
+
+    The range is clamped to the oldest raw sample still stored: rollups for
+    periods already pruned by retention are the only copy and are left alone.
+    """
+    oldest = conn.execute("SELECT MIN(timestamp) FROM measurements" +
+                          (" WHERE device_id = ?" if device_id else ""),
+                          (device_id,) if device_id else ()).fetchone()[0]
+    if oldest is None:
+        return 0
+    start = oldest if start is None else max(start, oldest)
+    scanned = 0
+    for table, size in RESOLUTIONS.values():
+        params = {"size": size, "off": UTC_OFFSET, "max_gap": ENERGY_MAX_GAP}
+        raw_where = []   # Wider window so the first sample in range still sees its predecessor
+        range_where = [] # The rows actually being rebuilt
+        bucket_where = []
+        if device_id:
+            raw_where.append("device_id = :device")
+            range_where.append("device_id = :device")
+            bucket_where.append("device_id = :device")
+            params["device"] = device_id
+        if start is not None:
+            params["lo"] = bucket_start(start, size)
+            raw_where.append("timestamp >= :lo - :max_gap")
+            range_where.append("timestamp >= :lo")
+            bucket_where.append("bucket >= :lo")
+        if end is not None:
+            params["hi"] = bucket_start(end, size) + size
+            raw_where.append("timestamp < :hi")
+            range_where.append("timestamp < :hi")
+            bucket_where.append("bucket < :hi")
+
+        conn.execute(f"DELETE FROM {table}{_where(bucket_where)}", params)
+        conn.execute(f'''
+            INSERT INTO {table} (device_id, bucket, {", ".join(_AGG_COLUMNS)})
+            SELECT device_id,
+                   CAST((timestamp + :off) / :size AS INTEGER) * :size - :off AS b,
+                   COUNT(*),
+                   MIN(voltage), MAX(voltage), SUM(voltage),
+                   MIN(current), MAX(current), SUM(current),
+                   MIN(power), MAX(power), SUM(power),
+                   SUM({interval_sql()}),
+                   SUM(CASE WHEN status LIKE '%FAULT%' THEN 1 ELSE 0 END)
+            FROM (
+                SELECT device_id, timestamp, voltage, current, power, status,
+                       timestamp - LAG(timestamp) OVER w AS dt,
+                       LAG(power) OVER w AS prev_power
+                FROM measurements{_where(raw_where)}
+                WINDOW w AS (PARTITION BY device_id ORDER BY timestamp)
+            ){_where(range_where)}
+            GROUP BY device_id, b''', params)
+        if table == "rollup_1m":
+            scanned = conn.execute(f"SELECT COALESCE(SUM(samples), 0) FROM {table}{_where(bucket_where)}",
+                                   params).fetchone()[0]
+    return scanned
+
+
+def is_empty(conn):
+    return conn.execute("SELECT 1 FROM rollup_1m LIMIT 1").fetchone() is None
+
+
+def query(conn, resolution, device_id=None, start=None, end=None, limit=500):
+    """Rollup buckets (oldest first) with min/mean/max per quantity.
+
+    Without device_id, buckets are merged across all devices.
+    """
+    table, size = RESOLUTIONS[resolution]
+    limit = max(1, min(int(limit), QUERY_LIMIT_MAX))
+    where = []
+    params = []
+    if device_id:
+        where.append("device_id = ?")
+        params.append(device_id)
+    if start is not None:
+        where.append("bucket >= ?")
+        params.append(bucket_start(start, size))
+    if end is not None:
+        where.append("bucket < ?")
+        params.append(end)
+    rows = conn.execute(f'''
+        SELECT bucket, SUM(samples), MIN(v_min), MAX(v_max), SUM(v_sum),
+               MIN(i_min), MAX(i_max), SUM(i_sum), MIN(p_min), MAX(p_max), SUM(p_sum),
+               SUM(energy_kwh), SUM(fault_count)
+        FROM {table}{_where(where)}
+        GROUP BY bucket ORDER BY bucket DESC LIMIT ?''', params + [limit]).fetchall()
+
+    result = []
+    for (bucket, n, v_min, v_max, v_sum, i_min, i_max, i_sum,
+         p_min, p_max, p_sum, energy, faults) in reversed(rows):
+        result.append({
+            "bucket": bucket,
+            "samples": n,
+            "voltage": {"min": v_min, "mean": v_sum / n, "max": v_max},
+            "current": {"min": i_min, "mean": i_sum / n, "max": i_max},
+            "power": {"min": p_min, "mean": p_sum / n, "max": p_max},
+            "energy_kwh": energy,
+            "fault_count": faults,
+        })
+    return result
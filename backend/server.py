@@ -3,118 +3,291 @@ import json
 import time
 import threading
 from datetime import datetime
-from flask import Flask, render_template, jsonify, request
+from flask import Blueprint, Flask, Response, render_template, jsonify, request
 from flask_cors import CORS
-import paho.mqtt.client as mqtt
-import google.generativeai as genai
-import requests
-import matplotlib
-matplotlib.use('Agg') # Non-interactive backend
-import matplotlib.pyplot as plt
-import io
+import atexit
 from dotenv import load_dotenv
+import energy
+from ai_cache import AICache, context_key
+from anomaly import AnomalyDetector
+from charts import CHART_TIMEOUT, ChartRenderer
+from classifier import LoadClassifier
+from codec import decode_payload
+from cluster import CLUSTER_ROLE, LeaderLock, Replica
+from context_builder import CONTEXT_WARM_DAYS, ContextBuilder, daily_lines, fit_to_budget, readings_lines
+import rollups
+import stats
+from db import connect, init_db
+from ingest import IngestWriter
+from recorder import DatasetRecorder
+from retention import RetentionManager
+from devices import DeviceRegistry, TELEMETRY_TOPIC, resolve_device_id
+from alerts import AlertDispatcher
+from jobs import JobManager, JobQueueFull, JobStore
+from ring_buffer import LiveHistory
+from stream import EventBroker, STREAM_RETRY_MS, format_event
 
 # Load environment variables
 load_dotenv()
 
-app = Flask(__name__)
-CORS(app)
+# Routes are registered on the app by create_app()
+bp = Blueprint('gridguard', __name__)
 
 # --- CONFIGURATION ---
-MQTT_BROKER = "broker.hivemq.com"
-MQTT_PORT = 1883
-MQTT_TOPIC = "gridguard/power/telemetry"
+MQTT_BROKER = os.getenv("MQTT_BROKER", "broker.hivemq.com")  # e.g. localhost for loadgen.py runs
+MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
+MQTT_TOPIC = TELEMETRY_TOPIC # gridguard/+/telemetry: one subscription for every board
 DATA_FILE = "energy_data.json"
 
 # Google Gemini
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") 
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+GEMINI_MODEL = 'gemini-3-pro-preview'
+GENAI_STREAM_CANCEL_VERSIONS = ("0.8.",)  # SDK releases cancel_ai_stream is tested against
+_genai = None
+
+# Generated reports/answers, reused while their data context is unchanged
+ai_cache = AICache()
+chat_stats = {"streamed": 0, "cancelled": 0, "cancel_unsupported": 0}  # Streaming chat answers / ones abandoned by the client
 
 # Telegram
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+NOTIFY_TIMEOUT = 120 # Seconds /api/notify waits for the dispatcher (covers retries)
 
 # --- GLOBAL STATE ---
-current_data = {
-    "voltage": 0,
-    "current": 0,
-    "power": 0,
-    "status": "OFFLINE",
-    "timestamp": 0
-}
-
-total_energy_kwh = 0.0
-last_update_time = time.time()
+# Live readings, session energy and fault state, per device
+devices = DeviceRegistry()
+
+# Per-device energy integration (trapezoid on device timestamps), restored from its checkpoint
+energy_meter = energy.EnergyMeter()
+
+# Streaming overcurrent / sag / swell / power-step checks (leader only: it owns logs and alerts)
+anomaly_detector = AnomalyDetector()
+
 COST_PER_KWH = 2.0 # INR per unit
-fault_alert_sent = False # Prevent spam
 
 import sqlite3
 
 # --- DATABASE SETUP ---
 DB_FILE = "power_monitor.db"
 
-def init_db():
-    print(f"--- DB CONFIGURATION ---")
-    print(f"DB Path: {os.path.abspath(DB_FILE)}")
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    # Measurements Table: High frequency data
-    c.execute('''CREATE TABLE IF NOT EXISTS measurements (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp REAL,
-                    voltage REAL,
-                    current REAL,
-                    power REAL,
-                    status TEXT
-                )''')
-    # Daily Summary Table: Aggregated kWh per day
-    c.execute('''CREATE TABLE IF NOT EXISTS daily_summary (
-                    date TEXT PRIMARY KEY,
-                    kwh REAL
-                )''')
-    # Logs Table: System events
-    c.execute('''CREATE TABLE IF NOT EXISTS logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp REAL,
-                    level TEXT,
-                    message TEXT
-                )''')
-    conn.commit()
-    conn.close()
+# Recent measurements/logs per device, served by /api/data without touching the DB
+live_history = LiveHistory()
 
-init_db()
+# Push channel for /api/stream subscribers
+event_broker = EventBroker()
 
-def log_event(level, message):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("INSERT INTO logs (timestamp, level, message) VALUES (?, ?, ?)", 
-              (time.time(), level, message))
-    conn.commit()
-    conn.close()
-    print(f"[{level}] {message}")
+def warm_live_history():
+    conn = connect(DB_FILE, row_factory=sqlite3.Row)
+    try:
+        live_history.clear()
+        live_history.warm(conn)
+    finally:
+        conn.close()
+    # Known boards show up (as OFFLINE) before they report again
+    for device_id in live_history.device_ids():
+        state = devices.get_or_create(device_id)
+        rows = live_history.measurements(device_id, 1)
+        if rows and not state.timestamp:
+            state.timestamp = rows[-1]["timestamp"]
+
+# Deduplicated log summary for AI prompts, fed by log_event
+context_builder = ContextBuilder()
+
+def warm_context_builder():
+    conn = connect(DB_FILE)
+    try:
+        context_builder.clear()
+        context_builder.warm(conn)
+    finally:
+        conn.close()
 
-def get_daily_kwh(date_str):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT kwh FROM daily_summary WHERE date = ?", (date_str,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else 0.0
+def load_energy_meter():
+    conn = connect(DB_FILE)
+    try:
+        energy_meter.clear()
+        energy_meter.load(conn)
+    finally:
+        conn.close()
+
+# Server-side load classification (model.tflite), run by the writer once per
+# flushed batch; stores predicted_class for boards without on-device ML
+load_classifier = LoadClassifier()
+
+# Single writer thread: all telemetry and log INSERTs go through its queue
+ingest_writer = IngestWriter(DB_FILE, classifier=load_classifier)
+
+def rebuild_rollups(conn, device_id=None, start=None, end=None):
+    """Runs on the writer thread (via ingest_writer.call) so it can't race incremental updates."""
+    with conn:
+        return rollups.rebuild(conn, device_id, start, end)
+
+def backfill_rollups(conn):
+    # First start after the rollup migration: derive them from existing raw data
+    if rollups.is_empty(conn):
+        scanned = rebuild_rollups(conn)
+        if scanned:
+            print(f"Rollups backfilled from {scanned} measurements")
 
-def update_daily_db(kwh_increment):
+# Hourly pruning of old raw rows (chunked, on the writer thread) + incremental vacuum
+retention_manager = RetentionManager(ingest_writer)
+
+# Background Telegram sender: never blocks the MQTT thread
+alert_dispatcher = AlertDispatcher(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID)
+
+# Labelled training data: per-device sessions, buffered in memory, written in
+# chunks under recordings/ (and appended to ml_dataset.csv for train_model.py)
+DATASET_FILE = "ml_dataset.csv"
+RECORDINGS_DIR = os.getenv("RECORDINGS_DIR", "recordings")
+dataset_recorder = DatasetRecorder(DB_FILE, RECORDINGS_DIR, dataset_csv=DATASET_FILE)
+
+# Bounded pool for report pipelines requested with "async": true (mirrored to
+# the jobs table so a status poll can land on any web worker)
+job_manager = JobManager(store=JobStore(DB_FILE))
+
+# Single chart worker (Figure API, no pyplot) with a PNG cache keyed by the plotted data
+chart_renderer = ChartRenderer()
+
+def log_event(level, message, device_id=None):
+    now = time.time()
+    ingest_writer.submit_log(now, level, message, device_id)
+    apply_log({"timestamp": now, "level": level, "message": message, "device_id": device_id})
+    if device_id:
+        print(f"[{level}] [{device_id}] {message}")
+    else:
+        print(f"[{level}] {message}")
+
+def get_genai():
+    """google.generativeai, imported and configured on first use (~1s to import)."""
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai
+        if GEMINI_API_KEY:
+            genai.configure(api_key=GEMINI_API_KEY)
+        _genai = genai
+    return _genai
+
+def apply_log(row):
+    """In-memory side of a log row (leader: from log_event; followers: from the replica)."""
+    live_history.add_log(row)
+    context_builder.add_log(row)
+    event_broker.publish("log", row, row["device_id"])
+
+def generate_ai_text(prompt):
+    """Single Gemini call site (swap genai.GenerativeModel for a stub in tests)."""
+    model = get_genai().GenerativeModel(GEMINI_MODEL)
+    return model.generate_content(prompt).text
+
+def cancel_ai_stream(response):
+    """Cancels a streaming generate_content request; True if it was cancelled.
+    The SDK has no public cancel, so this reaches its gRPC stream and is limited
+    to the versions test_stream_cancel.py covers. Elsewhere the request is left
+    to finish on its own and a warning says so."""
+    version = getattr(get_genai(), "__version__", "")
+    cancel = getattr(getattr(response, "_iterator", None), "cancel", None)
+    if not version.startswith(GENAI_STREAM_CANCEL_VERSIONS) or cancel is None:
+        if not chat_stats["cancel_unsupported"]:
+            print(f"WARNING: cannot cancel Gemini streams with google-generativeai {version or '?'}; "
+                  "abandoned chat answers run to completion")
+        chat_stats["cancel_unsupported"] += 1
+        return False
+    cancel()
+    return True
+
+def generate_ai_stream(prompt):
+    """Yields answer text as Gemini produces it. Closing the generator cancels the request."""
+    response = get_genai().GenerativeModel(GEMINI_MODEL).generate_content(prompt, stream=True)
+    finished = False
+    try:
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+        finished = True
+    finally:
+        if not finished:
+            cancel_ai_stream(response)
+
+def ai_context_key(kind, device_id, daily_usage, log_version, live, *extra):
+    """Digest of what a prompt is built from. Today's still-growing kWh is left
+    out (the TTL covers it); log_version is context_builder.version(), so a new
+    fault changes the key. The live snapshot counts at two significant figures
+    and its status, so "what am I using now?" follows the load without every
+    sample's noise making a new key."""
     today = datetime.now().strftime("%Y-%m-%d")
-    conn = sqlite3.connect(DB_FILE)
+    closed_days = {day: round(kwh, 4) for day, kwh in daily_usage.items() if day != today}
+    now = (live["status"],) + tuple(float(f"{live[k]:.2g}") for k in ("voltage", "current", "power"))
+    return context_key(kind, device_id, closed_days, log_version, now, *extra)
+
+def wants_job():
+    """True when the client asked for a background job ("async": true in the body, or ?async=1)."""
+    body = request.get_json(silent=True) or {}
+    return bool(body.get('async') or request.args.get('async'))
+
+def submit_job(kind, fn, key):
+    """Queues fn(job) and answers 202 with the job; identical in-flight requests share one job."""
+    try:
+        job = job_manager.submit(kind, fn, key)
+    except JobQueueFull as e:
+        return jsonify({"result": f"Error: Too many reports in progress ({e})"}), 503
+    return jsonify(job.to_dict()), 202
+
+def get_daily_kwh(date_str, device_id=None):
+    conn = connect(DB_FILE)
     c = conn.cursor()
-    # Upsert logic
-    c.execute("INSERT INTO daily_summary (date, kwh) VALUES (?, ?) ON CONFLICT(date) DO UPDATE SET kwh = kwh + ?", 
-              (today, kwh_increment, kwh_increment))
-    conn.commit()
+    if device_id:
+        c.execute("SELECT kwh FROM daily_summary WHERE device_id = ? AND date = ?", (device_id, date_str))
+    else:
+        c.execute("SELECT SUM(kwh) FROM daily_summary WHERE date = ?", (date_str,))
+    row = c.fetchone()
     conn.close()
+    return (row[0] or 0.0) if row else 0.0
+
+def get_daily_usage(c, device_id=None, limit=None):
+    """{date: kwh} in ascending date order, for one device or summed over all devices."""
+    query = "SELECT date, SUM(kwh) FROM daily_summary"
+    params = []
+    if device_id:
+        query += " WHERE device_id = ?"
+        params.append(device_id)
+    query += " GROUP BY date ORDER BY date DESC"
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    c.execute(query, params)
+    return dict(sorted((row[0], row[1]) for row in c.fetchall()))
+
+def device_where(device_id, condition=None):
+    """WHERE clause + params for an optional condition, scoped to one device if given."""
+    clauses = [f"({condition})"] if condition else []
+    params = []
+    if device_id:
+        clauses.append("device_id = ?")
+        params.append(device_id)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+def hourly_profile_lines(conn, device_id=None, hours=24):
+    """Compact load profile for AI prompts: one line per hour from the 1h rollups."""
+    rows = rollups.query(conn, "1h", device_id, start=time.time() - hours * 3600, limit=hours)
+    if not rows:
+        return ["No hourly data recorded in this window."]
+    lines = []
+    for row in rows:
+        hour = datetime.fromtimestamp(row['bucket']).strftime('%m-%d %H:00')
+        lines.append(f"{hour} | avg {row['power']['mean']:.1f} W | peak {row['power']['max']:.1f} W | "
+                     f"V {row['voltage']['min']:.0f}-{row['voltage']['max']:.0f} | "
+                     f"{row['energy_kwh']:.4f} kWh | faults {row['fault_count']}")
+    return lines
+
+def request_device_id():
+    """Optional device selector from ?device= or a JSON body "device" field."""
+    device_id = request.args.get('device')
+    if not device_id and request.is_json:
+        device_id = (request.get_json(silent=True) or {}).get('device')
+    return device_id or None
 
 def send_fault_alert(data):
-    """Sends a critical alert to Telegram."""
-    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
+    """Queues a critical alert to Telegram (at most one per device per cooldown window)."""
+    if not alert_dispatcher.enabled:
         print("Telegram credentials missing, cannot send alert.")
         return
 
@@ -122,7 +295,8 @@ def send_fault_alert(data):
         timestamp = datetime.fromtimestamp(data['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
         caption = f"🚨 *CRITICAL SYSTEM ALERT* 🚨\n\n"
         caption += f"⚠️ **Result:** Protective Relay TRIPPED\n"
-        caption += f"⏱ **Time:** {timestamp}\n\n"
+        caption += f"⏱ **Time:** {timestamp}\n"
+        caption += f"📟 **Device:** `{data['device_id']}`\n\n"
         caption += f"🔍 **Fault Details:**\n"
         caption += f"• Status: `{data['status']}`\n"
         caption += f"• Voltage: `{data['voltage']} V`\n"
@@ -131,16 +305,43 @@ def send_fault_alert(data):
         caption += f"🛡 **Action Taken:** Circuit broken to prevent hardware damage.\n"
         caption += f"🔧 **Recommendation:** Inspect load for short circuits before manual reset."
         
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        payload = {
-            "chat_id": TELEGRAM_CHAT_ID,
-            "text": caption,
-            "parse_mode": "Markdown"
-        }
-        requests.post(url, json=payload)
-        print("Telegram Fault Alert Sent!")
+        future = alert_dispatcher.send_message(caption, parse_mode="Markdown",
+                                               dedup_key=(data['device_id'], "fault"))
+        if future is not None:
+            print("Telegram Fault Alert Queued!")
+    except Exception as e:
+        print(f"Failed to queue Telegram alert: {e}")
+
+def send_anomaly_alert(event):
+    """Queues a Telegram alert for an anomaly (one per device and kind per cooldown window)."""
+    if not alert_dispatcher.enabled:
+        return
+    timestamp = datetime.fromtimestamp(event['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
+    text = (f"⚠️ *Anomaly on {event['device_id']}*\n\n"
+            f"{event['message']}\n"
+            f"⏱ **Time:** {timestamp}")
+    alert_dispatcher.send_message(text, parse_mode="Markdown", dedup_key=(event['device_id'], event['kind']))
+
+def check_anomalies(device_id, sample_ts, voltage, current, power, notify=True):
+    """Runs the streaming detector on one ingested sample; events go to logs, /api/stream and alerts.
+
+    Called after the sample is queued for the writer: a detector error costs
+    its events, never the measurement row. Followers run it on replicated
+    rows with notify=False, only for their own /api/stream clients: the
+    leader's log rows (replicated) and alerts are the record.
+    """
+    try:
+        events = anomaly_detector.update(device_id, sample_ts, voltage, current, power)
     except Exception as e:
-        print(f"Failed to send Telegram alert: {e}")
+        anomaly_detector.stats["errors"] += 1
+        print(f"Anomaly detector failed for {device_id}: {e}")
+        return
+    for event in events:
+        if notify:
+            log_event(event["level"], event["message"], device_id)
+        event_broker.publish("anomaly", event, device_id)
+        if notify and event["level"] == "WARNING":
+            send_anomaly_alert(event)
 
 # --- MQTT CLIENT ---
 def on_connect(client, userdata, flags, rc):
@@ -148,63 +349,153 @@ def on_connect(client, userdata, flags, rc):
     client.subscribe(MQTT_TOPIC)
 
 def on_message(client, userdata, msg):
-    global current_data, total_energy_kwh, last_update_time, fault_alert_sent
     try:
-        payload = json.loads(msg.payload.decode())
+        # JSON or a binary frame, told apart by the first byte
+        payload, payload_format = decode_payload(msg.payload)
+        payload_stats[payload_format] += 1
         now = time.time()
-        
-        # Calculate Energy
-        dt_hours = (now - last_update_time) / 3600.0
-        power = float(payload.get("power", 0))
-        
-        if dt_hours < 0.1: # simple outlier filter
-            energy_increment = (power * dt_hours) / 1000.0
-            total_energy_kwh += energy_increment
-            update_daily_db(energy_increment)
-        
-        last_update_time = now
-        
-        # Update Global State
-        status = payload.get("status", "UNKNOWN")
-        current_data = {
-            "voltage": payload.get("voltage", 0),
-            "current": payload.get("current", 0),
-            "power": power,
-            "status": status,
-            "timestamp": now
-        }
-
-        # Fault Handling Logic
-        if "FAULT" in status:
-            log_event("WARNING", f"Fault Detected: {status} at {power:.1f}W")
-            
-            # Send alert only if not already sent recently (Latch)
-            if not fault_alert_sent:
-                send_fault_alert(current_data)
-                fault_alert_sent = True
+        device_id = resolve_device_id(msg.topic, payload)
+        samples = payload.get("samples")
+        if samples is None:
+            ingest_reading(device_id, payload, now)
         else:
-            # Reset latch if system returns to normal
-            if fault_alert_sent and status == "OK":
-                fault_alert_sent = False
-                log_event("INFO", "System Status Normal - Fault Alert Reset")
-
-        # Save to DB
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("INSERT INTO measurements (timestamp, voltage, current, power, status) VALUES (?, ?, ?, ?, ?)",
-                  (now, current_data["voltage"], current_data["current"], current_data["power"], current_data["status"]))
-        conn.commit()
-        conn.close()
-
-        # Record for ML if active
-        record_data_point(current_data)
+            ingest_batch(device_id, samples, now)
+            payload_stats["batches"] += 1
+            payload_stats["batch_samples"] += len(samples)
             
     except Exception as e:
+        payload_stats["errors"] += 1
         print(f"Error parsing MQTT message: {e}")
 
-mqtt_client = mqtt.Client()
-mqtt_client.on_connect = on_connect
-mqtt_client.on_message = on_message
+def ingest_reading(device_id, payload, now):
+    """One reading per message (the original firmware format)."""
+    # Numbers or numeric strings; anything else raises and the message is dropped
+    voltage = float(payload.get("voltage", 0))
+    current = float(payload.get("current", 0))
+    power = float(payload.get("power", 0))
+    status = payload.get("status", "UNKNOWN")
+    # Device's own clock (arrival time if it sends none)
+    sample_ts = energy_meter.sample_time(payload, now)
+
+    energy_mark = energy_meter.snapshot(device_id)
+    state, energy_increment, fault_change = apply_measurement(
+        device_id, sample_ts, voltage, current, power, status, now)
+    live = state.live(now)
+
+    # Fault Handling Logic
+    if "FAULT" in status:
+        log_event("WARNING", f"Fault Detected: {status} at {power:.1f}W", device_id)
+        # The dispatcher's per-device cooldown suppresses repeats
+        send_fault_alert(live)
+    elif fault_change is False:
+        # Log recovery once when the device returns to normal
+        log_event("INFO", "System Status Normal - Fault Alert Reset", device_id)
+
+    # Queue for the batched writer (measurement row + daily kWh increment)
+    if not ingest_writer.submit_measurement(device_id, sample_ts, state.voltage, state.current,
+                                            state.power, status, energy_increment):
+        drop_energy(device_id, energy_mark, energy_increment)
+        return
+    check_anomalies(device_id, sample_ts, state.voltage, state.current, power)
+
+    # Record for ML if a session covers this device (buffered, no file I/O here)
+    dataset_recorder.record(device_id, [(sample_ts, state.voltage, state.current, state.power)])
+
+def ingest_batch(device_id, samples, now):
+    """A multi-sample frame: every sample goes through apply_measurement, oldest first.
+
+    Energy integrates between consecutive samples exactly as if they had
+    arrived one per message, and the rows reach the writer as one record.
+    Faults are logged once per frame (and again only after a recovery inside
+    it), so 10 Hz sampling doesn't mean ten warnings a second.
+    """
+    if not samples:
+        return
+    times = energy_meter.batch_times([s.get("timestamp") for s in samples], now)
+    # Parse the whole frame first: one bad value rejects it before any sample is applied
+    parsed = sorted([(sample_ts, float(s.get("voltage", 0)), float(s.get("current", 0)),
+                      float(s.get("power", 0)), s.get("status", "UNKNOWN"))
+                     for sample_ts, s in zip(times, samples)], key=lambda r: r[0])
+    energy_mark = energy_meter.snapshot(device_id)
+    rows = []
+    fault_logged = False
+    for sample_ts, voltage, current, power, status in parsed:
+        state, energy_increment, fault_change = apply_measurement(
+            device_id, sample_ts, voltage, current, power, status, now)
+        if "FAULT" in status:
+            if not fault_logged:
+                fault_logged = True
+                log_event("WARNING", f"Fault Detected: {status} at {power:.1f}W", device_id)
+                send_fault_alert(state.live(now))
+        elif fault_change is False:
+            fault_logged = False
+            log_event("INFO", "System Status Normal - Fault Alert Reset", device_id)
+        rows.append((device_id, sample_ts, state.voltage, state.current, state.power, status, energy_increment))
+
+    if not ingest_writer.submit_measurements(rows):
+        drop_energy(device_id, energy_mark, sum(r[6] for r in rows))
+        return
+    for _, sample_ts, voltage, current, power, _, _ in rows:
+        check_anomalies(device_id, sample_ts, voltage, current, power)
+    dataset_recorder.record(device_id, [r[1:5] for r in rows])
+
+def drop_energy(device_id, energy_mark, kwh):
+    """The writer queue was full and the rows were dropped: un-count their energy so the
+    in-memory meter matches the rows and checkpoint that get persisted. Safe on the
+    leader, whose MQTT thread is the only one integrating."""
+    energy_meter.restore(device_id, energy_mark)
+    devices.get_or_create(device_id).session_kwh -= kwh
+
+def apply_measurement(device_id, sample_ts, voltage, current, power, status, now):
+    """In-memory side of one sample: energy, live state, fault flag, caches and push events.
+
+    Runs for MQTT messages on the leader and for replicated rows on followers,
+    so every worker integrates the same samples in the same order. Returns
+    (state, energy_increment, fault_change); fault_change is True on entering a
+    fault, False on recovery, else None.
+    """
+    state = devices.get_or_create(device_id)
+
+    # Calculate Energy: trapezoid over device timestamps; gaps and out-of-order samples add nothing
+    energy_increment = energy_meter.integrate(device_id, sample_ts, power)
+    state.session_kwh += energy_increment
+    ai_cache.note_sample(device_id, sample_ts)  # New local day -> cached reports are stale
+
+    # Update Device State
+    state.voltage = voltage
+    state.current = current
+    state.power = power
+    state.status = status
+    state.timestamp = sample_ts
+    state.last_update = now
+
+    fault_change = None
+    if "FAULT" in status:
+        if not state.in_fault:
+            state.in_fault = fault_change = True
+            ai_cache.invalidate(device_id)
+    elif state.in_fault and status == "OK":
+        state.in_fault = fault_change = False
+    if fault_change is not None:
+        event_broker.publish("fault", {"device_id": device_id, "in_fault": fault_change, "status": status,
+                                       "timestamp": sample_ts}, device_id)
+
+    row = {"device_id": device_id, "timestamp": sample_ts, "voltage": voltage,
+           "current": current, "power": power, "status": status}
+    live_history.add_measurement(row)
+    event_broker.publish("measurement", {**row, "session_kwh": state.session_kwh}, device_id)
+    return state, energy_increment, fault_change
+
+def follow_measurement(row):
+    """Replica callback: a sample the leader has committed."""
+    apply_measurement(row["device_id"], row["timestamp"], row["voltage"], row["current"],
+                      row["power"], row["status"], time.time())
+    check_anomalies(row["device_id"], row["timestamp"], row["voltage"], row["current"], row["power"],
+                    notify=False)
+
+mqtt_client = None
+payload_stats = {"json": 0, "binary": 0, "errors": 0,  # Messages per telemetry format
+                 "batches": 0, "batch_samples": 0}     # Multi-sample frames (either format)
 
 def start_mqtt():
     try:
@@ -213,104 +504,282 @@ def start_mqtt():
     except Exception as e:
         log_event("ERROR", f"MQTT Connection Failed: {e}")
 
-mqtt_thread = threading.Thread(target=start_mqtt)
-mqtt_thread.daemon = True
-mqtt_thread.start()
+# --- CLUSTER (multi-worker servers) ---
+# One process per DB ingests (the lock holder); the rest follow the DB. A
+# single `python server.py` simply wins the election.
+cluster_role = None  # "leader" / "follower" once started
+leader_lock = LeaderLock(DB_FILE + ".leader")
+
+def start_ingestion():
+    """Leader only: MQTT intake, rollup backfill and retention."""
+    global cluster_role, mqtt_client
+    cluster_role = "leader"
+    load_energy_meter()
+    ingest_writer.call(backfill_rollups)
+    retention_manager.start()
+    dataset_recorder.start()
+
+    import paho.mqtt.client as mqtt
+    mqtt_client = mqtt.Client()
+    mqtt_client.on_connect = on_connect
+    mqtt_client.on_message = on_message
+    mqtt_thread = threading.Thread(target=start_mqtt, name="mqtt")
+    mqtt_thread.daemon = True
+    mqtt_thread.start()
+    print(f"Cluster: pid {os.getpid()} is the ingestion leader")
+
+# Followers replay committed rows through the same code path as MQTT; in "auto"
+# mode they also take over ingestion if the leader process exits
+replica = Replica(DB_FILE, follow_measurement, apply_log,
+                  lock=leader_lock if CLUSTER_ROLE == "auto" else None, on_promote=start_ingestion)
+
+def start_following():
+    global cluster_role
+    cluster_role = "follower"
+    conn = connect(DB_FILE)
+    try:
+        # One read snapshot: energy totals match the row the replica resumes after
+        conn.execute("BEGIN")
+        energy_meter.clear()
+        energy_meter.load(conn)
+        replica.seek(conn)
+        conn.rollback()
+    finally:
+        conn.close()
+    replica.start()
+    dataset_recorder.start(write=False)  # Session state for /api/data; the leader writes the files
+    print(f"Cluster: pid {os.getpid()} is following the database")
+
+# --- STARTUP / SHUTDOWN ---
+services_started = False
+
+def start_services():
+    """Opens the DB, warms in-memory state and starts the background threads (once)."""
+    global services_started
+    if services_started:
+        return
+    services_started = True
+
+    init_db(DB_FILE)
+    warm_live_history()
+    warm_context_builder()
+
+    # Every worker: debug tools/rebuilds write through the writer, reports send via Telegram
+    ingest_writer.start()
+    alert_dispatcher.start()
+
+    if CLUSTER_ROLE != "web" and leader_lock.acquire():
+        start_ingestion()
+    else:
+        start_following()
+
+    atexit.register(stop_services)
+
+def stop_services():
+    """Stops intake first, then the workers; the ingest writer last so queued rows are flushed."""
+    global services_started
+    if not services_started:
+        return
+    services_started = False
+    replica.stop()
+    if mqtt_client is not None:
+        mqtt_client.disconnect()
+    job_manager.stop()
+    chart_renderer.stop()
+    alert_dispatcher.stop()
+    retention_manager.stop()
+    dataset_recorder.stop()
+    ingest_writer.stop()
+    leader_lock.release()  # Only after the final flush: the next leader sees every row
+
+def create_app(start=True):
+    """Application factory. start=False gives an app without DB or background threads (tooling)."""
+    app = Flask(__name__)
+    CORS(app)
+    app.register_blueprint(bp)
+    if start:
+        start_services()
+    return app
 
 
 # --- ROUTES ---
-@app.route('/')
+@bp.route('/')
 def index():
     return render_template('index.html')
 
 # --- DATA RECORDING (Edge AI) ---
-recording_active = False
-recording_label = "LEVEL_1"
-DATASET_FILE = "ml_dataset.csv"
-
-@app.route('/api/record', methods=['POST'])
+# Sessions are recording_sessions rows, so any worker can start/stop one; the
+# ingestion leader's dataset_recorder picks them up and writes the samples
+def close_recording_sessions(conn, now, device_id=None):
+    """Ends open sessions: device_id's and the all-device one, or every session if None."""
+    if device_id is None:
+        conn.execute("UPDATE recording_sessions SET ended = ? WHERE ended IS NULL", (now,))
+    else:
+        conn.execute("UPDATE recording_sessions SET ended = ? WHERE ended IS NULL "
+                     "AND (device_id = ? OR device_id IS NULL)", (now, device_id))
+
+@bp.route('/api/record', methods=['GET'])
+def recording_sessions():
+    # Open sessions plus the latest ones with their recorded row counts (?limit=, default 20)
+    limit = max(1, min(request.args.get('limit', 20, type=int), 500))
+    conn = connect(DB_FILE)
+    try:
+        rows = conn.execute("SELECT id, label, device_id, started, ended FROM recording_sessions "
+                            "ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    finally:
+        conn.close()
+    sessions = []
+    for sid, label, device_id, started, ended in rows:
+        meta, _ = dataset_recorder.read_meta(sid)
+        sessions.append({"id": sid, "label": label, "device_id": device_id, "started": started,
+                         "ended": ended, "rows": meta["rows"] if meta else None,
+                         "format": meta["format"] if meta else None})
+    return jsonify({"active": dataset_recorder.active(), "sessions": sessions})
+
+@bp.route('/api/record', methods=['POST'])
 def toggle_recording():
-    global recording_active, recording_label
     req = request.json
     action = req.get('action') # 'start' or 'stop'
+    device_id = request_device_id()  # None: every board
+    now = time.time()
     
     if action == 'start':
         recording_label = req.get('label', 'LEVEL_1')
-        recording_active = True
-        return jsonify({"status": "Recording Started", "label": recording_label})
+        # The session row labels the DB measurements for ml/train_pipeline.py and
+        # the recorder's files. Overlapping sessions are ended first, so a sample
+        # never carries two labels: a device session ends that device's and the
+        # all-device one, an all-device session ends every other session.
+        conn = connect(DB_FILE)
+        try:
+            with conn:
+                close_recording_sessions(conn, now, device_id)
+                session_id = conn.execute(
+                    "INSERT INTO recording_sessions (label, device_id, started) VALUES (?, ?, ?)",
+                    (recording_label, device_id, now)).lastrowid
+        finally:
+            conn.close()
+        dataset_recorder.refresh()  # This worker at once; the leader's recorder polls the table
+        return jsonify({"status": "Recording Started", "label": recording_label,
+                        "session": session_id, "device_id": device_id})
     elif action == 'stop':
-        recording_active = False
-        return jsonify({"status": "Recording Stopped"})
+        conn = connect(DB_FILE)
+        try:
+            with conn:
+                close_recording_sessions(conn, now, device_id)
+        finally:
+            conn.close()
+        closed = dataset_recorder.refresh()
+        return jsonify({"status": "Recording Stopped", "sessions": [s.id for s in closed]})
     
     return jsonify({"status": "Invalid Action"}), 400
 
-# Helper to save data point
-def record_data_point(data):
-    if not recording_active: return
-    
-    file_exists = os.path.isfile(DATASET_FILE)
-    with open(DATASET_FILE, 'a') as f:
-        if not file_exists:
-            f.write("voltage,current,power,label\n") # Header
-        
-        # Save: V, I, P, Label
-        f.write(f"{data['voltage']:.2f},{data['current']:.3f},{data['power']:.2f},{recording_label}\n")
-
-@app.route('/api/data')
+@bp.route('/api/record/export')
+def export_recording():
+    """?session=<id>[&format=csv|npy]: one session's samples. Without a session: every
+    closed session in ml/train_model.py's CSV format (voltage,current,power,label)."""
+    session_id = request.args.get('session')
+    if session_id is None:
+        conn = connect(DB_FILE)
+        try:
+            ids = [r[0] for r in conn.execute(
+                "SELECT id FROM recording_sessions WHERE ended IS NOT NULL ORDER BY id").fetchall()]
+        finally:
+            conn.close()
+        return Response(dataset_recorder.export_dataset(ids), mimetype="text/csv",
+                        headers={"Content-Disposition": f"attachment; filename={DATASET_FILE}"})
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'npy'):
+        return jsonify({"error": "format must be csv or npy"}), 400
+    try:
+        exported = dataset_recorder.export(int(session_id), fmt)
+    except ValueError:
+        return jsonify({"error": "session must be an id"}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 501
+    if exported is None:
+        return jsonify({"error": f"no recorded data for session {session_id}"}), 404
+    data, mimetype, filename = exported
+    return Response(data, mimetype=mimetype, headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+@bp.route('/api/data')
 def get_data():
-    # Automatically mark device as offline if no updates received in 5 seconds
-    if time.time() - last_update_time > 5.0:
-        current_data["status"] = "OFFLINE"
-        current_data["voltage"] = 0
-        current_data["current"] = 0
-        current_data["power"] = 0
+    # ?device=<id> selects a board; default is whichever reported most recently.
+    # live() reports OFFLINE automatically if no updates received in 5 seconds.
+    state = devices.resolve(request_device_id())
+    device_id = state.device_id
 
     today = datetime.now().strftime("%Y-%m-%d")
-    today_kwh = get_daily_kwh(today)
+    today_kwh = get_daily_kwh(today, device_id)
     
-    # Get recent history from DB
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM measurements ORDER BY timestamp DESC LIMIT 50")
-    rows = c.fetchall()
-    history = [dict(row) for row in rows][::-1] # Reverse to be chronological
-    
-    # Get recent logs
-    c.execute("SELECT * FROM logs ORDER BY timestamp DESC LIMIT 10")
-    log_rows = c.fetchall()
-    logs = [dict(row) for row in log_rows]
-    
-    conn.close()
+    # Recent history (chronological) and logs (this device's plus system-wide
+    # events, newest first) come straight from the in-memory ring buffers
+    history = live_history.measurements(device_id, 50)
+    logs = live_history.logs(device_id, 10)
     
     return jsonify({
-        "live": current_data,
-        "session_kwh": total_energy_kwh,
+        "device_id": device_id,
+        "devices": devices.ids(),
+        "live": state.live(),
+        "session_kwh": state.session_kwh,
+        "total_kwh": energy_meter.total(device_id),
         "today_kwh": today_kwh,
         "bill": today_kwh * COST_PER_KWH,
         "history": history,
         "logs": logs,
-        "recording": recording_active
+        "recording": bool(dataset_recorder.active(device_id))
     })
 
-@app.route('/api/history')
+@bp.route('/api/stream')
+def stream():
+    """Server-Sent Events: measurement, log and fault events as they arrive.
+
+    ?device=<id> limits the stream to one board (system-wide logs are always
+    included). Reconnecting clients send Last-Event-ID and get what they missed,
+    or a "resync" event if it is no longer buffered.
+    """
+    device_id = request_device_id()
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    sub = event_broker.subscribe(device_id, last_event_id)
+
+    def generate():
+        try:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            yield from sub.frames()
+        finally:
+            event_broker.unsubscribe(sub)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/api/history')
 def get_history():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT date, kwh FROM daily_summary ORDER BY date DESC LIMIT 7")
-    rows = c.fetchall()
-    conn.close()
-    
-    # Convert to dict {date: kwh}
-    result = {row[0]: row[1] for row in rows}
-    # Sort by date ascending for chart
-    sorted_result = dict(sorted(result.items()))
-    return jsonify(sorted_result)
+    # ?device=<id> for one board; without it, data is summed across all devices
+    device_id = request_device_id()
+    resolution = request.args.get('resolution')
+    conn = connect(DB_FILE)
+    try:
+        if not resolution:
+            # {date: kwh}, sorted by date ascending for chart
+            return jsonify(get_daily_usage(conn.cursor(), device_id, limit=7))
+
+        # ?resolution=1m|1h|1d[&start=<unix>&end=<unix>&limit=<n>]: rollup buckets
+        if resolution not in rollups.RESOLUTIONS:
+            return jsonify({"error": f"resolution must be one of {sorted(rollups.RESOLUTIONS)}"}), 400
+        try:
+            start = request.args.get('start', type=float)
+            end = request.args.get('end', type=float)
+            limit = request.args.get('limit', 500, type=int)
+        except ValueError:
+            return jsonify({"error": "start, end and limit must be numbers"}), 400
+        buckets = rollups.query(conn, resolution, device_id, start, end, limit)
+        return jsonify({"resolution": resolution, "device_id": device_id, "buckets": buckets})
+    finally:
+        conn.close()
 
-@app.route('/api/debug/db')
+@bp.route('/api/debug/db')
 def debug_db():
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = connect(DB_FILE)
         c = conn.cursor()
         c.execute("SELECT * FROM daily_summary")
         rows = c.fetchall()
@@ -319,18 +788,110 @@ def debug_db():
     except Exception as e:
         return jsonify({"error": str(e)})
 
-@app.route('/api/debug/reset_data')
+@bp.route('/api/debug/ingest')
+def debug_ingest():
+    return jsonify({**ingest_writer.stats, "alive": ingest_writer.alive,
+                    "pending": ingest_writer.queue.qsize(), "payloads": payload_stats})
+
+@bp.route('/api/debug/alerts')
+def debug_alerts():
+    return jsonify({**alert_dispatcher.stats, "pending": alert_dispatcher.queue.qsize()})
+
+@bp.route('/api/debug/stream')
+def debug_stream():
+    return jsonify(event_broker.stats)
+
+@bp.route('/api/debug/rebuild_rollups')
+def debug_rebuild_rollups():
+    # ?device=&start=&end= to limit the rebuild; default is everything
+    try:
+        device_id = request_device_id()
+        start = request.args.get('start', type=float)
+        end = request.args.get('end', type=float)
+        t0 = time.time()
+        scanned = ingest_writer.call(lambda conn: rebuild_rollups(conn, device_id, start, end)).result(300)
+        return jsonify({"status": "Rebuild Complete", "samples": scanned,
+                        "seconds": round(time.time() - t0, 3)})
+    except Exception as e:
+        return jsonify({"error": str(e)})
+
+@bp.route('/api/debug/jobs')
+def debug_jobs():
+    return jsonify(job_manager.stats)
+
+@bp.route('/api/debug/charts')
+def debug_charts():
+    return jsonify(chart_renderer.stats)
+
+@bp.route('/api/debug/anomaly')
+def debug_anomaly():
+    return jsonify({**anomaly_detector.stats, "devices": anomaly_detector.snapshot()})
+
+@bp.route('/api/debug/classifier')
+def debug_classifier():
+    return jsonify(load_classifier.metrics())
+
+@bp.route('/api/debug/recorder')
+def debug_recorder():
+    return jsonify({**dataset_recorder.stats, "format": dataset_recorder.format,
+                    "active": dataset_recorder.active()})
+
+@bp.route('/api/debug/cluster')
+def debug_cluster():
+    return jsonify({"pid": os.getpid(), "role": cluster_role, "mode": CLUSTER_ROLE, "replica": replica.stats})
+
+@bp.route('/api/debug/ai_cache')
+def debug_ai_cache():
+    # ?clear=1 drops every cached answer
+    if request.args.get('clear'):
+        ai_cache.clear()
+    return jsonify({**ai_cache.stats, "chat": chat_stats, "context": context_builder.stats})
+
+@bp.route('/api/debug/energy')
+def debug_energy():
+    # Meter counters plus a recompute-from-raw check against rollup_1m
+    # (?device=&start=&end=, default the last 24h, rounded to whole minutes)
+    try:
+        device_id = request_device_id()
+        now = time.time()
+        start = rollups.bucket_start(request.args.get('start', now - 86400, type=float), 60)
+        end = rollups.bucket_start(request.args.get('end', now, type=float), 60)
+        conn = connect(DB_FILE)
+        try:
+            check = energy.compare_with_rollups(conn, device_id, start, end)
+        finally:
+            conn.close()
+        totals = {d: energy_meter.total(d) for d in devices.ids()}
+        return jsonify({**energy_meter.stats, "start": start, "end": end, "totals": totals, "check": check})
+    except Exception as e:
+        return jsonify({"error": str(e)})
+
+@bp.route('/api/debug/retention')
+def debug_retention():
+    # ?run=1 triggers a pass now; otherwise returns the last report
+    try:
+        if request.args.get('run'):
+            report = retention_manager.run_once()
+            return jsonify({"status": "Retention Complete", **report})
+        return jsonify({**retention_manager.stats, "retention_days": retention_manager.retention_days})
+    except Exception as e:
+        return jsonify({"error": str(e)})
+
+@bp.route('/api/debug/reset_data')
 def debug_reset_data():
     try:
         import random
         from datetime import timedelta
         
-        conn = sqlite3.connect(DB_FILE)
+        conn = connect(DB_FILE)
         c = conn.cursor()
         
         # 1. Clear Tables
         c.execute("DELETE FROM daily_summary")
         c.execute("DELETE FROM measurements")
+        c.execute("DELETE FROM energy_checkpoint")
+        for table, _ in rollups.RESOLUTIONS.values():
+            c.execute(f"DELETE FROM {table}")
         
         # 2. Seed 7 Days
         today = datetime.now().date()
@@ -361,6 +922,10 @@ def debug_reset_data():
         c.execute("SELECT count(*) FROM daily_summary")
         count = c.fetchone()[0]
         conn.close()
+        ingest_writer.call(rebuild_rollups).result(300)
+        warm_live_history()
+        load_energy_meter()
+        ai_cache.clear()
         
         return jsonify({
             "status": "Reset Complete", 
@@ -370,352 +935,419 @@ def debug_reset_data():
     except Exception as e:
         return jsonify({"error": str(e)})
 
-@app.route('/api/analyze', methods=['POST'])
+@bp.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+@bp.route('/api/analyze', methods=['POST'])
 def analyze_usage():
     if not GEMINI_API_KEY:
         return jsonify({"result": "Error: GEMINI_API_KEY not set in .env"}), 500
-        
+
+    # Optional "device" in the body scopes the report to one board
+    device_id = request_device_id()
+    if wants_job():
+        return submit_job("analyze", lambda job: run_analysis(device_id, job.update), ("analyze", device_id))
     try:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        
-        # Get Weekly Data
-        c.execute("SELECT date, kwh FROM daily_summary ORDER BY date DESC LIMIT 7")
-        weekly_rows = c.fetchall()
-        weekly_data = {row[0]: row[1] for row in weekly_rows}
-        
-        # Get ALL fault + warning logs
-        c.execute("SELECT * FROM logs WHERE level='WARNING' OR level='ERROR' ORDER BY timestamp DESC LIMIT 50")
-        fault_rows = c.fetchall()
-        all_faults = [dict(row) for row in fault_rows]
-        recent_faults = [f for f in all_faults if (time.time() - f['timestamp']) < 1800]
-        
-        # Get all info logs
-        c.execute("SELECT * FROM logs WHERE level='INFO' ORDER BY timestamp DESC LIMIT 20")
-        info_logs = [dict(row) for row in c.fetchall()]
-        
-        # Get last 100 measurements for full statistical analysis
-        c.execute("SELECT timestamp, voltage, current, power, status FROM measurements ORDER BY timestamp DESC LIMIT 100")
-        measurements = [dict(row) for row in c.fetchall()]
-        
+        return jsonify(run_analysis(device_id))
+    except Exception as e:
+        return jsonify({"result": f"AI Error: {str(e)}"}), 500
+
+def run_analysis(device_id, progress=lambda step: None):
+    """Deep-analysis pipeline behind /api/analyze; returns the response body."""
+    progress("Collecting data")
+    current_data = devices.resolve(device_id).live()
+
+    conn = connect(DB_FILE)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    
+    # Get Weekly Data
+    weekly_data = get_daily_usage(c, device_id, limit=7)
+    
+    # Fault + warning history, one line per distinct message (repeats counted, not listed)
+    fault_levels = ("WARNING", "ERROR")
+    week_ago = time.time() - CONTEXT_WARM_DAYS * 86400  # The prompt's "Last 7 Days"
+    fault_total = context_builder.count(device_id, fault_levels, since=week_ago)
+    recent_fault_count = context_builder.count(device_id, fault_levels, since=time.time() - 1800)
+
+    # Same closed days and fault log as a recent report -> serve that report
+    cache_key = ai_context_key("analyze", device_id, weekly_data, context_builder.version(device_id, fault_levels),
+                               current_data)
+    cached = ai_cache.get(cache_key)
+    if cached is not None:
         conn.close()
-        
-        today = datetime.now().strftime("%Y-%m-%d")
-        today_val = weekly_data.get(today, 0.0)
-        
-        # Pre-compute stats for richer context
-        if measurements:
-            voltages = [m['voltage'] for m in measurements]
-            currents = [m['current'] for m in measurements]
-            powers = [m['power'] for m in measurements]
-            avg_voltage = sum(voltages) / len(voltages)
-            avg_current = sum(currents) / len(currents)
-            avg_power = sum(powers) / len(powers)
-            peak_power = max(powers)
-            min_power = min(powers)
-            fault_count_in_measurements = sum(1 for m in measurements if 'FAULT' in m.get('status', ''))
-        else:
-            avg_voltage = avg_current = avg_power = peak_power = min_power = 0
-            fault_count_in_measurements = 0
-        
-        weekly_values = list(weekly_data.values())
-        weekly_avg = sum(weekly_values) / len(weekly_values) if weekly_values else 0
-        weekly_peak = max(weekly_values) if weekly_values else 0
-        weekly_min = min(weekly_values) if weekly_values else 0
-        projected_monthly_bill = weekly_avg * 30 * COST_PER_KWH
-        
-        prompt = f"""
-        You are a WORLD-CLASS power systems engineer and energy data scientist providing a comprehensive, professional-grade deep-dive analysis report for the "GridGuard Smart Power Management System". This report must be exhaustive, precise, and actionable. Leave absolutely nothing out.
-
-        =============================================
-        LIVE SYSTEM SNAPSHOT
-        =============================================
-        - Current Status: {current_data['status']}
-        - Live Voltage (RMS): {current_data['voltage']:.2f} V
-        - Live Current (RMS): {current_data['current']:.3f} A
-        - Live Power: {current_data['power']:.2f} W
-        - Today's Total Energy: {today_val:.4f} kWh
-        - Today's Cost: Rs.{today_val * COST_PER_KWH:.2f} (at Rs.{COST_PER_KWH}/kWh)
-
-        =============================================
-        STATISTICAL ANALYSIS (Last 100 Measurements)
-        =============================================
-        - Average Voltage: {avg_voltage:.2f} V
-        - Average Current: {avg_current:.3f} A
-        - Average Power Draw: {avg_power:.2f} W
-        - Peak Power Recorded: {peak_power:.2f} W
-        - Minimum Power Recorded: {min_power:.2f} W
-        - Fault Events in Sample: {fault_count_in_measurements} out of {len(measurements)} readings
-
-        =============================================
-        7-DAY ENERGY HISTORY (kWh per day)
-        =============================================
-        {json.dumps(weekly_data, indent=2)}
-
-        - 7-Day Average: {weekly_avg:.3f} kWh/day
-        - 7-Day Peak Day: {weekly_peak:.3f} kWh
-        - 7-Day Minimum Day: {weekly_min:.3f} kWh
-        - Projected Monthly Bill: Rs.{projected_monthly_bill:.2f}
-
-        =============================================
-        FAULT & WARNING LOG (All Time, Last 50)
-        =============================================
-        Total Faults/Warnings on Record: {len(all_faults)}
-        Faults in Last 30 Minutes: {len(recent_faults)}
-        Fault Log Details: {json.dumps(all_faults[:20], indent=2)}
-
-        =============================================
-        SYSTEM EVENTS LOG (INFO)
-        =============================================
-        {json.dumps(info_logs, indent=2)}
-
-        =============================================
-        FULL ANALYSIS REQUEST - MANDATORY SECTIONS
-        =============================================
-
-        Generate a FULL, DEEPLY DETAILED HTML report covering ALL of the following sections. Do not skip any section. Use rich formatting: headings with <h3 style="color:#00f2fe; margin-top:20px;">, sections with <div style="margin-bottom: 20px;">, key values in <b style="color:#4facfe">, lists with <ul style="padding-left: 20px;"><li>, and highlight faults with <span style="color:#ef4444">. 
-        
-        CRITICAL UI RULES: Your entire output will be injected into a dark-themed glassmorphism UI. NEVER use styling like `background: white` or `color: black` or generic `style="background-color: #ffffff;"` on any element. Do not wrap the report in a body or html tag. Just output the raw styled HTML sections.
+        return {"result": cached, "cached": True}
+    
+    # Last 24h of raw measurements as arrays (newest 100 rows if the device went quiet)
+    measurement_stats = stats.summarize(stats.recent_window(conn, device_id))
 
-        **SECTION 1: EXECUTIVE SUMMARY**
-        Provide a 3-4 sentence high-level verdict on the system's overall health, energy efficiency, and financial standing.
+    # 24h load profile from the hourly rollups (24 rows, not ~43k raw samples)
+    hourly_profile = hourly_profile_lines(conn, device_id)
+    
+    conn.close()
 
-        **SECTION 2: LIVE POWER STATE ANALYSIS**
-        Deeply analyze the current live readings. Is the voltage within acceptable Indian mains range (220-240V)? Is the current safe (below 0.35A trip threshold)? What does the power draw suggest about what appliance is likely connected? Are there any anomalies visible?
+    # Variable-size sections share the token budget; system events give way first
+    context = fit_to_budget({
+        "weekly": (daily_lines(weekly_data, newest_first=True), 4),
+        "hourly": (hourly_profile, 3),
+        "faults": (context_builder.log_lines(device_id, fault_levels, since=week_ago), 2),
+        "info": (context_builder.log_lines(device_id, ("INFO",)), 1),
+    }, sep="\n    ")
+    
+    today = datetime.now().strftime("%Y-%m-%d")
+    today_val = weekly_data.get(today, 0.0)
+    
+    weekly_values = list(weekly_data.values())
+    weekly_avg = sum(weekly_values) / len(weekly_values) if weekly_values else 0
+    weekly_peak = max(weekly_values) if weekly_values else 0
+    weekly_min = min(weekly_values) if weekly_values else 0
+    projected_monthly_bill = weekly_avg * 30 * COST_PER_KWH
+    
+    prompt = f"""
+    You are a WORLD-CLASS power systems engineer and energy data scientist providing a comprehensive, professional-grade deep-dive analysis report for the "GridGuard Smart Power Management System". This report must be exhaustive, precise, and actionable. Leave absolutely nothing out.
+
+    =============================================
+    LIVE SYSTEM SNAPSHOT
+    =============================================
+    - Current Status: {current_data['status']}
+    - Live Voltage (RMS): {current_data['voltage']:.2f} V
+    - Live Current (RMS): {current_data['current']:.3f} A
+    - Live Power: {current_data['power']:.2f} W
+    - Today's Total Energy: {today_val:.4f} kWh
+    - Today's Cost: Rs.{today_val * COST_PER_KWH:.2f} (at Rs.{COST_PER_KWH}/kWh)
+
+    =============================================
+    STATISTICAL ANALYSIS (Raw Measurements, Last 24 Hours)
+    =============================================
+    {stats.format_summary(measurement_stats)}
+
+    =============================================
+    24-HOUR LOAD PROFILE (hourly)
+    =============================================
+    {context['hourly']}
+
+    =============================================
+    7-DAY ENERGY HISTORY (kWh per day, newest first)
+    =============================================
+    {context['weekly']}
+
+    - 7-Day Average: {weekly_avg:.3f} kWh/day
+    - 7-Day Peak Day: {weekly_peak:.3f} kWh
+    - 7-Day Minimum Day: {weekly_min:.3f} kWh
+    - Projected Monthly Bill: Rs.{projected_monthly_bill:.2f}
+
+    =============================================
+    FAULT & WARNING LOG (Last 7 Days, newest first; "xN" = repeated N times)
+    =============================================
+    Total Faults/Warnings (Last 7 Days): {fault_total}
+    Faults in Last 30 Minutes: {recent_fault_count}
+    Fault Log Details:
+    {context['faults']}
+
+    =============================================
+    SYSTEM EVENTS LOG (INFO)
+    =============================================
+    {context['info']}
+
+    =============================================
+    FULL ANALYSIS REQUEST - MANDATORY SECTIONS
+    =============================================
+
+    Generate a FULL, DEEPLY DETAILED HTML report covering ALL of the following sections. Do not skip any section. Use rich formatting: headings with <h3 style="color:#00f2fe; margin-top:20px;">, sections with <div style="margin-bottom: 20px;">, key values in <b style="color:#4facfe">, lists with <ul style="padding-left: 20px;"><li>, and highlight faults with <span style="color:#ef4444">. 
+    
+    CRITICAL UI RULES: Your entire output will be injected into a dark-themed glassmorphism UI. NEVER use styling like `background: white` or `color: black` or generic `style="background-color: #ffffff;"` on any element. Do not wrap the report in a body or html tag. Just output the raw styled HTML sections.
 
-        **SECTION 3: FAULT & SAFETY INCIDENT ANALYSIS**
-        Provide a detailed post-mortem on every fault/warning event in the log. For EACH fault: what was the probable cause, when did it occur (human-readable timestamp), how severe was it, did the relay trip correctly? If there are zero faults, explain why the system is operating safely.
+    **SECTION 1: EXECUTIVE SUMMARY**
+    Provide a 3-4 sentence high-level verdict on the system's overall health, energy efficiency, and financial standing.
 
-        **SECTION 4: ENERGY CONSUMPTION DEEP DIVE (7-Day Trend)**
-        Analyze day-over-day trend (increasing/decreasing?). Identify the highest and lowest consumption days and speculate on the cause. Calculate the percentage deviation from the weekly average for each day. What does the consumption curve suggest about usage patterns (peak hours, weekday vs weekend)?
+    **SECTION 2: LIVE POWER STATE ANALYSIS**
+    Deeply analyze the current live readings. Is the voltage within acceptable Indian mains range (220-240V)? Is the current safe (below 0.35A trip threshold)? What does the power draw suggest about what appliance is likely connected? Are there any anomalies visible?
 
-        **SECTION 5: VOLTAGE & CURRENT STABILITY REPORT**
-        Based on the 100-measurement statistics: Is the voltage stable? Any significant sag or swell? Is the current profile smooth or erratic? Is the system under-loaded or running near capacity? Comment on the consistency of readings.
+    **SECTION 3: FAULT & SAFETY INCIDENT ANALYSIS**
+    Provide a detailed post-mortem on every fault/warning event in the log. For EACH fault: what was the probable cause, when did it occur (human-readable timestamp), how severe was it, did the relay trip correctly? If there are zero faults, explain why the system is operating safely.
 
-        **SECTION 6: FINANCIAL & BILLING ANALYSIS**
-        Provide a complete cost breakdown: Today's bill, projected weekly bill, projected monthly bill, projected annual bill (all in INR at Rs.{COST_PER_KWH}/kWh). Compare today's spend vs the 7-day average. State the carbon footprint implication (India grid avg: 0.82 kg CO2 per kWh).
+    **SECTION 4: ENERGY CONSUMPTION DEEP DIVE (7-Day Trend)**
+    Analyze day-over-day trend (increasing/decreasing?). Identify the highest and lowest consumption days and speculate on the cause. Calculate the percentage deviation from the weekly average for each day. What does the consumption curve suggest about usage patterns (peak hours, weekday vs weekend)?
 
-        **SECTION 7: PREDICTIVE RISK ASSESSMENT**
-        Based on all data: What is the risk level (LOW/MEDIUM/HIGH) of a fault occurring in the next 24 hours? Justify using the data. Are there patterns that suggest the relay may trip again? What preventive actions should be taken immediately?
+    **SECTION 5: VOLTAGE & CURRENT STABILITY REPORT**
+    Based on the measurement statistics (spread, percentiles, sag/swell counts): Is the voltage stable? Any significant sag or swell? Is the current profile smooth or erratic? Is the system under-loaded or running near capacity? Comment on the consistency of readings.
 
-        **SECTION 8: ACTIONABLE RECOMMENDATIONS**
-        Provide at least 5 specific, highly actionable recommendations to reduce energy consumption, improve safety, optimize costs, and maintain system health. Each recommendation must reference the actual data values above.
+    **SECTION 6: FINANCIAL & BILLING ANALYSIS**
+    Provide a complete cost breakdown: Today's bill, projected weekly bill, projected monthly bill, projected annual bill (all in INR at Rs.{COST_PER_KWH}/kWh). Compare today's spend vs the 7-day average. State the carbon footprint implication (India grid avg: 0.82 kg CO2 per kWh).
 
-        **SECTION 9: SYSTEM HEALTH SCORECARD**
-        Rate the system on a 0-100 scale for: Safety, Energy Efficiency, Voltage Stability, Cost Optimization, and Overall Health. Display as an HTML table (<table style="width:100%;border-collapse:collapse;">) with scores and a brief one-line justification for each.
+    **SECTION 7: PREDICTIVE RISK ASSESSMENT**
+    Based on all data: What is the risk level (LOW/MEDIUM/HIGH) of a fault occurring in the next 24 hours? Justify using the data. Are there patterns that suggest the relay may trip again? What preventive actions should be taken immediately?
 
-        This is a hackathon submission report. Make it world-class. Be thorough, precise, and technically impressive.
-        """
-        
-        model = genai.GenerativeModel('gemini-3-pro-preview')
-        response = model.generate_content(prompt)
-        # Strip markdown code fences if Gemini wraps output in ```html ... ```
-        result_text = response.text.strip()
-        if result_text.startswith('```'):
-            result_text = result_text.split('\n', 1)[-1]  # Remove first line (```html)
-            result_text = result_text.rsplit('```', 1)[0]  # Remove trailing ```
-        return jsonify({"result": result_text})
-        
-    except Exception as e:
-        return jsonify({"result": f"AI Error: {str(e)}"}), 500
+    **SECTION 8: ACTIONABLE RECOMMENDATIONS**
+    Provide at least 5 specific, highly actionable recommendations to reduce energy consumption, improve safety, optimize costs, and maintain system health. Each recommendation must reference the actual data values above.
 
-@app.route('/api/chat', methods=['POST'])
+    **SECTION 9: SYSTEM HEALTH SCORECARD**
+    Rate the system on a 0-100 scale for: Safety, Energy Efficiency, Voltage Stability, Cost Optimization, and Overall Health. Display as an HTML table (<table style="width:100%;border-collapse:collapse;">) with scores and a brief one-line justification for each.
+
+    This is a hackathon submission report. Make it world-class. Be thorough, precise, and technically impressive.
+    """
+    
+    progress("Generating AI report")
+    # Strip markdown code fences if Gemini wraps output in ```html ... ```
+    result_text = generate_ai_text(prompt).strip()
+    if result_text.startswith('```'):
+        result_text = result_text.split('\n', 1)[-1]  # Remove first line (```html)
+        result_text = result_text.rsplit('```', 1)[0]  # Remove trailing ```
+    ai_cache.put(cache_key, result_text, device_id)
+    return {"result": result_text}
+    
+
+@bp.route('/api/chat', methods=['POST'])
 def chat():
     if not GEMINI_API_KEY:
         return jsonify({"result": "Error: GEMINI_API_KEY not set in .env"}), 500
-        
+
+    req_data = request.json or {}
+    user_message = req_data.get('message', '')
+    if not user_message:
+        return jsonify({"result": "Error: No message provided"}), 400
+    device_id = req_data.get('device') or None
+
     try:
-        req_data = request.json or {}
-        user_message = req_data.get('message', '')
-        
-        if not user_message:
-            return jsonify({"result": "Error: No message provided"}), 400
-            
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        
-        # Gathering Context
-        # 1. Weekly Data
-        c.execute("SELECT date, kwh FROM daily_summary ORDER BY date DESC LIMIT 7")
-        weekly_data = {row[0]: row[1] for row in c.fetchall()}
-        
-        # 2. Recent Events/Faults (last 2 hours)
-        two_hours_ago = time.time() - 7200
-        c.execute("SELECT * FROM logs WHERE timestamp > ? ORDER BY timestamp DESC LIMIT 20", (two_hours_ago,))
-        recent_logs = [dict(row) for row in c.fetchall()]
-        
-        # 3. Latest Measurements
-        c.execute("SELECT timestamp, voltage, current, power, status FROM measurements ORDER BY timestamp DESC LIMIT 10")
-        recent_measurements = [dict(row) for row in c.fetchall()]
-        
-        conn.close()
-        
-        today = datetime.now().strftime("%Y-%m-%d")
-        today_val = weekly_data.get(today, 0.0)
-        
-        # Construct the Prompt
-        prompt = f"""
-        You are a professional energy data analyst for the "GridGuard Smart Power Monitor" IoT system. You have direct access to the system's live sensor telemetry and its historical database. You are NOT a chatbot — you are a specialist who interprets measurements and gives sharp, data-driven, structured responses.
-
-        Your tone: Confident, professional, and precise. Explain things like a senior electrical engineer talking to a non-technical homeowner. Use relevant emojis where helpful. Always back your answers with specific numbers from the data below.
-
-        === LIVE SENSOR TELEMETRY ===
-        System Status: {current_data['status']}
-        Measured Voltage (RMS): {current_data['voltage']:.2f} V
-        Measured Current (RMS): {current_data['current']:.3f} A
-        Measured Real Power: {current_data['power']:.2f} W
-        Today's Total Energy (from DB): {today_val:.4f} kWh
-
-        === 7-DAY ENERGY DATABASE (kWh/day) ===
-        {json.dumps(weekly_data, indent=2)}
-
-        === RECENT SYSTEM EVENT LOGS (Last 2 hours) ===
-        {json.dumps(recent_logs, indent=2)}
-
-        === LAST 10 SENSOR READINGS ===
-        {json.dumps(recent_measurements, indent=2)}
-
-        === USER'S QUESTION ===
-        {user_message}
-
-        === STRICT RESPONSE RULES ===
-        1. Answer ONLY using the sensor telemetry, database records above, and your own real-world electrical/energy expertise.
-        2. NEVER reference the dashboard code, how the app is built, configuration constants, or "what the system is set to". You have no knowledge of source code or software constants. You only see measurements and database records.
-        3. For questions about electricity rates in India: use your real-world knowledge of DISCOM tariffs, slab structures, and state averages. Do NOT invent a single rate — explain the slab-based reality (e.g. MSEDCL, BESCOM, TNEB rates).
-        4. For cost/billing questions: use the kWh values from the DB. Apply the standard Tier-2 residential rate (Rs. 6-8/kWh) for realistic estimates. Always show the calculation step by step.
-        5. For fault/safety questions: quote the exact log entries. State the exact measured current and voltage that triggered the fault.
-        6. For trend analysis: compute exact % changes day-over-day. Identify peak and trough days by name with values.
-        7. If the system is OFFLINE (all live readings = 0), acknowledge it plainly, then shift focus to the historical data.
-        8. Format: Use **bold** for every key number/value. Use bullet points (- ) for lists. Use ### for section headings in multi-part answers.
-        9. Use Markdown ONLY. Never use HTML tags.
-        10. Write like a brief analyst report — structured, precise, and actionable. Never give a lazy one-liner for a real question.
-        """
-        
-        # Use gemini-3-pro-preview for consistency with other working endpoints
-        model = genai.GenerativeModel('gemini-3-pro-preview')
-        response = model.generate_content(prompt)
-        
-        return jsonify({"result": response.text})
+        prompt, cache_key, cached = build_chat_prompt(device_id, user_message)
+        if req_data.get('stream'):
+            # "stream": true -> Server-Sent Events, one "delta" per model chunk
+            return Response(stream_chat(prompt, cache_key, cached, device_id), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        if cached is not None:
+            return jsonify({"result": cached, "cached": True})
+
+        result_text = generate_ai_text(prompt)
+        ai_cache.put(cache_key, result_text, device_id)
+        return jsonify({"result": result_text})
         
     except Exception as e:
         import traceback
         traceback.print_exc()
         return jsonify({"result": f"AI Error: {str(e)}"}), 500
 
-# --- HELPER: Generate Chart Image ---
-def generate_chart_image(data_dict):
-    """Generates a dark-themed bar chart for the given data {date: kwh}."""
-    dates = list(data_dict.keys())
-    values = list(data_dict.values())
+def stream_chat(prompt, cache_key, cached, device_id):
+    """SSE frames for a chat answer. Closing the generator (client gone) stops the model stream."""
+    if cached is not None:
+        yield format_event(1, "delta", json.dumps({"text": cached}))
+        yield format_event(2, "done", json.dumps({"cached": True}))
+        return
+    chat_stats["streamed"] += 1
+    chunks = generate_ai_stream(prompt)
+    parts = []
+    finished = False
+    try:
+        for text in chunks:
+            parts.append(text)
+            yield format_event(len(parts), "delta", json.dumps({"text": text}))
+        finished = True
+        ai_cache.put(cache_key, "".join(parts), device_id)
+        yield format_event(len(parts) + 1, "done", json.dumps({"cached": False}))
+    except Exception as e:
+        finished = True
+        yield format_event(len(parts) + 1, "error", json.dumps({"result": f"AI Error: {str(e)}"}))
+    finally:
+        if not finished:
+            chat_stats["cancelled"] += 1
+        chunks.close()
+
+def build_chat_prompt(device_id, user_message):
+    """Chat context + prompt; returns (prompt, cache_key, cached_answer_or_None)."""
+    current_data = devices.resolve(device_id).live()
+
+    conn = connect(DB_FILE)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
     
-    # Setup Dark Theme
-    plt.style.use('dark_background')
-    fig, ax = plt.subplots(figsize=(10, 5))
+    # Gathering Context
+    # 1. Weekly Data
+    weekly_data = get_daily_usage(c, device_id, limit=7)
     
-    # Plot Bars
-    bars = ax.bar(dates, values, color='#4facfe', edgecolor='#00f2fe')
+    # Same question over the same closed days and event log -> cached answer
+    question = " ".join(user_message.lower().split())
+    cache_key = ai_context_key("chat", device_id, weekly_data, context_builder.version(device_id), current_data,
+                               question)
+    cached = ai_cache.get(cache_key)
+    if cached is not None:
+        conn.close()
+        return None, cache_key, cached
     
-    # Styling
-    ax.set_title('Energy Consumption History', fontsize=16, color='white', pad=20)
-    ax.set_ylabel('Energy (kWh)', fontsize=12, color='#94a3b8')
-    ax.tick_params(axis='x', rotation=45, colors='#94a3b8')
-    ax.tick_params(axis='y', colors='#94a3b8')
-    ax.spines['top'].set_visible(False)
-    ax.spines['right'].set_visible(False)
-    ax.spines['bottom'].set_color('#334155')
-    ax.spines['left'].set_color('#334155')
+    # 2. Latest Measurements
+    where, params = device_where(device_id)
+    c.execute(f"SELECT timestamp, voltage, current, power, status FROM measurements{where} "
+              "ORDER BY timestamp DESC LIMIT 10", params)
+    recent_measurements = [dict(row) for row in c.fetchall()]
+
+    # 3. Hourly load profile (from rollups)
+    hourly_profile = hourly_profile_lines(conn, device_id)
+
+    # 4. 24h statistics over the raw measurements
+    measurement_stats = stats.summarize(stats.recent_window(conn, device_id))
     
-    # Add Value Labels
-    for bar in bars:
-        height = bar.get_height()
-        ax.text(bar.get_x() + bar.get_width()/2., height,
-                f'{height:.2f}',
-                ha='center', va='bottom', color='white', fontsize=10)
+    conn.close()
+
+    # 5. Recent events (last 2 hours, deduplicated), all sections fitted to the token budget
+    context = fit_to_budget({
+        "weekly": (daily_lines(weekly_data, newest_first=True), 4),
+        "readings": (readings_lines(recent_measurements), 3),
+        "hourly": (hourly_profile, 2),
+        "logs": (context_builder.log_lines(device_id, since=time.time() - 7200), 1),
+    }, sep="\n    ")
     
-    plt.tight_layout()
+    today = datetime.now().strftime("%Y-%m-%d")
+    today_val = weekly_data.get(today, 0.0)
     
-    # Save to Buffer
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=100, transparent=True)
-    buf.seek(0)
-    plt.close(fig)
-    return buf
-
-@app.route('/api/notify', methods=['POST'])
+    # Construct the Prompt
+    prompt = f"""
+    You are a professional energy data analyst for the "GridGuard Smart Power Monitor" IoT system. You have direct access to the system's live sensor telemetry and its historical database. You are NOT a chatbot — you are a specialist who interprets measurements and gives sharp, data-driven, structured responses.
+
+    Your tone: Confident, professional, and precise. Explain things like a senior electrical engineer talking to a non-technical homeowner. Use relevant emojis where helpful. Always back your answers with specific numbers from the data below.
+
+    === LIVE SENSOR TELEMETRY ===
+    System Status: {current_data['status']}
+    Measured Voltage (RMS): {current_data['voltage']:.2f} V
+    Measured Current (RMS): {current_data['current']:.3f} A
+    Measured Real Power: {current_data['power']:.2f} W
+    Today's Total Energy (from DB): {today_val:.4f} kWh
+
+    === 7-DAY ENERGY DATABASE (kWh/day, newest first) ===
+    {context['weekly']}
+
+    === RECENT SYSTEM EVENT LOGS (Last 2 hours, newest first; "xN" = repeated N times) ===
+    {context['logs']}
+
+    === LAST 10 SENSOR READINGS (newest first) ===
+    {context['readings']}
+
+    === 24-HOUR LOAD PROFILE (hourly) ===
+    {context['hourly']}
+
+    === 24-HOUR MEASUREMENT STATISTICS ===
+    {stats.format_summary(measurement_stats)}
+
+    === USER'S QUESTION ===
+    {user_message}
+
+    === STRICT RESPONSE RULES ===
+    1. Answer ONLY using the sensor telemetry, database records above, and your own real-world electrical/energy expertise.
+    2. NEVER reference the dashboard code, how the app is built, configuration constants, or "what the system is set to". You have no knowledge of source code or software constants. You only see measurements and database records.
+    3. For questions about electricity rates in India: use your real-world knowledge of DISCOM tariffs, slab structures, and state averages. Do NOT invent a single rate — explain the slab-based reality (e.g. MSEDCL, BESCOM, TNEB rates).
+    4. For cost/billing questions: use the kWh values from the DB. Apply the standard Tier-2 residential rate (Rs. 6-8/kWh) for realistic estimates. Always show the calculation step by step.
+    5. For fault/safety questions: quote the exact log entries. State the exact measured current and voltage that triggered the fault.
+    6. For trend analysis: compute exact % changes day-over-day. Identify peak and trough days by name with values.
+    7. If the system is OFFLINE (all live readings = 0), acknowledge it plainly, then shift focus to the historical data.
+    8. Format: Use **bold** for every key number/value. Use bullet points (- ) for lists. Use ### for section headings in multi-part answers.
+    9. Use Markdown ONLY. Never use HTML tags.
+    10. Write like a brief analyst report — structured, precise, and actionable. Never give a lazy one-liner for a real question.
+    """
+    return prompt, cache_key, None
+
+# --- HELPER: Report Range ---
+def report_days(device_id, scope):
+    """{date: kwh} for a report: the last 7 days for scope 'recent', else the full history."""
+    conn = connect(DB_FILE)
+    c = conn.cursor()
+    daily_usage = get_daily_usage(c, device_id)
+    conn.close()
+
+    sorted_days = sorted(daily_usage.keys())
+    if scope == 'recent':
+        target_days = sorted_days[-7:]
+    else:
+        target_days = sorted_days # Full history
+    return {day: daily_usage[day] for day in target_days}
+
+@bp.route('/api/chart')
+def get_chart():
+    """PNG of daily kWh (?scope=recent|full, ?device=); same image the Telegram report sends."""
+    scope = request.args.get('scope', 'recent')
+    data_slice = report_days(request_device_id(), scope)
+    if not data_slice:
+        return jsonify({"error": "No data available"}), 404
+    try:
+        png = chart_renderer.png(data_slice)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    return Response(png, mimetype='image/png', headers={'Cache-Control': 'no-cache'})
+
+@bp.route('/api/notify', methods=['POST'])
 def send_bill_telegram():
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         return jsonify({"result": "Error: Telegram credentials not set in .env"}), 500
-        
-    try:
-        req_data = request.json or {}
-        scope = req_data.get('scope', 'recent') # 'recent' or 'full'
-        
-        # 1. Select Data Range
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("SELECT date, kwh FROM daily_summary")
-        rows = c.fetchall()
-        conn.close()
-        daily_usage = {row[0]: row[1] for row in rows}
 
-        sorted_days = sorted(daily_usage.keys())
-        if scope == 'recent':
-            target_days = sorted_days[-7:]
-        else:
-            target_days = sorted_days # Full history
-            
-        data_slice = {day: daily_usage[day] for day in target_days}
-        
-        if not data_slice:
-             return jsonify({"result": "No data available to report."})
+    req_data = request.json or {}
+    scope = req_data.get('scope', 'recent') # 'recent' or 'full'
+    device_id = req_data.get('device') or None
+    if wants_job():
+        return submit_job("notify", lambda job: run_report(device_id, scope, job.update),
+                          ("notify", device_id, scope))
+    try:
+        return jsonify(run_report(device_id, scope))
+    except Exception as e:
+        return jsonify({"result": f"Error: {str(e)}"}), 500
 
-        # 2. Generate Chart
-        img_buf = generate_chart_image(data_slice)
-        
-        # 3. AI Analysis (Gemini)
-        today = datetime.now().strftime("%Y-%m-%d")
-        total_kwh = sum(data_slice.values())
-        avg_kwh = total_kwh / len(data_slice) if len(data_slice) > 0 else 0
-        
-        ai_prompt = f"""
-        Analyze this energy usage data for a smart home system:
-        {json.dumps(data_slice, indent=2)}
-        
-        Task:
-        1. Identify any **abnormal behavior** (e.g. sudden spikes, zero usage days).
-        2. Compare the trend (Increasing/Decreasing?).
-        3. Rate the "Energy Efficiency" (0-100%).
-        4. Keep it concise (max 100 words) and formatted for a Telegram Caption (No Markdown headers like ##).
-        5. Start with a bold title line like *Energy Insight*.
-        """
-        
-        ai_text = "Analysis Unavailable"
-        if GEMINI_API_KEY:
-            try:
-                # Deep analysis context
-                conn2 = sqlite3.connect(DB_FILE)
+def run_report(device_id, scope, progress=lambda step: None):
+    """Chart + AI analysis + Telegram pipeline behind /api/notify; returns the response body."""
+    progress("Collecting data")
+    current_data = devices.resolve(device_id).live()
+    
+    # 1. Select Data Range
+    data_slice = report_days(device_id, scope)
+    if not data_slice:
+        return {"result": "No data available to report."}
+    target_days = list(data_slice.keys())
+
+    # 2. Generate Chart (render worker; cached when this range was charted before)
+    progress("Rendering chart")
+    chart = chart_renderer.submit(data_slice)
+    
+    # 3. AI Analysis (Gemini)
+    today = datetime.now().strftime("%Y-%m-%d")
+    total_kwh = sum(data_slice.values())
+    avg_kwh = total_kwh / len(data_slice) if len(data_slice) > 0 else 0
+    
+    day_context = fit_to_budget({"days": (daily_lines(data_slice, newest_first=True), 1)}, sep="\n    ")
+    ai_prompt = f"""
+    Analyze this energy usage data for a smart home system:
+    {day_context['days']}
+    
+    Task:
+    1. Identify any **abnormal behavior** (e.g. sudden spikes, zero usage days).
+    2. Compare the trend (Increasing/Decreasing?).
+    3. Rate the "Energy Efficiency" (0-100%).
+    4. Keep it concise (max 100 words) and formatted for a Telegram Caption (No Markdown headers like ##).
+    5. Start with a bold title line like *Energy Insight*.
+    """
+    
+    ai_text = "Analysis Unavailable"
+    if GEMINI_API_KEY:
+        progress("Generating AI analysis")
+        try:
+            # Deep analysis context
+            fault_levels = ("WARNING", "ERROR")
+            cache_key = ai_context_key("notify", device_id, data_slice,
+                                       context_builder.version(device_id, fault_levels), current_data, scope)
+            ai_text = ai_cache.get(cache_key)
+            if ai_text is None:
+                conn2 = connect(DB_FILE)
                 conn2.row_factory = sqlite3.Row
-                c2 = conn2.cursor()
-                c2.execute("SELECT * FROM logs WHERE level='WARNING' OR level='ERROR' ORDER BY timestamp DESC LIMIT 50")
-                all_faults = [dict(row) for row in c2.fetchall()]
-                c2.execute("SELECT timestamp, voltage, current, power, status FROM measurements ORDER BY timestamp DESC LIMIT 100")
-                measurements = [dict(row) for row in c2.fetchall()]
+                measurement_stats = stats.summarize(stats.recent_window(conn2, device_id))
+                hourly_profile = hourly_profile_lines(conn2, device_id)
                 conn2.close()
 
+                # Full-history reports can span months: newest days are kept first
+                context = fit_to_budget({
+                    "days": (daily_lines(data_slice, newest_first=True), 3),
+                    "hourly": (hourly_profile, 2),
+                    "faults": (context_builder.log_lines(device_id, fault_levels,
+                                                         since=time.time() - CONTEXT_WARM_DAYS * 86400), 1),
+                }, sep="\n                ")
+
                 today_val_tg = data_slice.get(today, 0.0)
-                if measurements:
-                    voltages = [m['voltage'] for m in measurements]
-                    currents = [m['current'] for m in measurements]
-                    powers = [m['power'] for m in measurements]
-                    avg_voltage = sum(voltages) / len(voltages)
-                    avg_current = sum(currents) / len(currents)
-                    avg_power = sum(powers) / len(powers)
-                    peak_power = max(powers)
-                    fault_count = sum(1 for m in measurements if 'FAULT' in m.get('status',''))
-                else:
-                    avg_voltage = avg_current = avg_power = peak_power = fault_count = 0
 
                 projected_monthly = avg_kwh * 30 * COST_PER_KWH
 
@@ -727,16 +1359,18 @@ def send_bill_telegram():
                 Live Power: {current_data['power']:.2f} W | Voltage: {current_data['voltage']:.2f} V | Current: {current_data['current']:.3f} A
                 Today's Usage: {today_val_tg:.4f} kWh | Today's Cost: Rs.{today_val_tg * COST_PER_KWH:.2f}
 
-                === STATISTICS (Last 100 Readings) ===
-                Avg Voltage: {avg_voltage:.2f}V | Avg Current: {avg_current:.3f}A | Avg Power: {avg_power:.2f}W
-                Peak Power: {peak_power:.2f}W | Fault Events: {fault_count}/{len(measurements)}
+                === STATISTICS (Last 24 Hours) ===
+                {stats.format_summary(measurement_stats)}
+
+                === 24-HOUR LOAD PROFILE (hourly) ===
+                {context['hourly']}
 
-                === 7-DAY ENERGY DATA ===
-                {json.dumps(data_slice, indent=2)}
+                === DAILY ENERGY DATA (newest first) ===
+                {context['days']}
                 Total: {total_kwh:.2f} kWh | Daily Avg: {avg_kwh:.2f} kWh | Projected Monthly Bill: Rs.{projected_monthly:.2f}
 
-                === FAULTS (Last 20) ===
-                {json.dumps(all_faults[:20])}
+                === FAULTS (Last 7 Days, newest first; "xN" = repeated N times) ===
+                {context['faults']}
 
                 Write a FULL deep-dive report with these sections (use emojis as section headers, keep it readable for Telegram):
                 1. ⚡ EXECUTIVE SUMMARY
@@ -751,55 +1385,41 @@ def send_bill_telegram():
                 Be thorough, data-driven, and technically precise. Reference actual values.
                 """
 
-                model = genai.GenerativeModel('gemini-3-pro-preview')
-                resp = model.generate_content(ai_prompt)
-                ai_text = resp.text
-            except Exception as e:
-                ai_text = f"AI Error: {e}"
-
-        # 4. Construct Short Caption for Photo
-        caption = f"💡 *GridGuard Smart Report* ({scope.upper()})\n\n"
-        caption += f"📅 Range: {target_days[0]} to {target_days[-1]}\n"
-        caption += f"⚡ Total: {total_kwh:.2f} kWh\n"
-        caption += f"📊 Avg: {avg_kwh:.2f} kWh/day\n"
-        
-        # 5. Send Photo with Short Caption
-        photo_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendPhoto"
-        files = {'photo': ('chart.png', img_buf, 'image/png')}
-        photo_data = {
-            "chat_id": TELEGRAM_CHAT_ID,
-            "caption": caption,
-            "parse_mode": "Markdown"
-        }
-        
-        photo_resp = requests.post(photo_url, data=photo_data, files=files)
-        
-        if photo_resp.status_code != 200:
-            return jsonify({"result": f"Telegram Photo Error: {photo_resp.text}"}), 500
+                ai_text = generate_ai_text(ai_prompt)
+                ai_cache.put(cache_key, ai_text, device_id)
+        except Exception as e:
+            ai_text = f"AI Error: {e}"
 
-        # 6. Send the Full AI Deep Analysis as a Text Message
-        ai_msg = f"{ai_text}\n\nRunning Status: {current_data['status']}"
-        
-        # Protect against the 4096 character limit for text messages
-        if len(ai_msg) > 4000:
-            ai_msg = ai_msg[:4000] + "\n...(truncated)"
-            
-        text_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        text_data = {
-            "chat_id": TELEGRAM_CHAT_ID,
-            "text": ai_msg
-            # Telegram sometimes trips on AI-generated raw markdown if it has unclosed tags, so we send plain text output
-        }
-        
-        text_resp = requests.post(text_url, json=text_data)
+    # 4. Construct Short Caption for Photo
+    caption = f"💡 *GridGuard Smart Report* ({scope.upper()})\n\n"
+    caption += f"📅 Range: {target_days[0]} to {target_days[-1]}\n"
+    caption += f"⚡ Total: {total_kwh:.2f} kWh\n"
+    caption += f"📊 Avg: {avg_kwh:.2f} kWh/day\n"
+    
+    # 5. Send Photo with Short Caption
+    png = chart.result(CHART_TIMEOUT)
+    progress("Sending to Telegram")
+    try:
+        alert_dispatcher.send_photo(png, caption, parse_mode="Markdown").result(NOTIFY_TIMEOUT)
+    except Exception as e:
+        raise RuntimeError(f"Telegram Photo Error: {e}")
+
+    # 6. Send the Full AI Deep Analysis as a Text Message
+    ai_msg = f"{ai_text}\n\nRunning Status: {current_data['status']}"
+    
+    # Protect against the 4096 character limit for text messages
+    if len(ai_msg) > 4000:
+        ai_msg = ai_msg[:4000] + "\n...(truncated)"
         
-        if text_resp.status_code == 200:
-            return jsonify({"result": "Rich Report & Analysis Sent Successfully!"})
-        else:
-            return jsonify({"result": f"Telegram Text Error: {text_resp.text}"}), 500
-            
+    # Telegram sometimes trips on AI-generated raw markdown if it has unclosed tags, so we send plain text output
+    try:
+        alert_dispatcher.send_message(ai_msg).result(NOTIFY_TIMEOUT)
     except Exception as e:
-        return jsonify({"result": f"Error: {str(e)}"}), 500
+        raise RuntimeError(f"Telegram Text Error: {e}")
+
+    return {"result": "Rich Report & Analysis Sent Successfully!"}
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # No reloader: its parent process would run create_app() too, take the
+    # leader lock and keep ingesting with stale code while the child follows
+    create_app().run(debug=True, use_reloader=False, host='0.0.0.0', port=5000)
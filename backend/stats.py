@@ -0,0 +1,157 @@
+import time
+
+import numpy as np
+
+from energy import ENERGY_MAX_GAP
+
+# --- STATISTICS CONFIGURATION ---
+STATS_WINDOW = 86400       # Seconds of raw data summarized for AI reports
+STATS_FALLBACK_ROWS = 100  # Used instead when the device has been quiet for the whole window
+NOMINAL_VOLTAGE = 230.0
+SAG_THRESHOLD = 0.9 * NOMINAL_VOLTAGE    # IEC 61000-4-30: below 90% of nominal
+SWELL_THRESHOLD = 1.1 * NOMINAL_VOLTAGE  # above 110%
+MAINS_PRESENT_V = 50.0     # Lower readings mean no supply / unplugged sensor, not a sag
+PERCENTILES = (5, 50, 95)
+
+# Column order of the window matrix
+_TS, _V, _I, _P, _FAULT = range(5)
+
+# One query per device on the (device_id, timestamp) index: rows come back
+# already in time order, and the status text is reduced to a 0/1 in SQLite.
+_WINDOW_SQL = '''
+    SELECT timestamp, voltage, current, power,
+           CASE WHEN status LIKE '%FAULT%' THEN 1 ELSE 0 END
+    FROM measurements WHERE device_id = ?{where}'''
+
+
+class Window:
+    """Measurements as columnar arrays, grouped by device and in time order within each."""
+    __slots__ = ("timestamp", "voltage", "current", "power", "fault", "device")
+
+    def __init__(self, parts=()):
+        """parts: one list of (timestamp, voltage, current, power, fault) rows per device."""
+        blocks = [np.array(rows, dtype=np.float64).reshape(-1, 5) for rows in parts]
+        data = np.concatenate(blocks) if blocks else np.empty((0, 5))
+        self.timestamp = data[:, _TS]
+        self.voltage = data[:, _V]
+        self.current = data[:, _I]
+        self.power = data[:, _P]
+        self.fault = data[:, _FAULT].astype(bool)
+        # Small integer per device; consecutive samples only pair up when it matches
+        self.device = np.repeat(np.arange(len(blocks)), [len(b) for b in blocks])
+
+    def __len__(self):
+        return len(self.timestamp)
+
+
+def load_window(conn, device_id=None, start=None, end=None, limit=None):
+    """Reads measurements into a Window (all devices when device_id is None).
+
+    With limit, keeps the newest `limit` rows of each device.
+    """
+    where = ""
+    params = []
+    if start is not None:
+        where += " AND timestamp >= ?"
+        params.append(start)
+    if end is not None:
+        where += " AND timestamp < ?"
+        params.append(end)
+    sql = _WINDOW_SQL.format(where=where)
+    if limit:
+        sql = f"SELECT * FROM ({sql} ORDER BY timestamp DESC LIMIT ?) ORDER BY 1"
+        params.append(int(limit))
+    else:
+        sql += " ORDER BY timestamp"
+
+    # Plain tuples regardless of the caller's row_factory
+    cur = conn.cursor()
+    cur.row_factory = None
+    if device_id:
+        device_ids = [device_id]
+    else:
+        device_ids = [row[0] for row in cur.execute("SELECT DISTINCT device_id FROM measurements").fetchall()]
+    return Window([cur.execute(sql, [d] + params).fetchall() for d in device_ids])
+
+
+def recent_window(conn, device_id=None, seconds=STATS_WINDOW, fallback_rows=STATS_FALLBACK_ROWS, now=None):
+    """The last `seconds` of data, or the newest fallback_rows if that window is empty."""
+    window = load_window(conn, device_id, start=(now or time.time()) - seconds)
+    if not len(window):
+        window = load_window(conn, device_id, limit=fallback_rows)
+    return window
+
+
+def _describe(values):
+    pcts = np.percentile(values, PERCENTILES)
+    out = {
+        "mean": float(values.mean()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "std": float(values.std()),
+    }
+    for p, v in zip(PERCENTILES, pcts):
+        out[f"p{p}"] = float(v)
+    return out
+
+
+def _events(mask, same_device):
+    """Number of runs of True in mask (a run restarts at each device boundary)."""
+    if not len(mask):
+        return 0
+    starts = mask[1:] & ~(mask[:-1] & same_device)
+    return int(mask[0]) + int(starts.sum())
+
+
+def integrate_energy(window, max_gap=ENERGY_MAX_GAP):
+    """Trapezoidal kWh per window; intervals of max_gap seconds or more (and device boundaries) are skipped."""
+    if len(window) < 2:
+        return 0.0
+    dt = np.diff(window.timestamp)
+    valid = (dt > 0) & (dt < max_gap) & (window.device[1:] == window.device[:-1])
+    watt_seconds = (window.power[1:] + window.power[:-1]) * 0.5 * dt
+    return float(watt_seconds[valid].sum() / 3600.0 / 1000.0)
+
+
+def summarize(window):
+    """All report statistics for a window, computed on its arrays."""
+    n = len(window)
+    if not n:
+        return {"samples": 0}
+    same_device = window.device[1:] == window.device[:-1]
+    mains = window.voltage >= MAINS_PRESENT_V
+    sag = mains & (window.voltage < SAG_THRESHOLD)
+    swell = window.voltage > SWELL_THRESHOLD
+    return {
+        "samples": n,
+        "start": float(window.timestamp.min()),
+        "end": float(window.timestamp.max()),
+        "voltage": _describe(window.voltage),
+        "current": _describe(window.current),
+        "power": _describe(window.power),
+        "fault_count": int(window.fault.sum()),
+        "fault_events": _events(window.fault, same_device),
+        "sag_samples": int(sag.sum()),
+        "sag_events": _events(sag, same_device),
+        "swell_samples": int(swell.sum()),
+        "swell_events": _events(swell, same_device),
+        "energy_kwh": integrate_energy(window),
+    }
+
+
+def format_summary(s):
+    """Compact multi-line text of summarize() output for AI prompts."""
+    if not s.get("samples"):
+        return "No measurements recorded."
+    hours = (s["end"] - s["start"]) / 3600.0
+    lines = [f"Samples: {s['samples']} over {hours:.1f} h"]
+    for name, unit, fmt in (("voltage", "V", ".2f"), ("current", "A", ".3f"), ("power", "W", ".2f")):
+        d = s[name]
+        lines.append(f"{name.capitalize()}: avg {d['mean']:{fmt}}{unit} | min {d['min']:{fmt}} | "
+                     f"max {d['max']:{fmt}} | std {d['std']:{fmt}} | "
+                     f"p5/p50/p95 {d['p5']:{fmt}}/{d['p50']:{fmt}}/{d['p95']:{fmt}}")
+    lines.append(f"Voltage sags (<{SAG_THRESHOLD:.0f}V): {s['sag_events']} events / {s['sag_samples']} samples | "
+                 f"swells (>{SWELL_THRESHOLD:.0f}V): {s['swell_events']} events / {s['swell_samples']} samples")
+    lines.append(f"Fault readings: {s['fault_count']} in {s['fault_events']} episodes | "
+                 f"Energy in window: {s['energy_kwh']:.4f} kWh")
+    return "\n".join(lines)
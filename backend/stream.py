@@ -0,0 +1,123 @@
+import json
+import os
+import queue
+import threading
+import time
+
+from ring_buffer import RingBuffer
+
+# --- STREAM CONFIGURATION ---
+STREAM_REPLAY_SIZE = 1000    # Recent events kept for Last-Event-ID resume
+STREAM_CLIENT_BACKLOG = 256  # Undelivered events per client before it counts as a slow consumer
+STREAM_HEARTBEAT = 15.0      # Seconds between keep-alive comments (also detects dead clients)
+STREAM_RETRY_MS = 3000       # Client reconnect delay advertised to EventSource
+
+
+def format_event(event_id, event_type, data):
+    """One Server-Sent Events frame. event_id None: no id line, so the client's Last-Event-ID is kept."""
+    if event_id is None:
+        return f"event: {event_type}\ndata: {data}\n\n"
+    return f"id: {event_id}\nevent: {event_type}\ndata: {data}\n\n"
+
+
+class Subscriber:
+    """One connected client: a bounded queue of pre-formatted frames."""
+    __slots__ = ("device_id", "queue", "overflowed")
+
+    def __init__(self, device_id=None, backlog=STREAM_CLIENT_BACKLOG):
+        self.device_id = device_id
+        self.queue = queue.Queue(maxsize=backlog)
+        self.overflowed = False
+
+    def wants(self, event_device):
+        # System-wide events (no device) go to everyone
+        return self.device_id is None or event_device is None or event_device == self.device_id
+
+    def push(self, frame):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            # Slow consumer: stop feeding it. The stream loop closes the
+            # connection and EventSource reconnects with Last-Event-ID.
+            self.overflowed = True
+
+    def frames(self, heartbeat=STREAM_HEARTBEAT):
+        """Yields frames until the client overflows; heartbeats keep idle proxies open."""
+        while not self.overflowed:
+            try:
+                yield self.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+        # No id: the reconnect must resume after the last event delivered, not from 0
+        yield format_event(None, "overflow", "{}")
+
+
+class EventBroker:
+    """Fans events out to every subscriber and keeps a replay window for resume.
+
+    Each event is serialized once in publish(), however many clients are listening.
+    Event ids are "<epoch>:<n>", the epoch naming this broker (worker pid + boot
+    time): a client reconnecting to another worker, or after a restart, carries
+    an id from a different sequence and gets a resync instead of a wrong replay.
+    """
+
+    def __init__(self, replay_size=STREAM_REPLAY_SIZE):
+        self._replay = RingBuffer(replay_size)  # (event_id, device_id, frame)
+        self._subscribers = set()
+        self.epoch = f"{os.getpid():x}-{int(time.time() * 1000):x}"
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self.stats = {"published": 0, "subscribers": 0, "overflows": 0, "resyncs": 0}
+
+    def publish(self, event_type, data, device_id=None):
+        payload = json.dumps(data)
+        with self._lock:
+            event_id = self._next_id
+            self._next_id += 1
+            frame = format_event(f"{self.epoch}:{event_id}", event_type, payload)
+            self._replay.append((event_id, device_id, frame))
+            subscribers = list(self._subscribers)
+        self.stats["published"] += 1
+        for sub in subscribers:
+            if sub.wants(device_id):
+                sub.push(frame)
+        return f"{self.epoch}:{event_id}"
+
+    def _sequence(self, last_event_id):
+        """The client's Last-Event-ID as a number in this broker's sequence; -1 if from another one."""
+        epoch, _, n = last_event_id.rpartition(":")
+        if epoch != self.epoch or not n.isdigit():
+            return -1
+        return int(n)
+
+    def subscribe(self, device_id=None, last_event_id=None):
+        """Registers a client; replays anything it missed since last_event_id (as the client sent it)."""
+        sub = Subscriber(device_id)
+        with self._lock:
+            if last_event_id:
+                seen = self._sequence(last_event_id)
+                window = self._replay.latest()
+                missed = [e for e in window if e[0] > seen and sub.wants(e[1])]
+                # Resync (client refetches /api/data) when the id is from another
+                # worker or an earlier run, the gap is older than the replay
+                # window, or it is too big to queue.
+                if (seen < 0 or seen >= self._next_id
+                        or (window and window[0][0] > seen + 1)
+                        or len(missed) >= sub.queue.maxsize):
+                    self.stats["resyncs"] += 1
+                    sub.push(format_event(f"{self.epoch}:{self._next_id - 1}", "resync", "{}"))
+                else:
+                    for event_id, event_device, frame in missed:
+                        sub.push(frame)
+            self._subscribers.add(sub)
+            self.stats["subscribers"] = len(self._subscribers)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+            self.stats["subscribers"] = len(self._subscribers)
+        if sub.overflowed:
+            self.stats["overflows"] += 1
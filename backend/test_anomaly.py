@@ -0,0 +1,23 @@
+from anomaly import OVERCURRENT_HOLD, RESET_GAP, AnomalyDetector
+
+
+def test_overcurrent_then_gap_then_normal():
+    """An overcurrent left open by a gap must not break the next normal sample."""
+    detector = AnomalyDetector(overcurrent=0.30)
+    ts = 1000.0
+    kinds = []
+    for _ in range(int(OVERCURRENT_HOLD) + 2):
+        kinds += [e["kind"] for e in detector.update("dev", ts, 120.0, 0.35, 40.0)]
+        ts += 1.0
+    assert "overcurrent" in kinds
+
+    ts += RESET_GAP + 1.0
+    events = detector.update("dev", ts, 120.0, 0.10, 12.0)
+    assert events == []
+    assert detector.snapshot()["dev"]["open"] == []
+    assert detector.update("dev", ts + 1.0, 120.0, 0.10, 12.0) == []
+
+
+if __name__ == "__main__":
+    test_overcurrent_then_gap_then_normal()
+    print("OK")
@@ -0,0 +1,68 @@
+import google.generativeai as genai
+from google.generativeai import protos
+from google.generativeai.types.generation_types import GenerateContentResponse
+
+import server
+
+
+class FakeStream:
+    """Stands in for the gRPC response stream: yields chunks, records cancel()."""
+
+    def __init__(self, texts):
+        self.chunks = iter(texts)
+        self.cancelled = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        text = next(self.chunks)
+        return protos.GenerateContentResponse(
+            candidates=[{"content": {"parts": [{"text": text}], "role": "model"}}])
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeModel:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def generate_content(self, prompt, stream=False):
+        # Built by the real SDK class, so a change to its internals shows up here
+        return GenerateContentResponse.from_iterator(self.stream)
+
+
+class FakeGenai:
+    __version__ = genai.__version__
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def GenerativeModel(self, name):
+        return FakeModel(self.stream)
+
+
+def stream_with(texts):
+    stream = FakeStream(texts)
+    server._genai = FakeGenai(stream)
+    return stream, server.generate_ai_stream("prompt")
+
+
+def test_closing_the_stream_cancels_the_request():
+    stream, chunks = stream_with(["one ", "two ", "three"])
+    assert next(chunks) == "one "
+    chunks.close()
+    assert stream.cancelled, f"google-generativeai {genai.__version__} no longer cancels streams"
+
+
+def test_finished_stream_is_not_cancelled():
+    stream, chunks = stream_with(["one ", "two"])
+    assert "".join(chunks) == "one two"
+    assert not stream.cancelled
+
+
+if __name__ == "__main__":
+    test_closing_the_stream_cancels_the_request()
+    test_finished_stream_is_not_cancelled()
+    print("OK")
@@ -0,0 +1,8 @@
+"""Production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+
+Each worker builds its own app. The first one to take the leader lock runs MQTT
+ingestion; the others serve HTTP from the database (see cluster.py).
+"""
+from server import create_app
+
+app = create_app()
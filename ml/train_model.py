@@ -1,9 +1,21 @@
+import os
+import sys
+
 import pandas as pd
 import numpy as np
 import tensorflow as tf
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+from features import N_FEATURES, WINDOW_SIZE, add_synthetic_faults, add_transients, grouped_window_features
+
+# --windowed: classify WINDOW_SIZE-sample windows (backend/features.py) instead
+# of single readings. That model only runs on the server (the firmware feeds
+# one sample at a time), so it goes to backend/model_windowed.tflite and the
+# firmware headers are left alone.
+WINDOWED = '--windowed' in sys.argv
+
 # 1. Load Data
 try:
     df = pd.read_csv('../backend/ml_dataset.csv')
@@ -17,23 +29,38 @@ except:
 print("Augmenting data with synthetic FAULT samples...")
 np.random.seed(42)
 n_faults = 50
-fault_data = pd.DataFrame({
-    'voltage': np.random.normal(120, 5, n_faults), # 120V Faults
-    'current': np.random.normal(0.35, 0.05, n_faults), # > 0.30A
-    'power': np.random.normal(40, 5, n_faults),
-    'label': ['FAULT'] * n_faults
-})
-
-# Add some "LEVEL_2" as "WARNING" if user wants? 
-# For now, let's keep user labels (LEVEL_1, LEVEL_2, IDLE) + FAULT.
-df = pd.concat([df, fault_data], ignore_index=True)
+if WINDOWED:
+    # Same augmentation as train_pipeline.py --windowed (backend/features.py):
+    # steady fault runs, plus a copy of the data with switching spikes. The
+    # CSV is recorded one label at a time: each run of equal labels is one sequence
+    rng = np.random.default_rng(42)
+    runs = (df['label'] != df['label'].shift()).cumsum().values
+    X, y_str, groups = add_synthetic_faults(df[['voltage', 'current', 'power']].values, df['label'].values,
+                                            runs, n_faults, rng, windowed=True)
+    X, y_str, groups = add_transients(X, y_str, groups, rng)
+else:
+    fault_data = pd.DataFrame({
+        'voltage': np.random.normal(120, 5, n_faults), # 120V Faults
+        'current': np.random.normal(0.35, 0.05, n_faults), # > 0.30A
+        'power': np.random.normal(40, 5, n_faults),
+        'label': ['FAULT'] * n_faults
+    })
+
+    # Add some "LEVEL_2" as "WARNING" if user wants? 
+    # For now, let's keep user labels (LEVEL_1, LEVEL_2, IDLE) + FAULT.
+    df = pd.concat([df, fault_data], ignore_index=True)
+    X = df[['voltage', 'current', 'power']].values
+    y_str = df['label'].values
 
 print("Dataset Class Distribution:")
-print(df['label'].value_counts())
+print(pd.Series(y_str).value_counts())
 
 # 3. Preprocessing
-X = df[['voltage', 'current', 'power']].values
-y_str = df['label'].values
+if WINDOWED:
+    # Windows don't cross from one run into the next
+    X, ends = grouped_window_features(X, groups)
+    y_str = y_str[ends]
+    print(f"Windows: {len(X)} x {N_FEATURES} features ({WINDOW_SIZE} samples each)")
 
 encoder = LabelEncoder()
 y = encoder.fit_transform(y_str)
@@ -41,17 +68,25 @@ classes = encoder.classes_
 print(f"Classes: {classes}")
 
 # Save class map for Firmware
-with open('../firmware/src/class_map.h', 'w') as f:
-    f.write("// Auto-generated class map\n")
-    joined_classes = '", "'.join(classes)
-    f.write(f'const char* CLASS_NAMES[] = {{ "{joined_classes}" }};\n')
+if not WINDOWED:
+    with open('../firmware/src/class_map.h', 'w') as f:
+        f.write("// Auto-generated class map\n")
+        joined_classes = '", "'.join(classes)
+        f.write(f'const char* CLASS_NAMES[] = {{ "{joined_classes}" }};\n')
 
 # Split
 X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
 
 # 4. Define Model
-model = tf.keras.Sequential([
-    tf.keras.layers.Dense(16, activation='relu', input_shape=(3,)),
+# Window features span very different scales (variance vs. mean voltage), so
+# that model normalizes its inputs itself; the server still feeds raw features
+layers = [tf.keras.layers.Input(shape=(X.shape[1],))]
+if WINDOWED:
+    norm = tf.keras.layers.Normalization()
+    norm.adapt(X_train)
+    layers.append(norm)
+model = tf.keras.Sequential(layers + [
+    tf.keras.layers.Dense(16, activation='relu'),
     tf.keras.layers.Dense(8, activation='relu'),
     tf.keras.layers.Dense(len(classes), activation='softmax')
 ])
@@ -70,6 +105,12 @@ converter.optimizations = [tf.lite.Optimize.DEFAULT] # Quantize for size
 tflite_model = converter.convert()
 
 # Save binary
+if WINDOWED:
+    with open('../backend/model_windowed.tflite', 'wb') as f:
+        f.write(tflite_model)
+    print("Success! Windowed model saved to backend/model_windowed.tflite")
+    sys.exit()
+
 with open('model.tflite', 'wb') as f:
     f.write(tflite_model)
 
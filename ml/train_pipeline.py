@@ -0,0 +1,390 @@
+"""Training pipeline: recorded sessions -> cached features -> parallel model search -> TFLite.
+
+    python train_pipeline.py [--db ../backend/power_monitor.db] [--csv ../backend/ml_dataset.csv]
+                             [--workers N] [--quick] [--windowed] [--install]
+
+1. Labelled samples come straight from the measurements table: each closed
+   recording session (/api/record start/stop -> recording_sessions) labels the
+   measurements inside its time window, minus --trim seconds at both edges
+   while the load was still being switched. --csv adds the legacy dataset.
+2. Feature arrays are cached in ml/cache/, keyed by the sessions and their row
+   counts, so re-runs skip the DB scan until something new is recorded.
+3. Candidate architectures / learning rates train in parallel, one process per
+   CPU core with TensorFlow pinned to one thread, from fixed seeds.
+4. Every candidate is converted to a quantized TFLite model and scored with the
+   TFLite interpreter on a held-out split: accuracy, size and CPU latency. The
+   best one is also run over every session in time order to count how often
+   consecutive predictions flip (label stability).
+
+Outputs land in ml/build/ (model.tflite, class_map.h, model_data.h,
+report.json); --install copies them into backend/ and firmware/src/.
+
+--windowed trains on backend/features.py window statistics (mean, RMS, slope,
+crest factor, variance over the last WINDOW_SIZE samples of one device)
+instead of single readings. That model is for the server only - the firmware
+still classifies single samples - so it is written as model_windowed.tflite
+and --install copies it to backend/, where the classifier prefers it.
+"""
+import argparse
+import contextlib
+import csv
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+ML_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(ML_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "backend"))
+from features import (FEATURE_NAMES, WINDOW_SIZE, add_synthetic_faults, add_transients,  # noqa: E402
+                      grouped_window_features)
+
+CACHE_DIR = os.path.join(ML_DIR, "cache")
+BUILD_DIR = os.path.join(ML_DIR, "build")
+
+FEATURE_VERSION = 2  # Bump when the features change: invalidates ml/cache
+FEATURES = ("voltage", "current", "power")  # Model input, same order the firmware feeds it
+WINDOWED_MODEL = "model_windowed.tflite"
+TEST_FRACTION = 0.2
+VALIDATION_SPLIT = 0.15  # Of the training part, for early stopping / model selection
+MAX_EPOCHS = 300
+PATIENCE = 20           # Epochs without a MIN_DELTA val_loss improvement before stopping
+MIN_DELTA = 1e-3
+BATCH_SIZE = 32
+SEED = 42
+
+SEARCH_SPACE = {
+    "hidden": [(8,), (16,), (16, 8), (32, 16), (32, 16, 8)],
+    "lr": [1e-3, 3e-3, 1e-2],
+}
+QUICK_SPACE = {"hidden": [(16, 8)], "lr": [3e-3]}
+
+
+# --- DATA ---
+def closed_sessions(conn):
+    try:
+        return conn.execute("SELECT id, label, device_id, started, ended FROM recording_sessions "
+                            "WHERE ended IS NOT NULL ORDER BY id").fetchall()
+    except sqlite3.OperationalError:  # DB from before schema v8 (server not restarted since)
+        print("No recording_sessions table yet: start the server once to migrate the DB")
+        return []
+
+
+def _window(session, trim):
+    _, _, device_id, started, ended = session
+    where = " WHERE timestamp >= ? AND timestamp <= ?"
+    params = [started + trim, ended - trim]
+    if device_id is not None:
+        where += " AND device_id = ?"
+        params.append(device_id)
+    return where, params
+
+
+def cache_key(conn, sessions, trim, csv_path):
+    """Identifies the dataset: sessions, the rows inside them, trim, the CSV file."""
+    parts = []
+    for s in sessions:
+        where, params = _window(s, trim)
+        count, max_id = conn.execute(f"SELECT COUNT(*), COALESCE(MAX(id), 0) FROM measurements{where}",
+                                     params).fetchone()
+        parts.append(list(s) + [count, max_id])
+    csv_stat = None
+    if csv_path:
+        st = os.stat(csv_path)
+        csv_stat = [os.path.abspath(csv_path), st.st_size, st.st_mtime]
+    blob = json.dumps({"v": FEATURE_VERSION, "sessions": parts, "trim": trim, "csv": csv_stat})
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+
+def read_csv(path):
+    rows, labels = [], []
+    with open(path, newline="") as f:
+        for rec in csv.DictReader(f):
+            rows.append([float(rec[k]) for k in FEATURES])
+            labels.append(rec["label"])
+    return rows, labels
+
+
+def load_features(db_file, csv_path=None, trim=2.0, use_cache=True):
+    """-> (X float32 (n, 3), labels array of str, groups, cache key, from_cache).
+
+    Rows are in time order within a group: one device in one session, or one
+    run of equal labels in the CSV (it was recorded a label at a time). Windows
+    never span two groups.
+    """
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    try:
+        sessions = closed_sessions(conn)
+        key = cache_key(conn, sessions, trim, csv_path)
+        path = os.path.join(CACHE_DIR, f"features-{key}.npz")
+        if use_cache and os.path.exists(path):
+            data = np.load(path)
+            return data["X"], data["labels"], data["groups"], key, True
+
+        blocks, labels, groups = [], [], []
+        for s in sessions:
+            where, params = _window(s, trim)
+            rows = conn.execute(f"SELECT device_id, {', '.join(FEATURES)} FROM measurements{where} "
+                                "ORDER BY device_id, timestamp", params).fetchall()
+            if rows:
+                blocks.append(np.asarray([r[1:] for r in rows], dtype=np.float32))
+                labels.extend([s[1]] * len(rows))
+                devices = [r[0] for r in rows]
+                first = groups[-1] + 1 if groups else 0
+                groups.extend(first + np.cumsum([0] + [a != b for a, b in zip(devices, devices[1:])]))
+    finally:
+        conn.close()
+    if csv_path:
+        rows, csv_labels = read_csv(csv_path)
+        if rows:
+            blocks.append(np.asarray(rows, dtype=np.float32))
+            labels.extend(csv_labels)
+            first = groups[-1] + 1 if groups else 0
+            groups.extend(first + np.cumsum([0] + [a != b for a, b in zip(csv_labels, csv_labels[1:])]))
+
+    X = np.concatenate(blocks) if blocks else np.empty((0, len(FEATURES)), dtype=np.float32)
+    labels = np.asarray(labels)
+    groups = np.asarray(groups, dtype=np.int64)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = path + ".tmp.npz"
+    np.savez_compressed(tmp, X=X, labels=labels, groups=groups)
+    os.replace(tmp, path)
+    return X, labels, groups, key, False
+
+
+def stratified_split(y, fraction, rng):
+    """Per-class shuffled split -> (train_idx, test_idx); each class keeps its share."""
+    train, test = [], []
+    for cls in np.unique(y):
+        idx = rng.permutation(np.flatnonzero(y == cls))
+        n_test = max(1, int(round(len(idx) * fraction))) if len(idx) > 1 else 0
+        test.extend(idx[:n_test])
+        train.extend(idx[n_test:])
+    return rng.permutation(train), np.asarray(test, dtype=np.intp)
+
+
+# --- SEARCH (runs in worker processes) ---
+def candidates(space):
+    return [{"hidden": list(h), "lr": lr} for h in space["hidden"] for lr in space["lr"]]
+
+
+def tflite_latency_us(Interpreter, model_bytes, n_features, runs=2000):
+    interpreter = Interpreter(model_content=model_bytes, num_threads=1)
+    interpreter.allocate_tensors()
+    inp = interpreter.get_input_details()[0]["index"]
+    x = np.zeros((1, n_features), dtype=np.float32)
+    for _ in range(100):  # Warm-up
+        interpreter.set_tensor(inp, x)
+        interpreter.invoke()
+    start = time.perf_counter()
+    for _ in range(runs):
+        interpreter.set_tensor(inp, x)
+        interpreter.invoke()
+    return (time.perf_counter() - start) / runs * 1e6
+
+
+def tflite_predict(Interpreter, model_bytes, X):
+    interpreter = Interpreter(model_content=model_bytes, num_threads=1)
+    inp = interpreter.get_input_details()[0]["index"]
+    interpreter.resize_tensor_input(inp, list(X.shape))
+    interpreter.allocate_tensors()
+    interpreter.set_tensor(inp, X.astype(np.float32))
+    interpreter.invoke()
+    return interpreter.get_tensor(interpreter.get_output_details()[0]["index"]).argmax(axis=1)
+
+
+def tflite_accuracy(Interpreter, model_bytes, X, y):
+    return float((tflite_predict(Interpreter, model_bytes, X) == y).mean())
+
+
+def flip_rate(predicted, groups):
+    """Share of consecutive predictions within a group that change class."""
+    same_group = groups[1:] == groups[:-1]
+    if not same_group.any():
+        return 0.0
+    return float((predicted[1:] != predicted[:-1])[same_group].mean())
+
+
+def interpreter_class():
+    """LiteRT's Interpreter if installed (tf.lite.Interpreter is deprecated), else TensorFlow's."""
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        import tensorflow as tf
+        return tf.lite.Interpreter
+
+
+def train_candidate(job):
+    """Trains, converts and scores one candidate; returns its metrics and TFLite bytes."""
+    params, seed, X_train, y_train, X_test, y_test, n_classes = job
+    os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    tf.keras.utils.set_random_seed(seed)
+
+    start = time.perf_counter()
+    # Normalization is part of the model, so devices and the server keep feeding raw V/I/P
+    norm = tf.keras.layers.Normalization()
+    norm.adapt(X_train)
+    layers = [tf.keras.Input(shape=(X_train.shape[1],)), norm]
+    layers += [tf.keras.layers.Dense(units, activation="relu") for units in params["hidden"]]
+    layers.append(tf.keras.layers.Dense(n_classes, activation="softmax"))
+    model = tf.keras.Sequential(layers)
+    model.compile(optimizer=tf.keras.optimizers.Adam(params["lr"]),
+                  loss="sparse_categorical_crossentropy", metrics=["accuracy"])
+    stop = tf.keras.callbacks.EarlyStopping(monitor="val_loss", patience=PATIENCE, min_delta=MIN_DELTA,
+                                            restore_best_weights=True)
+    history = model.fit(X_train, y_train, epochs=MAX_EPOCHS, batch_size=BATCH_SIZE,
+                        validation_split=VALIDATION_SPLIT, callbacks=[stop], verbose=0)
+    train_s = time.perf_counter() - start
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]  # Quantize for size
+    with contextlib.redirect_stdout(io.StringIO()):  # The converter prints the exported signatures
+        model_bytes = converter.convert()
+    Interpreter = interpreter_class()
+    return {
+        "params": params,
+        "epochs": len(history.history["loss"]),
+        "val_accuracy": float(max(history.history["val_accuracy"])),
+        "test_accuracy": tflite_accuracy(Interpreter, model_bytes, X_test, y_test),
+        "size_bytes": len(model_bytes),
+        "latency_us": round(tflite_latency_us(Interpreter, model_bytes, X_train.shape[1]), 2),
+        "train_s": round(train_s, 1),
+    }, model_bytes
+
+
+def search(jobs, workers):
+    """Runs every job across worker processes ("spawn": TensorFlow is not fork-safe)."""
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(train_candidate, job) for job in jobs]
+        for future in as_completed(futures):
+            metrics, model_bytes = future.result()
+            print(f"  {str(metrics['params']['hidden']):<12} lr={metrics['params']['lr']:<6g} "
+                  f"val {metrics['val_accuracy'] * 100:5.1f}% | test {metrics['test_accuracy'] * 100:5.1f}% | "
+                  f"{metrics['size_bytes']:6d} B | {metrics['latency_us']:6.2f} us | "
+                  f"{metrics['epochs']:3d} epochs in {metrics['train_s']:.1f}s")
+            results.append((metrics, model_bytes))
+    return results
+
+
+# --- OUTPUTS ---
+def c_array(model_bytes):
+    hex_str = ", ".join(f"0x{b:02x}" for b in model_bytes)
+    return f"const unsigned char model_data[] = {{ {hex_str} }};\nconst int model_data_len = {len(model_bytes)};"
+
+
+def write_outputs(out_dir, model_bytes, classes, report, windowed=False):
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    if windowed:  # Server-only model: the firmware headers stay the single-sample model's
+        with open(os.path.join(out_dir, WINDOWED_MODEL), "wb") as f:
+            f.write(model_bytes)
+        return
+    with open(os.path.join(out_dir, "model.tflite"), "wb") as f:
+        f.write(model_bytes)
+    with open(os.path.join(out_dir, "class_map.h"), "w") as f:
+        f.write("// Auto-generated class map\n")
+        joined = '", "'.join(classes)
+        f.write(f'const char* CLASS_NAMES[] = {{ "{joined}" }};\n')
+    with open(os.path.join(out_dir, "model_data.h"), "w") as f:
+        f.write("#ifndef MODEL_DATA_H\n#define MODEL_DATA_H\n\n")
+        f.write(c_array(model_bytes))
+        f.write("\n\n#endif")
+
+
+def install(out_dir, windowed=False):
+    if windowed:
+        shutil.copy(os.path.join(out_dir, WINDOWED_MODEL), os.path.join(REPO_DIR, "backend", WINDOWED_MODEL))
+        print(f"Installed backend/{WINDOWED_MODEL}")
+        return
+    shutil.copy(os.path.join(out_dir, "model.tflite"), os.path.join(REPO_DIR, "backend", "model.tflite"))
+    for name in ("class_map.h", "model_data.h"):
+        shutil.copy(os.path.join(out_dir, name), os.path.join(REPO_DIR, "firmware", "src", name))
+    print("Installed backend/model.tflite, firmware/src/class_map.h, firmware/src/model_data.h")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=os.path.join(REPO_DIR, "backend", "power_monitor.db"))
+    parser.add_argument("--csv", help="also train on a legacy CSV dataset (voltage,current,power,label)")
+    parser.add_argument("--trim", type=float, default=2.0, help="seconds dropped at each session edge")
+    parser.add_argument("--fault-samples", type=int, default=50, help="synthetic FAULT samples to add")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="parallel training processes")
+    parser.add_argument("--quick", action="store_true", help="train only the default architecture")
+    parser.add_argument("--windowed", action="store_true",
+                        help=f"train on {WINDOW_SIZE}-sample window features (server-side model)")
+    parser.add_argument("--no-cache", action="store_true", help="rebuild features from the DB")
+    parser.add_argument("--out", default=BUILD_DIR)
+    parser.add_argument("--install", action="store_true", help="copy the best model into backend/ and firmware/")
+    parser.add_argument("--seed", type=int, default=SEED)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    X, labels, groups, key, cached = load_features(args.db, args.csv, args.trim, use_cache=not args.no_cache)
+    print(f"Features: {len(X)} samples ({'cache' if cached else 'built'} {key}) "
+          f"in {time.perf_counter() - start:.2f}s")
+    rng = np.random.default_rng(args.seed)
+    X, labels, groups = add_synthetic_faults(X, labels, groups, args.fault_samples, rng, args.windowed)
+    if args.windowed:
+        X, labels, groups = add_transients(X, labels, groups, rng)
+        X, ends = grouped_window_features(X, groups)
+        labels, groups = labels[ends], groups[ends]
+        print(f"Windows: {len(X)} x {X.shape[1]} features ({WINDOW_SIZE} samples each)")
+    classes, y = np.unique(labels, return_inverse=True)  # Sorted, like LabelEncoder
+    print("Class distribution: " + ", ".join(f"{c} {n}" for c, n in zip(classes, np.bincount(y))))
+    if len(classes) < 2:
+        raise SystemExit("Need at least two labelled classes: record some sessions with /api/record first")
+
+    train_idx, test_idx = stratified_split(y, TEST_FRACTION, rng)
+    X_train, y_train, X_test, y_test = X[train_idx], y[train_idx], X[test_idx], y[test_idx]
+    space = QUICK_SPACE if args.quick else SEARCH_SPACE
+    jobs = [(params, args.seed, X_train, y_train, X_test, y_test, len(classes)) for params in candidates(space)]
+    workers = max(1, min(args.workers, len(jobs)))
+    print(f"Searching {len(jobs)} candidate(s) on {workers} process(es)...")
+    search_start = time.perf_counter()
+    results = search(jobs, workers)
+    search_s = time.perf_counter() - search_start
+
+    # Best validation accuracy; ties go to the smaller, then faster model
+    best_metrics, best_bytes = max(results, key=lambda r: (round(r[0]["val_accuracy"], 4),
+                                                           -r[0]["size_bytes"], -r[0]["latency_us"]))
+    print(f"Best: {best_metrics['params']} -> test {best_metrics['test_accuracy'] * 100:.1f}%, "
+          f"{best_metrics['size_bytes']} B, {best_metrics['latency_us']:.2f} us/inference "
+          f"(search {search_s:.0f}s, total {time.perf_counter() - start:.0f}s)")
+    flips = flip_rate(tflite_predict(interpreter_class(), best_bytes, X), groups)
+    print(f"Prediction flips between consecutive samples: {flips * 100:.2f}%")
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "dataset": {"key": key, "samples": int(len(X)), "classes": classes.tolist(),
+                    "counts": np.bincount(y).tolist(), "db": os.path.abspath(args.db), "csv": args.csv,
+                    "trim": args.trim, "fault_samples": args.fault_samples},
+        "features": list(FEATURE_NAMES) if args.windowed else list(FEATURES),
+        "window": WINDOW_SIZE if args.windowed else 1,
+        "seed": args.seed,
+        "search_s": round(search_s, 1),
+        "candidates": sorted((m for m, _ in results), key=lambda m: -m["val_accuracy"]),
+        "best": best_metrics,
+        "flip_rate": round(flips, 4),
+    }
+    write_outputs(args.out, best_bytes, classes.tolist(), report, windowed=args.windowed)
+    print(f"Wrote {args.out}")
+    if args.install:
+        install(args.out, windowed=args.windowed)
+
+
+if __name__ == "__main__":
+    main()